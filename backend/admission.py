@@ -0,0 +1,247 @@
+import asyncio
+import contextlib
+import contextvars
+import math
+import time
+from collections import deque
+
+# priority classes, most urgent first: a student waiting on an answer goes
+# before embedding an upload or extracting deadlines
+INTERACTIVE = "interactive"
+BULK        = "bulk"
+PRIORITIES  = (INTERACTIVE, BULK)
+
+# whom the OpenAI calls made in this context are for; copied into the tasks
+# it starts (streamed responses, background jobs)
+_client = contextvars.ContextVar("llm_client", default=(None, BULK))
+
+
+def use(user: str, priority: str):
+    """Attributes the OpenAI calls made from here on in this context to `user` at `priority`."""
+    _client.set((user, priority))
+
+
+def estimate_tokens(*texts) -> int:
+    # charged before the call, so a cheap chars/4 estimate rather than BPE
+    return sum(len(t) for t in texts) // 4 + 1
+
+
+class Overloaded(Exception):
+    """The call would queue too long; answer 429 and come back after `retry_after` seconds."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    """
+    Refills at `rate` tokens/s up to `burst`. A call goes ahead while there
+    is at least a token left and is charged its whole cost, so one large
+    call can take the level negative and the next waits until it's paid back.
+    A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate  = rate
+        self.burst = burst
+        self.level = burst
+        self.t     = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.burst, self.level + (now - self.t) * self.rate)
+        self.t     = now
+
+    def wait(self, now: float) -> float:
+        """Seconds until a call could go ahead; 0 if it can now."""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.level >= 1 else (1 - self.level) / self.rate
+
+    def take(self, cost: float, now: float):
+        if self.rate:
+            self._refill(now)
+            self.level -= cost
+
+    def full(self, now: float) -> bool:
+        if self.rate:
+            self._refill(now)
+        return self.level >= self.burst
+
+
+class _Waiter:
+    __slots__ = ("user", "cost", "future", "t0")
+
+    def __init__(self, user, cost, future):
+        self.user   = user
+        self.cost   = cost
+        self.future = future
+        self.t0     = time.monotonic()
+
+
+class Scheduler:
+    """
+    Admission control in front of every outbound OpenAI call. A call takes
+    a slot (`async with scheduler.slot(tokens)`) and waits in its priority
+    class's queue until there's a free connection (`max_active` overall,
+    `user_active` per user) and both the user's bucket for that class and
+    the global bucket have credit (`user_tpm[priority]`, `global_tpm`,
+    tokens per minute). Queued interactive calls always go before bulk
+    ones; a user held back by their own limits doesn't hold up the others.
+
+    Endpoints call `check` before starting work, which raises Overloaded
+    when the class's queue (or the user's share of it) is full or the
+    user's bucket wouldn't have credit again within `max_wait` seconds.
+    """
+
+    def __init__(self, global_tpm: float, user_tpm: dict, max_active: int, user_active: int,
+                 queue_limits: dict, user_queue: int, max_wait: float, registry=None):
+        self.global_bucket = TokenBucket(global_tpm / 60, global_tpm)
+        self.user_tpm      = user_tpm
+        self.max_active    = max_active
+        self.user_active   = user_active
+        self.queue_limits  = queue_limits
+        self.user_queue    = user_queue
+        self.max_wait      = max_wait
+        self.active        = 0
+        self.rejected      = {p: 0 for p in PRIORITIES}
+        self._queues       = {p: deque() for p in PRIORITIES}
+        self._buckets      = {}   # (user, priority) -> TokenBucket
+        self._user_active  = {}
+        self._user_queued  = {}
+        self._timer        = None
+        self._waits        = None
+        self._rejections   = None
+        if registry is not None:
+            self._waits      = registry.histogram("rag_llm_queue_wait_seconds",
+                                                  "Time OpenAI calls waited for admission", ("priority",))
+            self._rejections = registry.counter("rag_llm_rejected_total",
+                                                "Requests refused with 429 by admission control",
+                                                ("priority", "reason"))
+            registry.gauge("rag_llm_queue_depth", "OpenAI calls waiting for admission",
+                           lambda: {p: len(q) for p, q in self._queues.items()}, label="priority")
+            registry.gauge("rag_llm_active", "OpenAI calls in flight", lambda: self.active)
+
+    def _bucket(self, user, priority: str):
+        if user is None or not self.user_tpm.get(priority):
+            return None
+        bucket = self._buckets.get((user, priority))
+        if bucket is None:
+            if len(self._buckets) >= 10_000:
+                self._prune()
+            tpm    = self.user_tpm[priority]
+            bucket = self._buckets[(user, priority)] = TokenBucket(tpm / 60, tpm)
+        return bucket
+
+    def _prune(self):
+        # a full bucket carries no state worth keeping
+        now = time.monotonic()
+        for key in [k for k, b in self._buckets.items() if b.full(now)]:
+            del self._buckets[key]
+
+    def _reject(self, priority: str, reason: str, retry_after: float):
+        self.rejected[priority] += 1
+        if self._rejections is not None:
+            self._rejections.inc(priority=priority, reason=reason)
+        raise Overloaded(f"Too many requests ({reason}); retry in {math.ceil(retry_after)}s.", retry_after)
+
+    def check(self, user, priority: str):
+        """Raises Overloaded if a call for `user` at `priority` would be queued too long."""
+        now   = time.monotonic()
+        queue = self._queues[priority]
+        # roughly how long the calls already queued will take to drain
+        drain = self.global_bucket.wait(now) + len(queue) / max(self.max_active, 1)
+        if len(queue) >= self.queue_limits[priority]:
+            self._reject(priority, "queue full", drain)
+        if user is not None and self._user_queued.get(user, 0) >= self.user_queue:
+            self._reject(priority, "user queue full", drain)
+        bucket = self._bucket(user, priority)
+        wait   = bucket.wait(now) if bucket is not None else 0.0
+        if wait > self.max_wait:
+            self._reject(priority, "user rate limit", wait)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens: int, priority: str = None):
+        """Holds an admitted call for the body of the block; `priority` overrides the context's."""
+        user, default = _client.get()
+        priority      = priority or default
+        await self._acquire(user, priority, tokens)
+        try:
+            yield
+        finally:
+            self._release(user)
+
+    async def _acquire(self, user, priority: str, tokens: int):
+        waiter = _Waiter(user, tokens, asyncio.get_running_loop().create_future())
+        self._queues[priority].append(waiter)
+        self._user_queued[user] = self._user_queued.get(user, 0) + 1
+        try:
+            self._dispatch()
+            await waiter.future
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # admitted just as we were cancelled
+                self._release(user)
+            else:
+                waiter.future.cancel()
+                self._dispatch()
+            raise
+        finally:
+            self._user_queued[user] -= 1
+            if not self._user_queued[user]:
+                del self._user_queued[user]
+        if self._waits is not None:
+            self._waits.observe(time.monotonic() - waiter.t0, priority=priority)
+
+    def _release(self, user):
+        self.active -= 1
+        self._user_active[user] -= 1
+        if not self._user_active[user]:
+            del self._user_active[user]
+        self._dispatch()
+
+    def _dispatch(self):
+        """Admits whatever queued calls can go now and sets a timer for when buckets refill."""
+        now     = time.monotonic()
+        wake    = None
+        blocked = False  # out of global capacity: nothing lower in priority may pass
+        for priority in PRIORITIES:
+            waiting = deque()
+            for waiter in self._queues[priority]:
+                if waiter.future.done():
+                    continue  # cancelled while queued
+                if blocked or self.active >= self.max_active:
+                    blocked = True
+                    waiting.append(waiter)
+                    continue
+                if waiter.user is not None and self._user_active.get(waiter.user, 0) >= self.user_active:
+                    waiting.append(waiter)
+                    continue
+                bucket = self._bucket(waiter.user, priority)
+                delay  = bucket.wait(now) if bucket is not None else 0.0
+                if not delay:
+                    delay   = self.global_bucket.wait(now)
+                    blocked = bool(delay)
+                if delay:
+                    wake = delay if wake is None else min(wake, delay)
+                    waiting.append(waiter)
+                    continue
+                if bucket is not None:
+                    bucket.take(waiter.cost, now)
+                self.global_bucket.take(waiter.cost, now)
+                self.active += 1
+                self._user_active[waiter.user] = self._user_active.get(waiter.user, 0) + 1
+                waiter.future.set_result(None)
+            self._queues[priority] = waiting
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if wake is not None:
+            self._timer = asyncio.get_running_loop().call_later(wake, self._dispatch)
+
+    def stats(self) -> dict:
+        return {"active":   self.active,
+                "queued":   {p: len(q) for p, q in self._queues.items()},
+                "rejected": dict(self.rejected)}
@@ -0,0 +1,131 @@
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+
+def passages_key(parts) -> str:
+    """Identifies the retrieved context an answer was generated from."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def scope_key(content_hashes) -> str:
+    return hashlib.sha256("\0".join(sorted(content_hashes)).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    Past answers keyed by scope and query embedding. A query within
+    `threshold` cosine similarity of a cached one, in the same scope and with
+    the same retrieved passages, gets the cached answer back without an LLM
+    call. Scopes are built from content hashes of the indexes searched, so an
+    edited document can never be answered from its old text; `invalidate`
+    frees the entries built on a content hash once it changes.
+    """
+
+    def __init__(self, max_entries: int = 10000, threshold: float = 0.97,
+                 ttl_s: float = 86400, max_per_scope: int = 512):
+        self.max_entries   = max_entries
+        self.threshold     = threshold
+        self.ttl_s         = ttl_s
+        self.max_per_scope = max_per_scope
+        self._entries      = OrderedDict()  # id -> entry, in LRU order
+        self._scopes       = {}             # scope -> [ids], oldest first
+        self._tags         = {}             # content hash -> {ids}
+        self._matrix       = {}             # scope -> (ids, stacked unit vectors)
+        self._ids          = itertools.count()
+        self._lock         = threading.Lock()
+        self.hits          = 0
+        self.misses        = 0
+        self.evictions     = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _unit(qv) -> np.ndarray:
+        v = np.asarray(qv, dtype="float32").reshape(-1)
+        n = np.linalg.norm(v)
+        return v / n if n else v
+
+    def lookup(self, scope: str, qv, pkey: str) -> Optional[str]:
+        with self._lock:
+            ids = self._scopes.get(scope)
+            if not ids:
+                self.misses += 1
+                return None
+            cached = self._matrix.get(scope)
+            if cached is None or cached[0] != ids:
+                cached = (list(ids), np.vstack([self._entries[i]["vec"] for i in ids]))
+                self._matrix[scope] = cached
+            cand_ids, mat = cached
+            sims = mat @ self._unit(qv)
+            now  = time.time()
+            for j in np.argsort(-sims):
+                if sims[j] < self.threshold:
+                    break
+                entry = self._entries[cand_ids[j]]
+                if entry["pkey"] == pkey and now - entry["created"] <= self.ttl_s:
+                    self._entries.move_to_end(cand_ids[j])
+                    self.hits += 1
+                    return entry["answer"]
+            self.misses += 1
+            return None
+
+    def store(self, scope: str, tags, qv, pkey: str, answer: str):
+        with self._lock:
+            eid = next(self._ids)
+            self._entries[eid] = {"scope": scope, "tags": list(tags), "vec": self._unit(qv),
+                                  "pkey": pkey, "answer": answer, "created": time.time()}
+            self._scopes.setdefault(scope, []).append(eid)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(eid)
+            if len(self._scopes[scope]) > self.max_per_scope:
+                self._drop(self._scopes[scope][0])
+                self.evictions += 1
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, eid):
+        entry = self._entries.pop(eid, None)
+        if entry is None:
+            return
+        ids = self._scopes.get(entry["scope"], [])
+        if eid in ids:
+            ids.remove(eid)
+        if not ids:
+            self._scopes.pop(entry["scope"], None)
+            self._matrix.pop(entry["scope"], None)
+        for tag in entry["tags"]:
+            self._tags.get(tag, set()).discard(eid)
+            if not self._tags.get(tag):
+                self._tags.pop(tag, None)
+
+    def invalidate(self, tag: str) -> int:
+        """Drops every entry built on the index content identified by `tag`."""
+        with self._lock:
+            ids = list(self._tags.get(tag, ()))
+            for eid in ids:
+                self._drop(eid)
+            self.invalidations += len(ids)
+            return len(ids)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries":       len(self._entries),
+            "scopes":        len(self._scopes),
+            "hits":          self.hits,
+            "misses":        self.misses,
+            "hit_rate":      (self.hits / lookups) if lookups else 0.0,
+            "evictions":     self.evictions,
+            "invalidations": self.invalidations,
+            "threshold":     self.threshold,
+        }
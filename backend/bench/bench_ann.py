@@ -0,0 +1,83 @@
+"""
+Offline recall@k vs latency for the index types in vector_index, on a
+synthetic clustered corpus (no API calls).
+
+    cd backend && python -m bench.bench_ann --n 1000000 --dim 1536
+
+A 1M x 1536 float32 corpus is ~6 GB before any index is built; use a smaller
+--n/--dim for a quick look.
+"""
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+import vector_index
+
+
+def make_corpus(n, dim, nq, clusters, seed=0):
+    # mixture of gaussians, normalized like ada-002 vectors
+    rng     = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype("float32")
+    xb      = np.empty((n, dim), dtype="float32")
+    step    = 100_000
+    for s in range(0, n, step):
+        e      = min(n, s + step)
+        assign = rng.integers(0, clusters, e - s)
+        xb[s:e] = centers[assign] + 0.5 * rng.standard_normal((e - s, dim)).astype("float32")
+    faiss.normalize_L2(xb)
+    xq = xb[rng.integers(0, n, nq)] + 0.05 * rng.standard_normal((nq, dim)).astype("float32")
+    faiss.normalize_L2(xq)
+    return xb, xq
+
+
+def timed_search(idx, xq, k, **params):
+    # one query at a time, like the API serves them
+    t0 = time.perf_counter()
+    out = np.vstack([vector_index.search(idx, xq[i:i + 1], k, **params)[1] for i in range(len(xq))])
+    return out, (time.perf_counter() - t0) / len(xq) * 1000
+
+
+def recall(found, truth):
+    k = truth.shape[1]
+    return float(np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)]))
+
+
+def main(args):
+    xb, xq = make_corpus(args.n, args.dim, args.queries, args.clusters)
+    ids    = np.arange(args.n, dtype="int64")
+    rows   = []
+
+    t0   = time.perf_counter()
+    flat = vector_index.train_and_fill("flat", args.dim, ids, xb)
+    build = time.perf_counter() - t0
+    truth, ms = timed_search(flat, xq, args.k)
+    rows.append({"index": "flat", "build_s": round(build, 1), "param": None,
+                 "recall": 1.0, "latency_ms": round(ms, 3)})
+    del flat
+
+    for kind, knob, values in (("hnsw", "ef_search", args.ef), ("ivfpq", "nprobe", args.nprobe)):
+        t0    = time.perf_counter()
+        idx   = vector_index.train_and_fill(kind, args.dim, ids, xb)
+        build = time.perf_counter() - t0
+        for v in values:
+            found, ms = timed_search(idx, xq, args.k, **{knob: v})
+            rows.append({"index": kind, "build_s": round(build, 1), "param": f"{knob}={v}",
+                         "recall": round(recall(found, truth), 4), "latency_ms": round(ms, 3)})
+        del idx
+
+    print(json.dumps({"n": args.n, "dim": args.dim, "k": args.k, "results": rows}, indent=2))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=1_000_000)
+    ap.add_argument("--dim", type=int, default=1536)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--clusters", type=int, default=1000)
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128, 256])
+    ap.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64, 128])
+    main(ap.parse_args())
@@ -0,0 +1,70 @@
+"""
+What plan_chat sends the model for a degree question: the whole catalog
+plus the student's uploaded course JSON (before), against the local degree
+audit (now), in prompt tokens, and how long parsing and auditing take.
+
+    cd backend && python -m bench.bench_audit --courses 30
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import time
+
+import degree_audit
+from ingest import Tokenizer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fake_transcript(program, n: int, seed: int = 0) -> dict:
+    """A Canvas course list: `n` rows drawn from the catalog, the last few in progress."""
+    rng   = random.Random(seed)
+    codes = sorted(program.courses())
+    rows  = [{"class_name": f"{c}-20 {program.titles.get(c, '')}".strip(), "course_id": str(1000 + i),
+              "term": "Fall 2024", "enrolled_as": "Student", "published": True}
+             for i, c in enumerate(rng.sample(codes, min(n, len(codes))))]
+    split = max(0, len(rows) - 4)
+    return {"pastCourses": rows[:split], "currentCourses": rows[split:]}
+
+
+def timed(fn, repeat: int):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return out, (time.perf_counter() - t0) / repeat * 1000
+
+
+def main(args):
+    tok    = Tokenizer("gpt-4o")
+    report = []
+    for path in sorted(glob.glob(os.path.join(args.plan_dir, "*.txt"))):
+        text = open(path, encoding="utf-8").read()
+        program, parse_ms = timed(lambda: degree_audit.parse_catalog(text), args.repeat)
+        if not program.requirements:
+            continue
+        blob       = fake_transcript(program, args.courses)
+        taken      = degree_audit.student_courses(blob, program.titles)
+        result, ms = timed(lambda: degree_audit.audit(program, taken), args.repeat)
+        context    = degree_audit.format_audit(result, program.titles)
+        before     = text + "\n---\n" + json.dumps(blob)
+        report.append({
+            "catalog":                os.path.basename(path),
+            "requirements":           len(program.requirements),
+            "student_courses":        len(taken),
+            "parse_ms":               round(parse_ms, 3),
+            "audit_ms":               round(ms, 3),
+            "context_tokens_before":  tok.count(before),
+            "context_tokens_audit":   tok.count(context),
+            "unmet":                  sum(1 for r in result["requirements"] if r["remaining"]),
+        })
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--plan-dir", default=os.path.join(BACKEND_DIR, "plan_data"))
+    ap.add_argument("--courses", type=int, default=20, help="courses on the synthetic transcript")
+    ap.add_argument("--repeat", type=int, default=100)
+    main(ap.parse_args())
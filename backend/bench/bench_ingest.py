@@ -0,0 +1,58 @@
+"""
+Compares one-request-per-document embedding (what upload_docs used to do)
+against the batched, concurrent EmbeddingPipeline, using the fake server.
+
+    cd backend && python -m bench.bench_ingest --docs 500
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import faiss
+import openai
+
+from bench.fake_openai import DIM, create_app, serve_in_thread
+from ingest import EmbeddingPipeline
+
+
+def make_docs(n: int):
+    words = "exam homework syllabus lecture midterm project reading quiz office hours grading".split()
+    return [" ".join(words[(i + j) % len(words)] for j in range(200)) + f" doc {i}" for i in range(n)]
+
+
+async def run(client, docs, **kw):
+    pipe  = EmbeddingPipeline(client, "text-embedding-ada-002", DIM, cache=None, **kw)
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
+    t0    = time.perf_counter()
+    await pipe.add_documents(index, range(len(docs)), docs)
+    dt    = time.perf_counter() - t0
+    return {"seconds": round(dt, 3), "docs_per_sec": round(len(docs) / dt, 1),
+            "requests": pipe.requests, "indexed": index.ntotal}
+
+
+async def main(args):
+    app = create_app(args.latency_ms, args.per_input_ms)
+    serve_in_thread(app, args.port)
+    client = openai.AsyncOpenAI(api_key="bench", base_url=f"http://127.0.0.1:{args.port}/v1")
+    docs   = make_docs(args.docs)
+
+    report = {
+        "docs": args.docs,
+        "sequential": await run(client, docs, concurrency=1, max_batch_inputs=1),
+        "batched":    await run(client, docs, concurrency=args.concurrency,
+                                max_batch_inputs=args.batch_size),
+    }
+    report["speedup"] = round(report["batched"]["docs_per_sec"] / report["sequential"]["docs_per_sec"], 1)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--docs", type=int, default=300)
+    ap.add_argument("--batch-size", type=int, default=64)
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--latency-ms", type=float, default=100.0)
+    ap.add_argument("--per-input-ms", type=float, default=1.0)
+    ap.add_argument("--port", type=int, default=9871)
+    asyncio.run(main(ap.parse_args()))
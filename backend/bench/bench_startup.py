@@ -0,0 +1,99 @@
+"""
+Cold start: what `import main` spends its time on (cumulative -X importtime,
+by top-level package), and with --serve how long a fresh uvicorn process
+takes to answer /healthz, a repeat query, and a 200 from /readyz.
+
+    cd backend && python -m bench.bench_startup
+    cd backend && python -m bench.bench_startup --serve --token alice --query "when is the midterm"
+
+The repeat query should be one this user has asked before the restart, so
+its embedding is in embedding_cache.sqlite.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_RE   = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_profile(top: int) -> dict:
+    env  = {"OPENAI_API_KEY": "x", **os.environ}
+    t0   = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                          cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    if proc.returncode:
+        raise SystemExit(proc.stderr[-2000:])
+    by_package = {}
+    total      = 0
+    for line in proc.stderr.splitlines():
+        m = IMPORT_RE.match(line)
+        if not m:
+            continue
+        cumulative, depth, name = int(m.group(2)), len(m.group(3)), m.group(4)
+        if name == "main" and depth == 1:
+            total = cumulative
+        elif depth == 3:  # imported by main itself
+            package = name.split(".")[0]
+            by_package[package] = by_package.get(package, 0) + cumulative
+    ranked = sorted(by_package.items(), key=lambda kv: -kv[1])[:top]
+    return {"process_wall_s": round(wall, 3),
+            "import_main_ms": round(total / 1000, 1),
+            "by_module_ms":   {k: round(v / 1000, 1) for k, v in ranked}}
+
+
+def wait_for(url: str, t0: float, ok=lambda r: True, timeout: float = 120):
+    while time.perf_counter() - t0 < timeout:
+        try:
+            r = httpx.get(url, timeout=1)
+            if ok(r):
+                return time.perf_counter() - t0, r
+        except httpx.TransportError:
+            pass
+        time.sleep(0.01)
+    raise SystemExit(f"{url} didn't answer within {timeout}s")
+
+
+def serve_profile(args) -> dict:
+    base = f"http://127.0.0.1:{args.port}"
+    t0   = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port)],
+                            cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        out = {}
+        out["healthz_s"], _ = wait_for(f"{base}/healthz", t0)
+        if args.query:
+            r = httpx.post(f"{base}/api/rag/query", json={"query": args.query},
+                           headers={"Authorization": f"Bearer {args.token}"}, timeout=60)
+            out["query_s"], out["query_status"] = round(time.perf_counter() - t0, 3), r.status_code
+        out["readyz_s"], r = wait_for(f"{base}/readyz", t0, lambda r: r.status_code == 200)
+        out["warm_up_stages_s"] = r.json()["stages"]
+        out["healthz_s"], out["readyz_s"] = round(out["healthz_s"], 3), round(out["readyz_s"], 3)
+        return out
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main(args):
+    report = {"import": import_profile(args.top)}
+    if args.serve:
+        report["serve"] = serve_profile(args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--top", type=int, default=15, help="modules to list")
+    ap.add_argument("--serve", action="store_true", help="also time a uvicorn start")
+    ap.add_argument("--port", type=int, default=8137)
+    ap.add_argument("--token", default="bench", help="bearer token of the querying user")
+    ap.add_argument("--query", help="a query to send as soon as /healthz answers")
+    main(ap.parse_args())
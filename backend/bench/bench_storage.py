@@ -0,0 +1,130 @@
+"""
+Bytes per document and recall@k of the VECTOR_STORAGE modes, against exact
+float32 search, with and without the re-ranking PersistentIndex does. Runs
+on the embeddings in embedding_cache.sqlite when there are enough of them
+(our corpus, no API calls), otherwise on a synthetic clustered corpus.
+
+    cd backend && python -m bench.bench_storage --k 10
+    cd backend && python -m bench.bench_storage --synthetic --n 200000
+
+Queries are corpus vectors with a little noise added. Also reports what the
+passage metadata costs per document as a dict of dicts and as a MetaTable.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+import tracemalloc
+
+import faiss
+import numpy as np
+
+import vector_index
+from bench.bench_ann import make_corpus, recall
+from metatable import MetaTable
+from persistence import VectorRows
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def cached_vectors(path: str, limit: int):
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("SELECT vec FROM embeddings LIMIT ?", (limit,)).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return None
+    return np.vstack([np.frombuffer(r[0], dtype="float32") for r in rows])
+
+
+def noisy_queries(xb, nq: int, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    xq  = xb[rng.integers(0, len(xb), nq)] + 0.05 * rng.standard_normal((nq, xb.shape[1])).astype("float32")
+    faiss.normalize_L2(xq)
+    return xq
+
+
+def timed(fn, xq):
+    # one query at a time, like the API serves them
+    t0  = time.perf_counter()
+    out = np.vstack([fn(xq[i:i + 1]) for i in range(len(xq))])
+    return out, (time.perf_counter() - t0) / len(xq) * 1000
+
+
+def measure_meta(n: int) -> dict:
+    # 40 passages per file, as a course page chunks into
+    rows = {i: {"source_file": f"{i // 40}_page{i // 40}.txt", "start": 1600 * (i % 40),
+                "end": 1600 * (i % 40) + 1800} for i in range(n)}
+    tracemalloc.start()
+    as_dict = dict((i, dict(r)) for i, r in rows.items())
+    size    = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del as_dict
+    return {"dict_bytes_per_doc":  round(size / n, 1),
+            "table_bytes_per_doc": round(MetaTable(rows).memory_bytes() / n, 1)}
+
+
+def main(args):
+    xb, source = None, "synthetic"
+    if not args.synthetic:
+        xb = cached_vectors(args.cache, args.n)
+        if xb is not None and len(xb) >= args.min_real:
+            source = args.cache
+        else:
+            xb = None
+    if xb is None:
+        xb, xq = make_corpus(args.n, args.dim, args.queries, args.clusters)
+    else:
+        xq = noisy_queries(xb, args.queries)
+    n, dim = xb.shape
+    ids    = np.arange(n, dtype="int64")
+    exact  = vector_index.train_and_fill("flat", dim, ids, xb)
+    truth  = exact.search(xq, args.k)[1]
+    full   = VectorRows(None, dim)
+    full.write(ids, xb)
+
+    results = []
+    for kind in ("flat", "hnsw"):
+        for storage in vector_index.STORAGE_TYPES:
+            t0    = time.perf_counter()
+            idx   = vector_index.train_and_fill(kind, dim, ids, xb, storage)
+            build = time.perf_counter() - t0
+            row   = {
+                "index":                  kind,
+                "storage":                storage,
+                "build_s":                round(build, 2),
+                "memory_bytes_per_doc":   round(vector_index.index_bytes(idx) / n, 1),
+                "snapshot_bytes_per_doc": round(len(faiss.serialize_index(idx)) / n, 1),
+            }
+            found, ms = timed(lambda q: vector_index.search(idx, q, args.k)[1], xq)
+            row["recall"], row["latency_ms"] = round(recall(found, truth), 4), round(ms, 3)
+            if storage != "fp32":
+                depth = args.k * vector_index.RERANK_FACTOR
+                found, ms = timed(
+                    lambda q: vector_index.rerank(q, vector_index.search(idx, q, depth)[1], full, args.k)[1], xq)
+                row["rerank_recall"], row["rerank_latency_ms"] = round(recall(found, truth), 4), round(ms, 3)
+                # the float32 copies re-ranking reads from
+                row["rows_file_bytes_per_doc"] = dim * 4
+            results.append(row)
+            del idx
+
+    print(json.dumps({"source": source, "n": n, "dim": dim, "k": args.k,
+                      "rerank_factor": vector_index.RERANK_FACTOR, "results": results,
+                      "metadata": measure_meta(n)}, indent=2))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--cache", default=os.path.join(BACKEND_DIR, "embedding_cache.sqlite"))
+    ap.add_argument("--synthetic", action="store_true", help="ignore the embedding cache")
+    ap.add_argument("--min-real", type=int, default=1000, help="fewer cached vectors than this: synthetic")
+    ap.add_argument("--n", type=int, default=100_000, help="corpus size (at most this many cached vectors)")
+    ap.add_argument("--dim", type=int, default=1536, help="synthetic corpus only")
+    ap.add_argument("--clusters", type=int, default=1000, help="synthetic corpus only")
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--k", type=int, default=10)
+    main(ap.parse_args())
@@ -0,0 +1,135 @@
+"""
+Local stand-in for the OpenAI embeddings and chat completions APIs, for
+benchmarks.
+
+Vectors are deterministic (seeded from the input text) and every embeddings
+request sleeps `latency_ms` plus `per_input_ms` per input, roughly like the
+real endpoint. Chat completions wait `first_token_ms`, then stream
+`completion_tokens` chunks `token_ms` apart; non-streamed completions (the
+deadline extraction) answer with a few deadlines derived from the prompt.
+Run standalone with:
+
+    python -m bench.fake_openai --port 9999 --latency-ms 150
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+DIM = 1536
+
+
+def fake_vector(text: str, dim: int = DIM):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    v    = np.random.default_rng(seed).standard_normal(dim).astype("float32")
+    return v / np.linalg.norm(v)
+
+
+def fake_deadlines(messages) -> str:
+    """A deadline extraction answer that only depends on the prompt."""
+    h = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).digest()
+    return json.dumps([
+        {"title": f"Problem Set {h[i]}", "due_date": f"2026-{h[i] % 12 + 1:02d}-{h[i + 1] % 28 + 1:02d}",
+         "type": "assignment" if i else "exam"}
+        for i in range(3)
+    ])
+
+
+def create_app(latency_ms: float = 100.0, per_input_ms: float = 1.0,
+               first_token_ms: float = 300.0, token_ms: float = 20.0,
+               completion_tokens: int = 50):
+    app = FastAPI()
+    app.state.calls  = 0
+    app.state.inputs = 0
+    app.state.chats  = 0
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body   = await request.json()
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        app.state.calls  += 1
+        app.state.inputs += len(inputs)
+        await asyncio.sleep((latency_ms + per_input_ms * len(inputs)) / 1000)
+        return {
+            "object": "list",
+            "model":  body.get("model"),
+            "data": [
+                {"object": "embedding", "index": i, "embedding": fake_vector(t).tolist()}
+                for i, t in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.chats += 1
+        words = [f" word{i}" for i in range(completion_tokens)]
+
+        def chunk(delta, finish=None):
+            return {
+                "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0,
+                "model": body.get("model"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+
+        if not body.get("stream"):
+            await asyncio.sleep((first_token_ms + token_ms * completion_tokens) / 1000)
+            return {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": 0,
+                "model": body.get("model"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant",
+                                         "content": fake_deadlines(body.get("messages", []))}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+
+        async def stream():
+            await asyncio.sleep(first_token_ms / 1000)
+            yield f"data: {json.dumps(chunk({'role': 'assistant', 'content': ''}))}\n\n"
+            for w in words:
+                yield f"data: {json.dumps(chunk({'content': w}))}\n\n"
+                await asyncio.sleep(token_ms / 1000)
+            yield f"data: {json.dumps(chunk({}, 'stop'))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def stats():
+        return {"calls": app.state.calls, "inputs": app.state.inputs, "chats": app.state.chats}
+
+    return app
+
+
+def serve_in_thread(app, port: int):
+    """Starts uvicorn on 127.0.0.1:`port` in a daemon thread and waits until it's up."""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=9999)
+    ap.add_argument("--latency-ms", type=float, default=100.0)
+    ap.add_argument("--per-input-ms", type=float, default=1.0)
+    ap.add_argument("--first-token-ms", type=float, default=300.0)
+    ap.add_argument("--token-ms", type=float, default=20.0)
+    ap.add_argument("--completion-tokens", type=int, default=50)
+    args = ap.parse_args()
+    app  = create_app(args.latency_ms, args.per_input_ms, args.first_token_ms, args.token_ms,
+                      args.completion_tokens)
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
@@ -0,0 +1,147 @@
+"""
+Fires N concurrent /api/rag/chat requests at a running backend and reports
+time-to-first-token and total latency percentiles.
+
+    python -m bench.fake_openai --port 9999 &
+    OPENAI_BASE_URL=http://127.0.0.1:9999/v1 OPENAI_API_KEY=fake \\
+        uvicorn main:app --port 8000 &
+    python -m bench.load_chat --url http://127.0.0.1:8000 --concurrency 50
+    python -m bench.load_chat --concurrency 50 --users 10 --hot-share 0.6
+
+Each simulated user has its own bearer token (<token>-<n>, one chat each
+by default), since admission control limits every user separately. With
+--hot-share that share of the chats all come from user 0, and the report
+splits latencies into the hot user and everyone else. The rest of the
+report shows whether admission held the hot user back without slowing
+the others: requests refused with 429, and admission rejections and queue
+wait read off /metrics, split into per-user and global limits.
+"""
+import argparse
+import asyncio
+import json
+import re
+import time
+
+import httpx
+import numpy as np
+
+
+def percentiles(xs):
+    if not xs:
+        return {}
+    a = np.array(xs) * 1000
+    return {"p50_ms": round(float(np.percentile(a, 50)), 1),
+            "p95_ms": round(float(np.percentile(a, 95)), 1),
+            "p99_ms": round(float(np.percentile(a, 99)), 1),
+            "max_ms": round(float(a.max()), 1)}
+
+
+# admission rejection reasons (rag_llm_rejected_total) by whose limit was hit
+USER_REASONS   = ("user queue full", "user rate limit")
+GLOBAL_REASONS = ("queue full",)
+METRIC_RE      = re.compile(r'^(rag_llm_rejected_total|rag_llm_queue_wait_seconds_sum|rag_llm_queue_wait_seconds_count)'
+                            r'\{([^}]*)\} (\S+)$')
+
+
+async def one_chat(client, url, endpoint, token, i):
+    t0   = time.perf_counter()
+    ttft = None
+    body = {"query": f"When is the midterm for course {i % 5}?", "top_k": 5}
+    async with client.stream("POST", f"{url}{endpoint}", json=body,
+                             headers={"Authorization": f"Bearer {token}"}) as resp:
+        if resp.status_code == 429:
+            return None
+        resp.raise_for_status()
+        async for chunk in resp.aiter_text():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - t0
+    return ttft, time.perf_counter() - t0
+
+
+async def admission_metrics(client, url) -> dict:
+    """{(metric, reason): value} of the interactive admission series; {} if /metrics is off."""
+    resp = await client.get(f"{url}/metrics")
+    if resp.status_code != 200:
+        return {}
+    out = {}
+    for line in resp.text.splitlines():
+        m = METRIC_RE.match(line)
+        if m and 'priority="interactive"' in m.group(2):
+            reason = re.search(r'reason="([^"]*)"', m.group(2))
+            out[(m.group(1), reason.group(1) if reason else "")] = float(m.group(3))
+    return out
+
+
+def admission_report(before: dict, after: dict) -> dict:
+    def delta(metric, reason=""):
+        return after.get((metric, reason), 0.0) - before.get((metric, reason), 0.0)
+
+    waits = delta("rag_llm_queue_wait_seconds_count")
+    return {
+        "rejected_per_user":  {r: int(delta("rag_llm_rejected_total", r)) for r in USER_REASONS},
+        "rejected_global":    {r: int(delta("rag_llm_rejected_total", r)) for r in GLOBAL_REASONS},
+        "avg_queue_wait_ms":  round(delta("rag_llm_queue_wait_seconds_sum") / waits * 1000, 2) if waits else 0.0,
+    }
+
+
+def chat_users(args) -> list:
+    """The user index of each chat: the hot share from user 0, the rest round-robin over the others."""
+    hot    = round(args.concurrency * args.hot_share) if args.users > 1 else 0
+    others = max(args.users - 1, 1) if hot else args.users
+    return [0] * hot + [(1 if hot else 0) + i % others for i in range(args.concurrency - hot)]
+
+
+def latency_report(results) -> dict:
+    ok = [r for r in results if r is not None]
+    return {"chats":    len(results),
+            "rejected": len(results) - len(ok),
+            "ttft":     percentiles([r[0] for r in ok if r[0] is not None]),
+            "total":    percentiles([r[1] for r in ok])}
+
+
+async def main(args):
+    tokens = [f"{args.token}-{u}" for u in range(args.users)]
+    users  = chat_users(args)
+    async with httpx.AsyncClient(timeout=120,
+                                 limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        if args.seed_docs:
+            docs = {str(c): {"pages": {f"p{p}": f"Course {c} page {p}: midterm on day {p}."
+                                       for p in range(args.seed_docs)}}
+                    for c in range(5)}
+            # every user searches their own shards; after the first upload
+            # the embeddings come from the cache
+            for token in sorted({tokens[u] for u in users}):
+                (await client.post(f"{args.url}/api/rag/upload", params={"wait": "true"},
+                                   json={"docs": docs},
+                                   headers={"Authorization": f"Bearer {token}"})).raise_for_status()
+
+        before  = await admission_metrics(client, args.url)
+        t0      = time.perf_counter()
+        results = await asyncio.gather(*[one_chat(client, args.url, args.endpoint, tokens[u], i)
+                                         for i, u in enumerate(users)])
+        wall    = time.perf_counter() - t0
+        after   = await admission_metrics(client, args.url)
+
+    report = {"concurrency": args.concurrency, "users": len(set(users)), "wall_s": round(wall, 2),
+              **latency_report(results)}
+    if args.hot_share and args.users > 1:
+        report["hot_user"] = latency_report([r for r, u in zip(results, users) if u == 0])
+        report["others"]   = latency_report([r for r, u in zip(results, users) if u != 0])
+    report["admission"] = admission_report(before, after)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--endpoint", default="/api/rag/chat")
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--token", default="loadtest", help="token prefix; user n sends <token>-<n>")
+    ap.add_argument("--users", type=int, help="distinct simulated users (default: one per chat)")
+    ap.add_argument("--hot-share", type=float, default=0.0,
+                    help="share of the chats sent by user 0 (a noisy neighbour)")
+    ap.add_argument("--seed-docs", type=int, default=10,
+                    help="pages per course to upload first (0 to skip)")
+    args = ap.parse_args()
+    args.users = args.users or args.concurrency
+    asyncio.run(main(args))
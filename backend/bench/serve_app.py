@@ -0,0 +1,69 @@
+"""
+Runs the backend with Google Calendar replaced by an in-memory fake, so
+/api/rag/deadlines can be benchmarked without OAuth. Used by bench.suite:
+
+    OPENAI_BASE_URL=http://127.0.0.1:9999/v1 OPENAI_API_KEY=fake \\
+        python -m bench.serve_app --port 8000
+"""
+import argparse
+import threading
+import time
+
+import uvicorn
+
+
+class FakeHttpError(Exception):
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.resp = type("Resp", (), {"status": status})()
+
+
+class FakeCalendar:
+    """The slice of the Calendar v3 client that deadlines.insert_events uses."""
+
+    def __init__(self, latency_ms: float):
+        self.latency_ms = latency_ms
+        self.events_by_id = {}
+        self._lock = threading.Lock()
+
+    def events(self):
+        return self
+
+    def insert(self, calendarId: str, body: dict):
+        return body
+
+    def new_batch_http_request(self, callback):
+        calendar = self
+
+        class Batch:
+            def __init__(self):
+                self.requests = []
+
+            def add(self, event, request_id):
+                self.requests.append((request_id, event))
+
+            def execute(self):
+                time.sleep(calendar.latency_ms / 1000)
+                for request_id, event in self.requests:
+                    with calendar._lock:
+                        taken = event["id"] in calendar.events_by_id
+                        calendar.events_by_id.setdefault(event["id"], event)
+                    callback(request_id, None if taken else event,
+                             FakeHttpError(409) if taken else None)
+
+        return Batch()
+
+
+def main(args):
+    import main as backend
+
+    calendar = FakeCalendar(args.calendar_latency_ms)
+    backend.get_calendar_service = lambda user: calendar
+    uvicorn.run(backend.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--calendar-latency-ms", type=float, default=200.0)
+    main(ap.parse_args())
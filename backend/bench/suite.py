@@ -0,0 +1,254 @@
+"""
+Offline end-to-end benchmark: starts the backend in a scratch copy of this
+directory against bench.fake_openai (and a fake Google Calendar), runs the
+scripted workloads and prints one JSON report, so runs before and after a
+change can be diffed without spending API credits.
+
+    cd backend && python -m bench.suite --courses 20 --pages 30 --chats 200 --out run.json
+
+Workloads, in order: upload (N courses, a few per request), rebuild (full
+re-embed), chat (concurrent streamed /api/rag/chat) and deadlines (first run
+extracts, later runs hit the cache). Each reports throughput and latency
+percentiles; peak_rss_mb is the backend process's high-water mark.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench.fake_openai import create_app, serve_in_thread
+from bench.load_chat import percentiles
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# runtime state the backend writes next to its sources; never copied
+STATE = ("data", "shards", "plan_index*", "plan_students", "*.sqlite*", "*.index", "__pycache__")
+# uploads, rebuilds and deadline scans are jobs; time them to completion
+WAIT  = {"wait": "true"}
+WORDS = ("exam homework syllabus lecture midterm project reading quiz office hours grading "
+         "rubric lab section final essay problem set due late policy").split()
+
+
+def make_course(rng: random.Random, cid: int, pages: int, words: int) -> dict:
+    def text(kind):
+        body = " ".join(rng.choice(WORDS) for _ in range(words))
+        return f"Course {cid} {kind}. {body}. Midterm on 2026-10-{cid % 28 + 1:02d}."
+    return {"syllabus": text("syllabus"),
+            "pages": {f"page{p}": text(f"page {p}") for p in range(pages)}}
+
+
+def summarize(latencies, wall: float, errors: int, units: int = None) -> dict:
+    out = {
+        "requests":       len(latencies) + errors,
+        "errors":         errors,
+        "wall_s":         round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "latency":        percentiles(latencies),
+    }
+    if units is not None:
+        out["units_per_s"] = round(units / wall, 2) if wall else 0.0
+    return out
+
+
+async def timed(client, method, path, **kw):
+    t0   = time.perf_counter()
+    resp = await client.request(method, path, **kw)
+    resp.raise_for_status()
+    return time.perf_counter() - t0, resp
+
+
+async def run_upload(client, args, rng):
+    courses = [(str(c), make_course(rng, c, args.pages, args.words)) for c in range(args.courses)]
+    lat, errors = [], 0
+    t0 = time.perf_counter()
+    for i in range(0, len(courses), args.upload_batch):
+        try:
+            dt, _ = await timed(client, "POST", "/api/rag/upload", params=WAIT,
+                                json={"docs": dict(courses[i:i + args.upload_batch])})
+            lat.append(dt)
+        except httpx.HTTPError:
+            errors += 1
+    report = summarize(lat, time.perf_counter() - t0, errors, units=args.courses * (args.pages + 1))
+    report["unit"] = "documents"
+    return report
+
+
+async def run_rebuild(client, args):
+    lat, errors, last = [], 0, None
+    t0 = time.perf_counter()
+    for _ in range(args.rebuilds):
+        try:
+            dt, resp = await timed(client, "POST", "/api/rag/build", params=WAIT, json={"full": True})
+            lat.append(dt)
+            last = resp.json()
+        except httpx.HTTPError:
+            errors += 1
+    report = summarize(lat, time.perf_counter() - t0, errors)
+    report["last"] = last
+    return report
+
+
+async def one_chat(client, query):
+    t0, ttft = time.perf_counter(), None
+    async with client.stream("POST", "/api/rag/chat", json={"query": query, "top_k": 5}) as resp:
+        resp.raise_for_status()
+        async for chunk in resp.aiter_text():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - t0
+    return ttft, time.perf_counter() - t0
+
+
+async def run_chat(client, args, rng):
+    # a fixed share of repeated questions, so answer-cache changes show up too
+    pool    = [f"When is the midterm for course {c}?" for c in range(args.courses)]
+    queries = [rng.choice(pool) if rng.random() < args.repeat else
+               f"What is the late policy for {rng.choice(WORDS)} in course {rng.randrange(args.courses)} ({i})?"
+               for i in range(args.chats)]
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def bounded(q):
+        async with sem:
+            try:
+                return await one_chat(client, q)
+            except httpx.HTTPError:
+                return None
+
+    t0      = time.perf_counter()
+    results = await asyncio.gather(*(bounded(q) for q in queries))
+    wall    = time.perf_counter() - t0
+    ok      = [r for r in results if r is not None]
+    report  = summarize([r[1] for r in ok], wall, len(results) - len(ok))
+    report["ttft"]        = percentiles([r[0] for r in ok if r[0] is not None])
+    report["concurrency"] = args.concurrency
+    return report
+
+
+async def run_deadlines(client, args):
+    lat, errors, runs = [], 0, []
+    t0 = time.perf_counter()
+    for _ in range(args.deadline_runs):
+        try:
+            dt, resp = await timed(client, "POST", "/api/rag/deadlines", params=WAIT)
+            lat.append(dt)
+            body = resp.json()
+            runs.append({"ms":       round(dt * 1000, 1),
+                         "misses":   sum(c["cache"] == "miss" for c in body["courses"].values()),
+                         "created":  body["calendar"]["created"]})
+        except httpx.HTTPError:
+            errors += 1
+    report = summarize(lat, time.perf_counter() - t0, errors)
+    report["runs"] = runs
+    return report
+
+
+def start_backend(workdir: str, args) -> subprocess.Popen:
+    env = {**os.environ,
+           "OPENAI_API_KEY":  "bench",
+           "OPENAI_BASE_URL": f"http://127.0.0.1:{args.fake_port}/v1",
+           "PYTHONPATH":      workdir,
+           "STATE_DIR":       workdir}
+    log = open(os.path.join(workdir, "backend.log"), "w")
+    return subprocess.Popen(
+        [sys.executable, "-m", "bench.serve_app", "--port", str(args.port),
+         "--calendar-latency-ms", str(args.calendar_latency_ms)],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+async def wait_ready(url: str, proc: subprocess.Popen, timeout: float = 120.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"backend exited with {proc.returncode}, see backend.log")
+            try:
+                await client.get(f"{url}/docs")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError("backend did not start")
+
+
+def peak_rss_mb() -> float:
+    # high-water mark of waited-for children; KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+async def main(args):
+    rng  = random.Random(args.seed)
+    fake = create_app(args.latency_ms, args.per_input_ms, args.first_token_ms, args.token_ms,
+                      args.completion_tokens)
+    serve_in_thread(fake, args.fake_port)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="canvas-bench-")
+    shutil.copytree(BACKEND_DIR, workdir, dirs_exist_ok=True, ignore=shutil.ignore_patterns(*STATE))
+    proc = start_backend(workdir, args)
+    url  = f"http://127.0.0.1:{args.port}"
+    workloads = {}
+    try:
+        await wait_ready(url, proc)
+        headers = {"Authorization": f"Bearer {args.token}"}
+        limits  = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=url, headers=headers, timeout=600, limits=limits) as client:
+            workloads["upload"]    = await run_upload(client, args, rng)
+            workloads["rebuild"]   = await run_rebuild(client, args)
+            workloads["chat"]      = await run_chat(client, args, rng)
+            workloads["deadlines"] = await run_deadlines(client, args)
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "workdir", "token")},
+        "workloads":   workloads,
+        "peak_rss_mb": peak_rss_mb(),
+        "openai":      {"embedding_requests": fake.state.calls, "embedding_inputs": fake.state.inputs,
+                        "chat_requests": fake.state.chats},
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--courses", type=int, default=10)
+    ap.add_argument("--pages", type=int, default=20, help="pages per course (plus a syllabus)")
+    ap.add_argument("--words", type=int, default=300, help="words per page")
+    ap.add_argument("--upload-batch", type=int, default=2, help="courses per upload request")
+    ap.add_argument("--rebuilds", type=int, default=1)
+    ap.add_argument("--chats", type=int, default=100)
+    ap.add_argument("--concurrency", type=int, default=20)
+    ap.add_argument("--repeat", type=float, default=0.3, help="share of chats repeating a question")
+    ap.add_argument("--deadline-runs", type=int, default=2)
+    ap.add_argument("--latency-ms", type=float, default=100.0)
+    ap.add_argument("--per-input-ms", type=float, default=1.0)
+    ap.add_argument("--first-token-ms", type=float, default=300.0)
+    ap.add_argument("--token-ms", type=float, default=20.0)
+    ap.add_argument("--completion-tokens", type=int, default=50)
+    ap.add_argument("--calendar-latency-ms", type=float, default=200.0)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--fake-port", type=int, default=9872)
+    ap.add_argument("--token", default="bench")
+    ap.add_argument("--workdir", help="keep the backend's files here instead of a temp dir")
+    ap.add_argument("--out", help="also write the report to this file")
+    asyncio.run(main(ap.parse_args()))
@@ -0,0 +1,65 @@
+import re
+
+CHUNK_TOKENS   = 400
+OVERLAP_TOKENS = 64
+
+_WORD = re.compile(rb"\S+\s*|\s+")
+
+
+def _units(data: bytes, tokenizer):
+    """
+    Splits utf-8 `data` into (start, end, tokens) spans. With tiktoken the
+    spans are real tokens, otherwise words with a bytes/4 token estimate.
+    """
+    enc = tokenizer.encoding()
+    if enc is not None:
+        pos = 0
+        out = []
+        for tok in enc.encode(data.decode("utf-8"), disallowed_special=()):
+            n = len(enc.decode_single_token_bytes(tok))
+            out.append((pos, pos + n, 1))
+            pos += n
+        return out
+    return [(m.start(), m.end(), max(1, (m.end() - m.start()) // 4)) for m in _WORD.finditer(data)]
+
+
+def _char_boundary(data: bytes, pos: int) -> int:
+    # tokens can split a multi-byte character; back up to its first byte
+    while 0 < pos < len(data) and (data[pos] & 0xC0) == 0x80:
+        pos -= 1
+    return pos
+
+
+def chunk_text(text: str, tokenizer, chunk_tokens: int = CHUNK_TOKENS,
+               overlap_tokens: int = OVERLAP_TOKENS):
+    """
+    Splits `text` into overlapping windows of about `chunk_tokens` tokens.
+    Returns [(start, end, passage)] where start/end are byte offsets into
+    text.encode("utf-8"), i.e. into the .txt file as written to disk.
+    """
+    data  = text.encode("utf-8")
+    units = _units(data, tokenizer)
+    if not units:
+        return []
+
+    chunks = []
+    i = 0
+    while i < len(units):
+        j, tokens = i, 0
+        while j < len(units) and (tokens < chunk_tokens or j == i):
+            tokens += units[j][2]
+            j += 1
+        start = _char_boundary(data, units[i][0])
+        end   = len(data) if j == len(units) else _char_boundary(data, units[j][0])
+        if end > start:
+            chunks.append((start, end, data[start:end].decode("utf-8")))
+        if j == len(units):
+            break
+
+        # step back far enough to overlap by ~overlap_tokens
+        back, k = 0, j
+        while k > i + 1 and back < overlap_tokens:
+            k -= 1
+            back += units[k][2]
+        i = k
+    return chunks
@@ -0,0 +1,283 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    import redis
+except ImportError:  # only needed for CONVERSATION_BACKEND=redis
+    redis = None
+
+
+def new_conversation() -> dict:
+    # messages are OpenAI-style {role, content}; older turns are folded into
+    # `summary` and dropped, `turns` counts everything ever appended
+    return {"summary": "", "messages": [], "turns": 0, "updated": time.time()}
+
+
+class MemoryBackend:
+    """In-process dict with LRU and TTL eviction. Lost on restart, per worker."""
+
+    def __init__(self, max_items: int, ttl_s: float):
+        self.max_items = max_items
+        self.ttl_s     = ttl_s
+        self._items    = OrderedDict()
+        self._lock     = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            conv = self._items.get(key)
+            if conv is None:
+                return None
+            if time.time() - conv["updated"] > self.ttl_s:
+                del self._items[key]
+                self.evictions += 1
+                return None
+            self._items.move_to_end(key)
+            return json.loads(json.dumps(conv))
+
+    def put(self, key: str, conv: dict):
+        with self._lock:
+            self._items[key] = conv
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._items.pop(key, None) is not None
+
+    def scan(self, prefix: str):
+        with self._lock:
+            return [(k, c) for k, c in self._items.items() if k.startswith(prefix)]
+
+    def count(self) -> int:
+        return len(self._items)
+
+
+class SQLiteBackend:
+    """
+    One row per conversation in a local SQLite file, so history survives
+    restarts and is shared by every worker on the host. Expired and least
+    recently used rows are purged every `purge_every` writes.
+    """
+
+    def __init__(self, path: str, max_items: int, ttl_s: float, purge_every: int = 100):
+        self.max_items   = max_items
+        self.ttl_s       = ttl_s
+        self.purge_every = purge_every
+        self._writes     = 0
+        self._lock       = threading.Lock()
+        self._conn       = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            " key TEXT PRIMARY KEY, data TEXT, updated REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated)")
+        self._conn.commit()
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM conversations WHERE key = ? AND updated > ?",
+                (key, time.time() - self.ttl_s),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, conv: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversations (key, data, updated) VALUES (?, ?, ?)",
+                (key, json.dumps(conv), conv["updated"]),
+            )
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self._purge()
+            self._conn.commit()
+
+    def _purge(self):
+        cur = self._conn.execute("DELETE FROM conversations WHERE updated <= ?",
+                                 (time.time() - self.ttl_s,))
+        self.evictions += cur.rowcount
+        cur = self._conn.execute(
+            "DELETE FROM conversations WHERE key NOT IN "
+            "(SELECT key FROM conversations ORDER BY updated DESC LIMIT ?)",
+            (self.max_items,),
+        )
+        self.evictions += cur.rowcount
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM conversations WHERE key = ?", (key,))
+            self._conn.commit()
+            return cur.rowcount > 0
+
+    def scan(self, prefix: str):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, data FROM conversations WHERE key >= ? AND key < ? AND updated > ?",
+                (prefix, prefix + "\uffff", time.time() - self.ttl_s),
+            ).fetchall()
+        return [(k, json.loads(d)) for k, d in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+
+class RedisBackend:
+    """
+    Conversations as JSON strings in Redis (or anything speaking its
+    protocol) with a per-key TTL; LRU is left to the server's
+    `maxmemory-policy allkeys-lru`.
+    """
+
+    def __init__(self, url: str, ttl_s: float, namespace: str = "conv:"):
+        if redis is None:
+            raise RuntimeError("CONVERSATION_BACKEND=redis needs the redis package")
+        self.ttl_s     = int(ttl_s)
+        self.namespace = namespace
+        self._client   = redis.Redis.from_url(url)
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        data = self._client.get(self.namespace + key)
+        return json.loads(data) if data else None
+
+    def put(self, key: str, conv: dict):
+        self._client.set(self.namespace + key, json.dumps(conv), ex=self.ttl_s)
+
+    def delete(self, key: str) -> bool:
+        return bool(self._client.delete(self.namespace + key))
+
+    def scan(self, prefix: str):
+        keys = list(self._client.scan_iter(match=f"{self.namespace}{prefix}*"))
+        out  = []
+        for k, data in zip(keys, self._client.mget(keys) if keys else []):
+            if data:
+                out.append((k.decode()[len(self.namespace):], json.loads(data)))
+        return out
+
+    def count(self) -> int:
+        return sum(1 for _ in self._client.scan_iter(match=f"{self.namespace}*"))
+
+
+class ConversationStore:
+    """
+    Chat history per (user, conversation id) on top of one of the backends.
+    `window` returns what goes into the prompt: the rolling summary plus the
+    newest turns that fit in `history_tokens`. Once the stored turns pass
+    twice that, `compact` folds the oldest into the summary, so both storage
+    and prompt size stay bounded no matter how long a conversation runs.
+    """
+
+    def __init__(self, backend, tokenizer, history_tokens: int = 2000, max_messages: int = 100):
+        self.backend        = backend
+        self.tokenizer      = tokenizer
+        self.history_tokens = history_tokens
+        self.max_messages   = max_messages
+        # read-modify-write of one conversation; cheap, so one lock is enough
+        self._lock          = threading.Lock()
+        self.summaries      = 0
+
+    @staticmethod
+    def _key(user: str, cid: str) -> str:
+        return f"{user}:{cid}"
+
+    def get(self, user: str, cid: str) -> dict:
+        return self.backend.get(self._key(user, cid)) or new_conversation()
+
+    def append(self, user: str, cid: str, role: str, content: str):
+        with self._lock:
+            conv = self.get(user, cid)
+            conv["messages"].append({"role": role, "content": content})
+            conv["turns"]  += 1
+            # hard cap in case summarizing keeps failing
+            del conv["messages"][:-self.max_messages]
+            conv["updated"] = time.time()
+            self.backend.put(self._key(user, cid), conv)
+
+    def _tokens(self, msg: dict) -> int:
+        return self.tokenizer.count(msg["content"]) + 4
+
+    def window(self, user: str, cid: str):
+        conv   = self.get(user, cid)
+        picked, used = [], 0
+        for msg in reversed(conv["messages"]):
+            n = self._tokens(msg)
+            if picked and used + n > self.history_tokens:
+                break
+            picked.append(msg)
+            used += n
+        picked.reverse()
+        if conv["summary"]:
+            picked.insert(0, {"role": "system",
+                              "content": f"Summary of the earlier conversation:\n{conv['summary']}"})
+        return picked
+
+    def _overflow(self, conv: dict):
+        """How many of the oldest messages to fold so the rest fit in the window."""
+        sizes = [self._tokens(m) for m in conv["messages"]]
+        if sum(sizes) <= 2 * self.history_tokens:
+            return 0
+        keep, used = 0, 0
+        for n in reversed(sizes):
+            if keep and used + n > self.history_tokens:
+                break
+            keep += 1
+            used += n
+        return len(sizes) - keep
+
+    async def compact(self, user: str, cid: str, summarize, run_blocking):
+        """
+        Folds turns that fell out of the window into the summary using the
+        async `summarize(summary, messages) -> str`. Messages appended while
+        the summary is being written are kept.
+        """
+        conv = await run_blocking(self.get, user, cid)
+        n    = self._overflow(conv)
+        if not n:
+            return
+        old = conv["messages"][:n]
+        try:
+            summary = await summarize(conv["summary"], old)
+        except Exception as e:
+            logging.warning(f"Conversation summary failed, keeping raw history: {e}")
+            return
+
+        def apply():
+            with self._lock:
+                cur = self.get(user, cid)
+                if cur["messages"][:n] != old:
+                    return
+                cur["summary"]  = summary
+                cur["messages"] = cur["messages"][n:]
+                cur["updated"]  = time.time()
+                self.backend.put(self._key(user, cid), cur)
+                self.summaries += 1
+        await run_blocking(apply)
+
+    def delete(self, user: str, cid: str) -> bool:
+        return self.backend.delete(self._key(user, cid))
+
+    def list(self, user: str):
+        prefix = self._key(user, "")
+        return [
+            {"id": key[len(prefix):], "message_count": conv["turns"]}
+            for key, conv in self.backend.scan(prefix)
+        ]
+
+    def stats(self):
+        return {
+            "backend":       type(self.backend).__name__,
+            "conversations": self.backend.count(),
+            "evictions":     self.backend.evictions,
+            "summaries":     self.summaries,
+        }
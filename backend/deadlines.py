@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+# bump when the prompt changes so cached extractions are redone
+PROMPT_VERSION = 1
+# Google recommends keeping batches to ~50 calls
+CALENDAR_BATCH_SIZE = 50
+
+
+def build_prompt(context: str) -> str:
+    return (
+        "Extract all exam or assignment deadlines from the following syllabus/pages.  "
+        "For each item, give:\n"
+        "  - title (e.g. “Midterm Exam 1”, “Problem Set 3”) \n"
+        "  - due_date (ISO format YYYY-MM-DD if possible)  \n"
+        "  - type (“exam” or “assignment”)\n"
+        "Return a JSON array only, e.g.:\n"
+        '[ { "title": "...", "due_date": "...", "type": "..." }, … ]\n\n'
+        f"CONTEXT:\n{context}"
+    )
+
+
+def parse_deadlines(cid: str, raw: str) -> list:
+    cleaned = re.sub(r"^```(?:json)?\s*", "", raw.strip())
+    cleaned = re.sub(r"\s*```$", "", cleaned)
+    cleaned = cleaned.strip()
+    try:
+        items = json.loads(cleaned)
+    except json.JSONDecodeError as e:
+        logging.error(f"[{cid}] JSON parse error: {e}")
+        logging.error(f"[{cid}] raw response:\n{raw}")
+        return []
+    return [i for i in items if isinstance(i, dict)] if isinstance(items, list) else []
+
+
+def course_hash(model: str, texts) -> str:
+    """Identifies one extraction: same model, prompt and source texts -> same deadlines."""
+    h = hashlib.sha256(f"{model}\0{PROMPT_VERSION}".encode("utf-8"))
+    for text in texts:
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+    return h.hexdigest()
+
+
+def event_id(cid: str, item: dict) -> str:
+    """
+    Deterministic Calendar event id (base32hex: 0-9a-v), so the same deadline
+    is only ever created once even if our own record of it is lost.
+    """
+    key = f"{cid}\0{item.get('title', '')}\0{item.get('due_date', '')}\0{item.get('type', '')}"
+    return "cc" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:40]
+
+
+def make_event(cid: str, item: dict) -> dict:
+    return {
+        "id":          event_id(cid, item),
+        "summary":     f"{item.get('title', 'Deadline')} ({item.get('type', 'assignment')})",
+        "start":       {"date": item["due_date"]},
+        "end":         {"date": item["due_date"]},
+        "description": f"Auto-added from Canvas course {cid}",
+    }
+
+
+class DeadlineStore:
+    """
+    SQLite-backed record of extracted deadlines (keyed by `course_hash`), of
+    the Calendar events already created for each user and of each user's
+    Google credentials, so every worker process sees the same.
+    """
+
+    def __init__(self, path: str):
+        self.path  = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS deadlines ("
+            " key TEXT PRIMARY KEY, course_id TEXT, items TEXT, created REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS calendar_events ("
+            " user TEXT, event_id TEXT, created REAL, PRIMARY KEY (user, event_id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS google_tokens (user TEXT PRIMARY KEY, data TEXT, updated REAL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT items FROM deadlines WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, course_id: str, items: list):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO deadlines (key, course_id, items, created) VALUES (?, ?, ?, ?)",
+                (key, course_id, json.dumps(items), time.time()),
+            )
+            self._conn.commit()
+
+    def created_events(self, user: str, event_ids) -> set:
+        event_ids = list(event_ids)
+        found = set()
+        with self._lock:
+            for i in range(0, len(event_ids), 500):
+                part = event_ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT event_id FROM calendar_events WHERE user = ? AND event_id IN ({','.join('?' * len(part))})",
+                    [user, *part],
+                ).fetchall()
+                found.update(r[0] for r in rows)
+        return found
+
+    def mark_created(self, user: str, event_ids):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO calendar_events (user, event_id, created) VALUES (?, ?, ?)",
+                [(user, eid, now) for eid in event_ids],
+            )
+            self._conn.commit()
+
+
+    def token(self, user: str):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM google_tokens WHERE user = ?", (user,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_token(self, user: str, token: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO google_tokens (user, data, updated) VALUES (?, ?, ?)",
+                (user, json.dumps(token), time.time()),
+            )
+            self._conn.commit()
+
+
+def insert_events(calendar, events, batch_size: int = CALENDAR_BATCH_SIZE):
+    """
+    Inserts `events` with the Calendar batch API. Returns (created, existing,
+    failed) lists of event ids; a 409 means the event id is already taken,
+    i.e. we created it on an earlier run.
+    """
+    created, existing, failed = [], [], []
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            created.append(request_id)
+        elif getattr(getattr(exception, "resp", None), "status", None) == 409:
+            existing.append(request_id)
+        else:
+            logging.error(f"Failed to create event {request_id}: {exception}")
+            failed.append(request_id)
+
+    for i in range(0, len(events), batch_size):
+        batch = calendar.new_batch_http_request(callback=callback)
+        for event in events[i:i + batch_size]:
+            batch.add(calendar.events().insert(calendarId="primary", body=event),
+                      request_id=event["id"])
+        batch.execute()
+    return created, existing, failed
@@ -0,0 +1,76 @@
+import hashlib
+import re
+import zlib
+from typing import Optional
+
+import numpy as np
+
+# MinHash over word 5-shingles; 16 bands of 4 rows put near-duplicates in
+# a shared bucket from about 0.5 Jaccard, candidates are then checked
+# against the actual threshold
+NUM_PERM = 64
+BANDS    = 16
+SHINGLE  = 5
+
+_MERSENNE = np.uint64((1 << 61) - 1)
+_rng      = np.random.default_rng(20240901)
+_A        = _rng.integers(1, 1 << 31, NUM_PERM, dtype=np.uint64)
+_B        = _rng.integers(0, 1 << 31, NUM_PERM, dtype=np.uint64)
+_WORD     = re.compile(r"\w+")
+
+
+def text_hash(text: str) -> str:
+    """sha256 of the UTF-8 text, as stored in manifest entries."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def minhash(text: str):
+    words = _WORD.findall(text.lower())
+    grams = {" ".join(words[i:i + SHINGLE]) for i in range(max(1, len(words) - SHINGLE + 1))}
+    x     = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+    # (a*x + b) mod p stays below 2**64 since a, b < 2**31 and x < 2**32
+    return ((np.outer(_A, x) + _B[:, None]) % _MERSENNE).min(axis=1).tolist()
+
+
+def similarity(a, b) -> float:
+    """Estimated Jaccard similarity of two signatures."""
+    return float(np.mean(np.asarray(a, dtype=np.uint64) == np.asarray(b, dtype=np.uint64)))
+
+
+class DuplicateFinder:
+    """
+    Finds the file an incoming one duplicates: byte-identical by sha256,
+    or, with a threshold set, near-identical by MinHash with LSH buckets.
+    """
+
+    def __init__(self, threshold: float = 0.0):
+        self.threshold = threshold
+        self.by_hash   = {}
+        self.sigs      = {}
+        self.buckets   = {}
+
+    @staticmethod
+    def _bands(sig):
+        rows = NUM_PERM // BANDS
+        return [(b, tuple(sig[b * rows:(b + 1) * rows])) for b in range(BANDS)]
+
+    def add(self, name: str, entry: dict):
+        self.by_hash.setdefault(entry["sha256"], name)
+        sig = entry.get("minhash")
+        if self.threshold and sig:
+            self.sigs[name] = sig
+            for band in self._bands(sig):
+                self.buckets.setdefault(band, []).append(name)
+
+    def find(self, sha256: str, sig=None) -> Optional[str]:
+        if sha256 in self.by_hash:
+            return self.by_hash[sha256]
+        if not (self.threshold and sig):
+            return None
+        candidates = {n for band in self._bands(sig) for n in self.buckets.get(band, ())}
+        best, best_sim = None, self.threshold
+        for name in sorted(candidates):
+            sim = similarity(sig, self.sigs[name])
+            if sim >= best_sim:
+                best, best_sim = name, sim
+        return best
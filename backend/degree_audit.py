@@ -0,0 +1,335 @@
+"""
+Degree requirements parsed from the plan_data catalogs, and a local audit of
+a student's courses against them, so plan_chat can send the model a short
+"done / still needed" summary instead of whole catalog files.
+
+A catalog is read the way it's written: the program summary up to the first
+"Course List" table is the requirement model, the tables after it only
+supply course titles. In the summary a line without course codes is a
+heading and the code lines under it are its options:
+
+  "6 core courses:"                    every line is required
+  "Mathematics"                        (no count) every line is required
+  "Project Courses (choose two):"      any two of the courses listed
+  "Breadth Areas (one course from each):"
+      "Theory:" / "Systems:" / ...     one course from each sub-area
+
+"or" separates alternatives on a line ("MATH 220-1 & 220-2 or MATH 218-1,
+218-2, 218-3" is one slot filled by either sequence), and "Any 300- or
+400-level COMP_SCI course" lets any such course count as an option.
+"""
+import re
+
+# "COMP_SCI 214-0", "COMP_SCI 214", "COMP_SCI_214-0-20" (a Canvas section)
+COURSE_RE = re.compile(r"\b([A-Z][A-Z]+(?:_[A-Z]+)*)[ _:]+(\d{3})(?!\d)(?:-(\d))?")
+# "335-0" after a subject already named on the line
+NUMBER_RE = re.compile(r"\b(\d{3})-(\d)\b")
+WORDS     = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+             "seven": 7, "eight": 8, "nine": 9, "ten": 10}
+COUNT_RE  = re.compile(r"\(choose (\w+)\)|^(\d+) ", re.I)
+EACH_RE   = re.compile(r"one (?:course )?from each", re.I)
+ANY_RE    = re.compile(r"any (\d)00-(?:\s*or (\d)00-)?\s*level ([A-Z_]+) course", re.I)
+TABLE     = ("Course List", "Expand all")
+# options listed per unmet requirement in the audit text
+MAX_LISTED = 8
+
+
+def course_code(subject: str, number: str, suffix: str = None) -> str:
+    return f"{subject} {number}-{suffix or '0'}"
+
+
+def course_codes(line: str, subject: str = None):
+    """
+    Course codes on a catalog line, in order. Bare numbers take the last
+    subject named, or `subject` (from the line before) if there's none yet.
+    """
+    codes, pos = [], 0
+    for m in sorted([*COURSE_RE.finditer(line), *NUMBER_RE.finditer(line)], key=lambda m: m.start()):
+        if m.start() < pos:
+            continue  # the number part of a code already taken
+        if m.re is COURSE_RE:
+            subject = m.group(1)
+            codes.append(course_code(subject, m.group(2), m.group(3)))
+        elif subject is not None:
+            codes.append(course_code(subject, m.group(1), m.group(2)))
+        pos = m.end()
+    return codes
+
+
+def _count(word: str) -> int:
+    return int(word) if word.isdigit() else WORDS.get(word.lower(), 1)
+
+
+def _name(heading: str) -> str:
+    name = re.sub(r"\(.*?\)", "", heading).strip().rstrip(":").strip()
+    name = re.sub(r"^\d+\s+", "", name)
+    return name[:1].upper() + name[1:]
+
+
+def _key(name: str) -> str:
+    return re.sub(r"\W+", " ", name.replace("&", "and")).strip().lower()
+
+
+class Requirement:
+    """
+    `need` of `options` must be completed. An option is a list of alternative
+    paths, a path the courses that together complete it. With `each` every
+    option is its own slot (need == len(options)); otherwise any `need` of
+    them. `wildcard` (subject, lowest level) lets any such course count.
+    """
+
+    def __init__(self, name: str, need: int, each: bool, wildcard=None):
+        self.name     = name
+        self.need     = need
+        self.each     = each
+        self.wildcard = wildcard
+        self.options  = []
+
+    def add_line(self, line: str, subject: str = None):
+        if self.each:
+            paths = [course_codes(alt, subject) for alt in re.split(r"\bor\b", line)]
+            paths = [p for p in paths if p]
+            if paths:
+                self.options.append(paths)
+                self.need = len(self.options)
+        else:
+            known = {p[0] for [p] in self.options}
+            self.options += [[[c]] for c in course_codes(line, subject) if c not in known]
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "need": self.need, "each": self.each,
+                "wildcard": list(self.wildcard) if self.wildcard else None, "options": self.options}
+
+
+class Program:
+    def __init__(self, name: str, requirements, titles: dict, notes):
+        self.name         = name
+        self.requirements = requirements
+        self.titles       = titles
+        self.notes        = notes
+
+    def courses(self) -> set:
+        return {c for r in self.requirements for o in r.options for p in o for c in p}
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "requirements": [r.to_dict() for r in self.requirements],
+                "notes": self.notes}
+
+
+def parse_catalog(text: str, name: str = None) -> Program:
+    lines  = [l.strip() for l in text.splitlines()]
+    titles = {}
+    for line in lines:
+        m = COURSE_RE.match(line)
+        if m and m.group(3) is not None:
+            title = line[m.end():].strip(" \t-:")
+            if title[:1].isalpha() and not (COURSE_RE.search(title) or NUMBER_RE.search(title)):
+                titles.setdefault(course_code(*m.groups()), title)
+
+    name         = name or next((l for l in lines if l), "Program")
+    requirements = []
+    notes        = []
+    current      = None   # the requirement the code lines below belong to
+    group        = None   # "one from each" heading its sub-areas are named under
+    heading      = None
+    wildcard     = None
+    in_notes     = False
+    subject      = None   # of the last code line, for continuation lines
+    for line in lines:
+        if line in TABLE:
+            break
+        if not line or line.startswith("("):
+            continue  # blank, or "(Note: STAT 202-0 is *not* accepted.)"
+        if in_notes and line.startswith(("-", "•")):
+            notes.append(line.lstrip("-• ").strip())
+            continue
+        carry = subject if current is not None else None
+        codes = course_codes(line, carry)
+        if not codes:
+            wild = ANY_RE.search(line)
+            if wild and heading is not None:
+                wildcard = (wild.group(3).upper(), int(wild.group(1)) * 100)
+                if current is not None:
+                    current.wildcard = wildcard
+                continue
+            in_notes = line.lower().startswith(("additional notes", "notes"))
+            heading, current, wildcard = line, None, None
+            count = COUNT_RE.search(line)
+            if EACH_RE.search(line) and line.endswith(":"):
+                group = _name(line)
+            elif count or not line.endswith(":"):
+                group = None
+            continue
+        if heading is None:
+            continue
+        if current is None:
+            count = COUNT_RE.search(heading)
+            label = _name(heading) if group is None else f"{group}: {_name(heading)}"
+            if group is not None:
+                current = Requirement(label, 1, each=False)
+            elif count and count.group(1):
+                current = Requirement(label, _count(count.group(1)), each=False)
+            else:
+                # "6 core courses:" or a bare heading: every line is required
+                current = Requirement(label, 0, each=True)
+            current.wildcard = wildcard
+            requirements.append(current)
+        current.add_line(line, carry)
+        subject = codes[-1].split()[0]
+
+    # a heading the summary repeats (a sub-area listed twice) counts once
+    seen, unique = set(), []
+    for r in requirements:
+        if r.options and _key(r.name) not in seen:
+            seen.add(_key(r.name))
+            unique.append(r)
+    return Program(name, unique, titles, notes)
+
+
+def student_courses(blob: dict, titles: dict = None) -> dict:
+    """
+    {course code: "completed" | "in progress"} from the plan upload
+    ({currentCourses: [...], pastCourses: [...]}, rows with a class_name).
+    A name without a code is matched on an unambiguous catalog title.
+    """
+    by_title = {}
+    for code, title in (titles or {}).items():
+        by_title.setdefault(title.lower(), []).append(code)
+    out = {}
+    for field, status in (("pastCourses", "completed"), ("currentCourses", "in progress")):
+        for row in blob.get(field) or []:
+            name  = row.get("class_name", "") if isinstance(row, dict) else str(row)
+            codes = [course_code(*m.groups()) for m in COURSE_RE.finditer(name.upper())]
+            if not codes:
+                lower = name.lower()
+                found = [cs for t, cs in by_title.items() if len(t) >= 12 and t in lower]
+                codes = found[0] if len(found) == 1 and len(found[0]) == 1 else []
+            for code in codes:
+                if out.get(code) != "completed":
+                    out[code] = status
+    return out
+
+
+def _level(code: str) -> int:
+    return int(code.split()[1][:3])
+
+
+def audit(program: Program, taken: dict) -> dict:
+    """
+    Matches the student's courses to requirement slots, each course used at
+    most once (the catalog's "a course may not satisfy more than one
+    requirement"). Multi-course paths (math sequences) are assigned first;
+    single courses then go through a maximum bipartite matching, completed
+    courses tried before ones in progress.
+    """
+    used  = {}   # course -> requirement index
+    slots = []   # (requirement index, candidate courses)
+    filled = {i: [] for i in range(len(program.requirements))}
+
+    for i, req in enumerate(program.requirements):
+        open_options = []
+        for option in req.options:
+            done = next((p for p in option if len(p) > 1 and all(c in taken and c not in used for c in p)), None)
+            if done is not None:
+                for c in done:
+                    used[c] = i
+                filled[i].append(done)
+            else:
+                open_options.append(option)
+        if req.each:
+            for option in open_options:
+                slots.append((i, [p[0] for p in option if len(p) == 1 and p[0] in taken]))
+        else:
+            singles = [p[0] for o in open_options for p in o if len(p) == 1 and p[0] in taken]
+            if req.wildcard:
+                subject, level = req.wildcard
+                singles += [c for c in taken if c.startswith(subject + " ") and _level(c) >= level
+                            and c not in singles]
+            for _ in range(req.need - len(filled[i])):
+                slots.append((i, singles))
+
+    rank  = {"completed": 0, "in progress": 1}
+    owner = {}  # course -> slot
+
+    def augment(s, seen):
+        for c in sorted(slots[s][1], key=lambda c: rank[taken[c]]):
+            if c in used or c in seen:
+                continue
+            seen.add(c)
+            if c not in owner or augment(owner[c], seen):
+                owner[c] = s
+                return True
+        return False
+
+    for s in range(len(slots)):
+        augment(s, set())
+    for c, s in owner.items():
+        used[c] = slots[s][0]
+        filled[slots[s][0]].append([c])
+
+    results = []
+    for i, req in enumerate(program.requirements):
+        courses   = [c for path in filled[i] for c in path]
+        remaining = max(0, req.need - len(filled[i]))
+        open_opts = [o for o in req.options if not any(p in filled[i] for p in o)]
+        results.append({
+            "name":        req.name,
+            "need":        req.need,
+            "completed":   [c for c in courses if taken[c] == "completed"],
+            "in_progress": [c for c in courses if taken[c] == "in progress"],
+            "remaining":   remaining,
+            "options":     [[" & ".join(p) for p in o] for o in open_opts] if remaining else [],
+            "wildcard":    req.wildcard if remaining else None,
+        })
+    return {
+        "program":      program.name,
+        "requirements": results,
+        "satisfied":    all(r["remaining"] == 0 for r in results),
+        "not_counted":  sorted(c for c in taken if c not in used),
+        "notes":        program.notes,
+    }
+
+
+def format_audit(result: dict, titles: dict = None) -> str:
+    """The audit as the few lines of plan_chat context."""
+    titles = titles or {}
+
+    def label(option):
+        alts = [f"{a} {titles[a]}" if a in titles else a for a in option]
+        return " or ".join(alts)
+
+    lines = [f"Degree audit: {result['program']}"]
+    for r in result["requirements"]:
+        status = "NEEDS" if r["remaining"] else ("IN PROGRESS" if r["in_progress"] else "DONE")
+        line   = f"- {r['name']} [{status}] {r['need'] - r['remaining']}/{r['need']}"
+        if r["completed"]:
+            line += f"; completed {', '.join(r['completed'])}"
+        if r["in_progress"]:
+            line += f"; in progress {', '.join(r['in_progress'])}"
+        if r["remaining"]:
+            opts = r["options"]
+            line += f"; needs {r['remaining']} more from: " + "; ".join(label(o) for o in opts[:MAX_LISTED])
+            if len(opts) > MAX_LISTED:
+                line += f"; ... ({len(opts) - MAX_LISTED} more)"
+            if r["wildcard"]:
+                subject, level = r["wildcard"]
+                line += f"; or any {level}+ level {subject} course not used elsewhere"
+        lines.append(line)
+    lines.append("All requirements met." if result["satisfied"] else "Some requirements remain.")
+    if result["not_counted"]:
+        lines.append(f"Courses not counted toward this program: {', '.join(result['not_counted'])}")
+    for note in result["notes"]:
+        lines.append(f"Note: {note}")
+    return "\n".join(lines)
+
+
+def format_courses(blob: dict) -> str:
+    """The student's uploaded course list as context lines (name and term, no JSON)."""
+    lines = ["Student's courses (from their last sync):"]
+    for field, label in (("pastCourses", "Completed"), ("currentCourses", "In progress")):
+        rows = [r for r in blob.get(field) or [] if isinstance(r, dict)]
+        if rows:
+            names = [f"{r.get('class_name', 'Unknown')} ({r['term']})" if r.get("term") not in (None, "Unknown")
+                     else r.get("class_name", "Unknown") for r in rows]
+            lines.append(f"{label}: {'; '.join(names)}")
+    return "\n".join(lines)
@@ -0,0 +1,109 @@
+import glob
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+
+class DocStore:
+    """
+    Holds the source text of every indexed file in memory, keyed by path
+    relative to `directory` (e.g. "<user>/<file>"), as utf-8 bytes so
+    passages can be sliced straight out of it with the byte offsets stored in
+    the index metadata. Loaded once at startup and kept in sync by
+    upload/build, so retrieval never touches the filesystem. With
+    `read_through` (other processes write the directory too, or it's still
+    being loaded) a miss falls back to reading the file, which is then kept.
+    """
+
+    def __init__(self, directory: str, pattern: str = "*.txt", read_through: bool = False):
+        self.directory    = directory
+        self.pattern      = pattern
+        self.read_through = read_through
+        self._docs     = {}
+        self._lock     = threading.Lock()
+        self.hits      = 0
+        self.misses    = 0
+        self._lookup_s = 0.0
+
+    def load(self) -> int:
+        docs = {}
+        for path in glob.glob(os.path.join(self.directory, self.pattern)):
+            with open(path, "rb") as f:
+                docs[os.path.relpath(path, self.directory).replace(os.sep, "/")] = f.read()
+        with self._lock:
+            # anything already here was put or read through while we were
+            # loading (the load runs in the background), so is at least as new
+            docs.update(self._docs)
+            self._docs = docs
+        return len(docs)
+
+    def put(self, fn: str, text: str):
+        with self._lock:
+            self._docs[fn] = text.encode("utf-8")
+
+    def remove(self, fn: str):
+        with self._lock:
+            self._docs.pop(fn, None)
+
+    def names(self):
+        with self._lock:
+            return list(self._docs)
+
+    def __contains__(self, fn: str) -> bool:
+        return fn in self._docs
+
+    def _lookup(self, fn, start=None, end=None) -> Optional[str]:
+        t0   = time.perf_counter()
+        data = self._docs.get(fn)
+        if data is None and self.read_through:
+            data = self._read(fn)
+        if data is None:
+            self.misses += 1
+            text = None
+        else:
+            self.hits += 1
+            if start is not None:
+                data = data[start:end]
+            text = data.decode("utf-8", errors="ignore")
+        self._lookup_s += time.perf_counter() - t0
+        return text
+
+    def _read(self, fn: str) -> Optional[bytes]:
+        path = os.path.join(self.directory, *fn.split("/"))
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._docs[fn] = data
+        return data
+
+    def get(self, fn: str) -> Optional[str]:
+        return self._lookup(fn)
+
+    def passage(self, fn: str, start: int, end: int) -> Optional[str]:
+        return self._lookup(fn, start, end)
+
+    def lookups(self) -> dict:
+        """Cumulative lookup counts and time, cheap enough for every metrics scrape."""
+        return {"hits": self.hits, "misses": self.misses, "seconds": self._lookup_s}
+
+    def stats(self):
+        with self._lock:
+            docs  = len(self._docs)
+            text  = sum(len(b) for b in self._docs.values())
+            total = sys.getsizeof(self._docs) + sum(
+                sys.getsizeof(k) + sys.getsizeof(v) for k, v in self._docs.items()
+            )
+        lookups = self.hits + self.misses
+        return {
+            "documents":      docs,
+            "text_bytes":     text,
+            "memory_bytes":   total,
+            "hits":           self.hits,
+            "misses":         self.misses,
+            "avg_lookup_us":  (self._lookup_s / lookups * 1e6) if lookups else 0.0,
+        }
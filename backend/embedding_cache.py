@@ -0,0 +1,241 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    # embeddings don't care about runs of whitespace or unicode composition,
+    # so "same page scraped twice" should hash to the same key
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+
+def cache_key(model: str, text: str) -> str:
+    h = hashlib.sha256()
+    h.update(model.encode("utf-8"))
+    h.update(b"\0")
+    h.update(normalize_text(text).encode("utf-8"))
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding store.
+
+    Vectors live in a small SQLite file keyed on sha256(model, normalized text),
+    with an in-memory LRU in front of it. The disk store is trimmed back to
+    `max_disk_bytes` by evicting the least recently used rows.
+    """
+
+    def __init__(self, path: str, max_memory_items: int = 4096,
+                 max_disk_bytes: int = 512 * 1024 * 1024):
+        self.path             = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes   = max_disk_bytes
+        self._lru             = OrderedDict()
+        self._lock            = threading.Lock()
+        self.hits             = 0
+        self.memory_hits      = 0
+        self.misses           = 0
+        self.evictions        = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "  key TEXT PRIMARY KEY,"
+            "  model TEXT NOT NULL,"
+            "  vec BLOB NOT NULL,"
+            "  last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self._db.commit()
+        self._disk_bytes = self._db.execute(
+            "SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def _remember(self, key, vec):
+        self._lru[key] = vec
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_memory_items:
+            self._lru.popitem(last=False)
+
+    def get_many(self, model: str, texts):
+        """Returns a list aligned with `texts`; None where the vector isn't cached."""
+        keys = [cache_key(model, t) for t in texts]
+        out  = [None] * len(keys)
+        with self._lock:
+            pending = {}
+            for i, k in enumerate(keys):
+                vec = self._lru.get(k)
+                if vec is not None:
+                    self._lru.move_to_end(k)
+                    out[i] = vec
+                    self.hits += 1
+                    self.memory_hits += 1
+                else:
+                    pending.setdefault(k, []).append(i)
+
+            if pending:
+                found = {}
+                ks = list(pending)
+                for start in range(0, len(ks), 500):
+                    part = ks[start:start + 500]
+                    rows = self._db.execute(
+                        f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})",
+                        part,
+                    ).fetchall()
+                    for k, blob in rows:
+                        found[k] = np.frombuffer(blob, dtype="float32")
+                if found:
+                    now = time.time()
+                    self._db.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                        [(now, k) for k in found],
+                    )
+                    self._db.commit()
+                for k, idxs in pending.items():
+                    vec = found.get(k)
+                    if vec is None:
+                        self.misses += len(idxs)
+                        continue
+                    self._remember(k, vec)
+                    self.hits += len(idxs)
+                    for i in idxs:
+                        out[i] = vec
+        return out
+
+    def put_many(self, model: str, texts, vecs):
+        now  = time.time()
+        rows = []
+        with self._lock:
+            for text, vec in zip(texts, vecs):
+                k   = cache_key(model, text)
+                vec = np.ascontiguousarray(vec, dtype="float32").reshape(-1)
+                self._remember(k, vec)
+                rows.append((k, model, vec.tobytes(), now))
+            old = self._db.execute(
+                f"SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings WHERE key IN ({','.join('?' * len(rows))})",
+                [r[0] for r in rows],
+            ).fetchone()[0] if rows else 0
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vec, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._disk_bytes += sum(len(r[2]) for r in rows) - old
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # trim to 90% so we don't evict on every single insert once full
+        target = int(self.max_disk_bytes * 0.9)
+        while self._disk_bytes > target:
+            rows = self._db.execute(
+                "SELECT key, LENGTH(vec) FROM embeddings ORDER BY last_used LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self._disk_bytes = 0
+                break
+            dropped = []
+            for k, size in rows:
+                if self._disk_bytes <= target:
+                    break
+                dropped.append((k,))
+                self._disk_bytes -= size
+                self._lru.pop(k, None)
+            self._db.executemany("DELETE FROM embeddings WHERE key = ?", dropped)
+            self.evictions += len(dropped)
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits":          self.hits,
+                "memory_hits":   self.memory_hits,
+                "misses":        self.misses,
+                "hit_rate":      (self.hits / lookups) if lookups else 0.0,
+                "evictions":     self.evictions,
+                "disk_entries":  entries,
+                "disk_bytes":    self._disk_bytes,
+                "memory_entries": len(self._lru),
+            }
+
+
+class QueryEmbedder:
+    """
+    Embeds search queries through an in-process LRU keyed on normalized text.
+    Concurrent identical queries that miss share one in-flight request
+    (single-flight) instead of each calling the embeddings API.
+    """
+
+    def __init__(self, embed_fn, max_items: int = 2048):
+        self.embed_fn   = embed_fn   # async (text) -> np.ndarray
+        self.max_items  = max_items
+        self._lru       = OrderedDict()
+        self._inflight  = {}
+        self.hits       = 0
+        self.coalesced  = 0
+        self.misses     = 0
+        self._miss_s    = 0.0
+
+    def _avg_miss_s(self) -> float:
+        return self._miss_s / self.misses if self.misses else 0.0
+
+    async def embed(self, text: str) -> np.ndarray:
+        key = normalize_text(text)
+        vec = self._lru.get(key)
+        if vec is not None:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return vec
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            # shielded so one impatient caller can't cancel it for the others
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        t0 = time.perf_counter()
+        try:
+            vec = await self.embed_fn(key)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # waiters re-raise it; don't warn if there are none
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        vec.setflags(write=False)  # shared by every caller that hits it
+        self.misses  += 1
+        self._miss_s += time.perf_counter() - t0
+        self._lru[key] = vec
+        while len(self._lru) > self.max_items:
+            self._lru.popitem(last=False)
+        fut.set_result(vec)
+        return vec
+
+    def stats(self):
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "hits":         self.hits,
+            "coalesced":    self.coalesced,
+            "misses":       self.misses,
+            "hit_rate":     ((self.hits + self.coalesced) / lookups) if lookups else 0.0,
+            "entries":      len(self._lru),
+            "avg_embed_ms": self._avg_miss_s() * 1000,
+            "saved_ms":     (self.hits + self.coalesced) * self._avg_miss_s() * 1000,
+        }
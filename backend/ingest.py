@@ -0,0 +1,248 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import random
+
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:  # fall back to a chars/4 estimate
+    tiktoken = None
+
+
+# limits of the embeddings endpoint for ada-002
+MAX_INPUT_TOKENS  = 8191
+MAX_BATCH_INPUTS  = 2048
+MAX_BATCH_TOKENS  = 250_000
+
+
+@functools.lru_cache(maxsize=None)
+def retryable() -> tuple:
+    # imported on first use: openai is most of the API's import time
+    import openai
+    return (openai.RateLimitError, openai.APIConnectionError,
+            openai.APITimeoutError, openai.InternalServerError)
+
+
+class LazyOpenAI:
+    """An AsyncOpenAI client that's created (and openai imported) on first use."""
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._client = None
+
+    def get(self):
+        if self._client is None:
+            import openai
+            self._client = openai.AsyncOpenAI(**self._kwargs)
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+@contextlib.asynccontextmanager
+async def _unlimited(tokens: int):
+    yield
+
+
+class Tokenizer:
+    def __init__(self, model: str):
+        self.model   = model
+        self._enc    = None
+        self._loaded = False
+
+    def encoding(self):
+        # loaded on first use: the BPE file is fetched over the network, and
+        # offline we just estimate
+        if not self._loaded:
+            self._loaded = True
+            if tiktoken is not None:
+                try:
+                    self._enc = tiktoken.encoding_for_model(self.model)
+                except Exception as e:
+                    logging.warning(f"tiktoken unavailable for {self.model} ({e}); estimating tokens")
+        return self._enc
+
+    def count(self, text: str) -> int:
+        enc = self.encoding()
+        if enc is None:
+            return max(1, len(text) // 4)
+        return len(enc.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        enc = self.encoding()
+        if enc is None:
+            return text[: max_tokens * 4]
+        toks = enc.encode(text, disallowed_special=())
+        if len(toks) <= max_tokens:
+            return text
+        return enc.decode(toks[:max_tokens])
+
+
+class EmbeddingPipeline:
+    """
+    Turns a list of texts into vectors with as few round-trips as possible:
+    cached texts are served from the EmbeddingCache, the rest are grouped into
+    token-bounded batches and sent `concurrency` batches at a time, retrying
+    with exponential backoff on rate limits and transient errors. Every
+    attempt first passes `admit` (the shared OpenAI admission control).
+    """
+
+    def __init__(self, client, model: str, dim: int, cache=None,
+                 concurrency: int = 4,
+                 max_batch_inputs: int = MAX_BATCH_INPUTS,
+                 max_batch_tokens: int = MAX_BATCH_TOKENS,
+                 max_retries: int = 6,
+                 executor=None,
+                 admit=None):
+        self.client           = client
+        self.model            = model
+        self.dim              = dim
+        self.cache            = cache
+        self.concurrency      = concurrency
+        self.max_batch_inputs = max_batch_inputs
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries      = max_retries
+        self.executor         = executor
+        # admit(tokens) -> async context manager held around each request
+        self.admit            = admit or _unlimited
+        self.tokenizer        = Tokenizer(model)
+        self.requests         = 0
+        self.retries          = 0
+
+    async def _blocking(self, fn, *args):
+        # cache lookups and FAISS adds go to the executor when we have one
+        if self.executor is None:
+            return fn(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args))
+
+    def make_batches(self, texts):
+        """Yields lists of (position, text) that fit in one embeddings request."""
+        batch, tokens = [], 0
+        for pos, text in texts:
+            n = self.tokenizer.count(text)
+            if n > MAX_INPUT_TOKENS:
+                text = self.tokenizer.truncate(text, MAX_INPUT_TOKENS)
+                n    = MAX_INPUT_TOKENS
+            if batch and (len(batch) >= self.max_batch_inputs or tokens + n > self.max_batch_tokens):
+                yield batch
+                batch, tokens = [], 0
+            batch.append((pos, text))
+            tokens += n
+        if batch:
+            yield batch
+
+    async def _request(self, inputs):
+        delay  = 1.0
+        tokens = sum(len(t) for t in inputs) // 4 + 1
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.admit(tokens):
+                    self.requests += 1
+                    resp = await self.client.embeddings.create(input=inputs, model=self.model)
+                data = sorted(resp.data, key=lambda d: d.index)
+                return np.array([d.embedding for d in data], dtype="float32")
+            except retryable() as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                wait = delay
+                headers = getattr(getattr(e, "response", None), "headers", None) or {}
+                if headers.get("retry-after"):
+                    try:
+                        wait = max(wait, float(headers["retry-after"]))
+                    except ValueError:
+                        pass
+                wait *= 1 + random.random() * 0.25
+                logging.warning(f"Embedding batch of {len(inputs)} failed ({type(e).__name__}), retrying in {wait:.1f}s")
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, 30.0)
+
+    async def embed_batches(self, texts):
+        """
+        Async generator over (positions, vectors) for `texts`, one item per
+        completed batch, in completion order. Cache hits come first as one batch.
+        """
+        if not texts:
+            return
+        if self.cache:
+            cached = await self._blocking(self.cache.get_many, self.model, texts)
+        else:
+            cached = [None] * len(texts)
+        hits   = [i for i, v in enumerate(cached) if v is not None]
+        if hits:
+            yield hits, np.vstack([cached[i] for i in hits]).astype("float32")
+
+        # identical texts in one call only need to be embedded once
+        todo = {}
+        for i, v in enumerate(cached):
+            if v is None:
+                todo.setdefault(texts[i], []).append(i)
+        if not todo:
+            return
+
+        unique  = list(todo)
+        sem     = asyncio.Semaphore(self.concurrency)
+        results = asyncio.Queue()
+
+        async def run(batch):
+            async with sem:
+                try:
+                    vecs = await self._request([t for _, t in batch])
+                    await results.put((batch, vecs, None))
+                except Exception as e:
+                    await results.put((batch, None, e))
+
+        batches = list(self.make_batches(enumerate(unique)))
+        tasks   = [asyncio.create_task(run(b)) for b in batches]
+        try:
+            for _ in batches:
+                batch, vecs, err = await results.get()
+                if err is not None:
+                    raise err
+                keys = [unique[p] for p, _ in batch]
+                if self.cache:
+                    await self._blocking(self.cache.put_many, self.model, keys, vecs)
+                positions, rows = [], []
+                for k, vec in zip(keys, vecs):
+                    for i in todo[k]:
+                        positions.append(i)
+                        rows.append(vec)
+                yield positions, np.vstack(rows)
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    async def embed(self, texts) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        async for positions, vecs in self.embed_batches(texts):
+            out[positions] = vecs
+        return out
+
+    async def add_documents(self, index, doc_ids, texts, lock=None) -> int:
+        """
+        Embeds `texts` and adds them to `index` with one add_with_ids per batch,
+        holding `lock` (if given) around each add. `index` may be a callable
+        returning the index, resolved under the lock, for callers that can
+        swap their index out while the batches are in flight.
+        """
+        ids  = np.asarray(doc_ids, dtype="int64")
+        lock = lock or contextlib.nullcontext()
+        n    = 0
+
+        def add(vecs, batch_ids):
+            with lock:
+                target = index() if callable(index) else index
+                target.add_with_ids(vecs, batch_ids)
+
+        async for positions, vecs in self.embed_batches(texts):
+            await self._blocking(add, vecs, ids[positions])
+            n += len(positions)
+        return n
+
+    def stats(self):
+        return {"requests": self.requests, "retries": self.retries}
@@ -0,0 +1,307 @@
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Optional
+
+# queued -> running -> done | failed | cancelled
+FINISHED = ("done", "failed", "cancelled")
+
+_JSON_FIELDS = ("progress", "result")
+
+
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _alive(owner: str) -> bool:
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname():
+        return True  # can't tell; leave it to its own host
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    return True
+
+
+class JobStore:
+    """
+    The job table: one row per submitted job with its state, last progress
+    report, result or error, and the process running it. Shared by every
+    worker process, so a job can be polled (and coalesced with) from any.
+    """
+
+    def __init__(self, path: str, ttl_s: float = 7 * 86400):
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, user TEXT, kind TEXT, key TEXT, status TEXT,"
+            " progress TEXT, result TEXT, error TEXT, error_status INTEGER,"
+            " owner TEXT, cancel INTEGER DEFAULT 0, created REAL, started REAL, finished REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_user_key ON jobs (user, key, status)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)")
+
+    @staticmethod
+    def _row(cur, row) -> dict:
+        job = {col[0]: value for col, value in zip(cur.description, row)}
+        for field in _JSON_FIELDS:
+            if job[field] is not None:
+                job[field] = json.loads(job[field])
+        job["cancel"] = bool(job["cancel"])
+        return job
+
+    def _active(self, user: str, key: str) -> Optional[dict]:
+        cur = self._conn.execute(
+            "SELECT * FROM jobs WHERE user = ? AND key = ? AND status IN ('queued', 'running')"
+            " ORDER BY created LIMIT 1", (user, key))
+        row = cur.fetchone()
+        return self._row(cur, row) if row else None
+
+    def create(self, user: str, kind: str, key: str):
+        """-> (job, created): the queued or running job with this key, else a new one."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                job = self._active(user, key)
+                if job is None:
+                    job = {"id": uuid.uuid4().hex, "user": user, "kind": kind, "key": key,
+                           "status": "queued", "progress": None, "result": None, "error": None,
+                           "error_status": None, "owner": _owner(), "cancel": False,
+                           "created": now, "started": None, "finished": None}
+                    self._conn.execute(
+                        "INSERT INTO jobs (id, user, kind, key, status, owner, created)"
+                        " VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                        (job["id"], user, kind, key, job["owner"], now))
+                    self._conn.execute("DELETE FROM jobs WHERE created < ? AND status IN (?, ?, ?)",
+                                       (now - self.ttl_s, *FINISHED))
+                    created = True
+                else:
+                    created = False
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job, created
+
+    def update(self, job_id: str, **fields):
+        for field in _JSON_FIELDS:
+            if field in fields:
+                fields[field] = json.dumps(fields[field])
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {cols} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            cur = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+            row = cur.fetchone()
+            return self._row(cur, row) if row else None
+
+    def list(self, user: str, limit: int = 50):
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT * FROM jobs WHERE user = ? ORDER BY created DESC LIMIT ?", (user, limit))
+            return [self._row(cur, row) for row in cur.fetchall()]
+
+    def request_cancel(self, job_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET cancel = 1 WHERE id = ?", (job_id,))
+
+    def cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def recover(self) -> int:
+        """Fails the unfinished jobs of processes that are gone; their work can't be resumed."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, owner FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+            lost = [job_id for job_id, owner in rows if not _alive(owner)]
+            self._conn.executemany(
+                "UPDATE jobs SET status = 'failed', error = 'interrupted by a restart',"
+                " error_status = 503, finished = ? WHERE id = ?",
+                [(time.time(), job_id) for job_id in lost])
+        return len(lost)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """What a job function gets: progress reporting, which is also where cancellation lands."""
+
+    def __init__(self, queue: "JobQueue", job_id: str):
+        self.queue = queue
+        self.id    = job_id
+
+    async def progress(self, **fields):
+        # a cancel sent to another worker process only reaches us through the table
+        if await self.queue.run_blocking(self.queue.store.cancel_requested, self.id):
+            raise JobCancelled()
+        await self.queue.run_blocking(self.queue.store.update, self.id, progress=fields)
+        self.queue._notify(self.id)
+
+
+class JobQueue:
+    """
+    Runs submitted jobs in the background on `workers` asyncio tasks.
+    Queued jobs are taken round-robin by user, with at most `per_user` of a
+    user's jobs running at once, so one user's sync can't starve the rest.
+    Submitting a job whose key matches a queued or running one of the same
+    user returns that job instead (coalescing).
+    """
+
+    def __init__(self, store: JobStore, run_blocking, workers: int = 2, per_user: int = 1):
+        self.store        = store
+        self.run_blocking = run_blocking
+        self.workers      = workers
+        self.per_user     = per_user
+        self._pending     = OrderedDict()  # user -> deque of (job id, fn, context)
+        self._user_active = {}
+        self._tasks       = {}             # job id -> task of a running job
+        self._watchers    = {}             # job id -> Event set on the next change
+        self._workers     = []
+        self._cond        = None
+        self._stopping    = False
+
+    async def start(self):
+        self._cond = asyncio.Condition()
+        lost = await self.run_blocking(self.store.recover)
+        if lost:
+            logging.warning(f"Marked {lost} jobs interrupted by a restart as failed")
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        self._stopping = True
+        for task in [*self._workers, *self._tasks.values()]:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        # whatever was still queued can't outlive the process
+        for queue in self._pending.values():
+            for job_id, *_ in queue:
+                await self.run_blocking(self.store.update, job_id, status="cancelled", finished=time.time())
+        self._pending.clear()
+
+    async def submit(self, user: str, kind: str, key: str, fn):
+        """-> (job, created). `fn(job)` is awaited on a worker; its return value is the result."""
+        job, created = await self.run_blocking(self.store.create, user, kind, f"{kind}:{key}")
+        if created:
+            # run in the submitter's context, so its request timings still see the stages
+            async with self._cond:
+                self._pending.setdefault(user, deque()).append((job["id"], fn, contextvars.copy_context()))
+                self._cond.notify()
+        return job, created
+
+    def _next(self):
+        for user in list(self._pending):
+            if self._user_active.get(user, 0) >= self.per_user:
+                continue
+            queue = self._pending.pop(user)
+            item  = queue.popleft()
+            if queue:
+                self._pending[user] = queue  # to the back of the line
+            self._user_active[user] = self._user_active.get(user, 0) + 1
+            return (user, *item)
+        return None
+
+    async def _work(self):
+        while True:
+            async with self._cond:
+                item = self._next()
+                while item is None:
+                    await self._cond.wait()
+                    item = self._next()
+            user, job_id, fn, context = item
+            try:
+                await self._run(job_id, fn, context)
+            finally:
+                async with self._cond:
+                    self._user_active[user] -= 1
+                    self._cond.notify_all()
+
+    async def _run(self, job_id: str, fn, context):
+        if await self.run_blocking(self.store.cancel_requested, job_id):
+            await self._finish(job_id, status="cancelled")
+            return
+        await self.run_blocking(self.store.update, job_id, status="running", started=time.time())
+        self._notify(job_id)
+        task = asyncio.create_task(fn(Job(self, job_id)), context=context)
+        self._tasks[job_id] = task
+        try:
+            result = await asyncio.shield(task)
+        except (asyncio.CancelledError, JobCancelled):
+            if self._stopping:
+                await self._finish(job_id, status="cancelled")
+                raise
+            task.cancel()
+            with contextlib.suppress(BaseException):
+                await task
+            await self._finish(job_id, status="cancelled")
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {e!r}")
+            await self._finish(job_id, status="failed", error=str(getattr(e, "detail", e)),
+                               error_status=getattr(e, "status_code", 500))
+        else:
+            await self._finish(job_id, status="done", result=result)
+        finally:
+            self._tasks.pop(job_id, None)
+
+    async def _finish(self, job_id: str, **fields):
+        await self.run_blocking(self.store.update, job_id, finished=time.time(), **fields)
+        self._notify(job_id)
+
+    async def cancel(self, job: dict):
+        """Cancels a queued or running job; jobs of other processes stop at their next progress report."""
+        await self.run_blocking(self.store.request_cancel, job["id"])
+        async with self._cond:
+            queue = self._pending.get(job["user"])
+            item  = next((item for item in queue or () if item[0] == job["id"]), None)
+            if item is not None:
+                queue.remove(item)
+                if not queue:
+                    del self._pending[job["user"]]
+                await self._finish(job["id"], status="cancelled")
+                return
+        task = self._tasks.get(job["id"])
+        if task is not None:
+            task.cancel()
+
+    def _notify(self, job_id: str):
+        event = self._watchers.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def wait(self, job_id: str, timeout: float = 1.0):
+        """Returns on the job's next change here, or after `timeout` (jobs run elsewhere are polled)."""
+        event = self._watchers.setdefault(job_id, asyncio.Event())
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(event.wait(), timeout)
+
+    async def wait_finished(self, job_id: str) -> dict:
+        while True:
+            job = await self.run_blocking(self.store.get, job_id)
+            if job is None or job["status"] in FINISHED:
+                return job
+            await self.wait(job_id)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "queued": sum(len(q) for q in self._pending.values()),
+                "running": len(self._tasks)}
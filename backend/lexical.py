@@ -0,0 +1,94 @@
+import math
+import re
+from collections import Counter
+
+# words plus joined codes like "comp_sci", "214-0", "2024-11-01", "ps3"
+_TOKEN = re.compile(r"[a-z0-9]+(?:[_\-./:][a-z0-9]+)*")
+_PART  = re.compile(r"[a-z0-9]+")
+
+BM25_K1 = 1.2
+BM25_B  = 0.75
+RRF_K   = 60
+
+
+def tokenize(text: str):
+    """
+    Lower-cased terms. Compound tokens are kept whole and also split into
+    their parts, so "COMP_SCI 214-0" matches both exactly and on "214".
+    """
+    out = []
+    for tok in _TOKEN.findall(text.lower()):
+        out.append(tok)
+        parts = _PART.findall(tok)
+        if len(parts) > 1:
+            out.extend(parts)
+    return out
+
+
+class BM25Index:
+    """In-memory inverted index over passages, scored with Okapi BM25."""
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1        = k1
+        self.b         = b
+        self.postings  = {}   # term -> {doc id: term frequency}
+        self.doc_len   = {}   # doc id -> number of terms
+        self.doc_terms = {}   # doc id -> distinct terms, for removal
+        self.total_len = 0
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def add(self, doc_id: int, text: str):
+        if doc_id in self.doc_len:
+            self.remove([doc_id])
+        terms = Counter(tokenize(text))
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        n = sum(terms.values())
+        self.doc_len[doc_id]   = n
+        self.doc_terms[doc_id] = tuple(terms)
+        self.total_len += n
+
+    def remove(self, doc_ids):
+        for did in doc_ids:
+            terms = self.doc_terms.pop(did, None)
+            if terms is None:
+                continue
+            self.total_len -= self.doc_len.pop(did)
+            for term in terms:
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(did, None)
+                    if not posting:
+                        del self.postings[term]
+
+    def search(self, query: str, top_k: int):
+        """Returns [(doc id, score)] best first."""
+        n = len(self.doc_len)
+        if not n:
+            return []
+        avg    = self.total_len / n or 1.0
+        scores = Counter()
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for did, tf in posting.items():
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[did] / avg)
+                scores[did] += idf * tf * (self.k1 + 1) / norm
+        return scores.most_common(top_k)
+
+    def memory_bytes(self) -> int:
+        # rough: a dict slot per posting plus the per-document bookkeeping
+        return 100 * sum(len(p) for p in self.postings.values()) + 200 * len(self.doc_len)
+
+
+def rrf(rankings, k: int = RRF_K):
+    """Reciprocal rank fusion of several best-first lists of keys -> [(key, score)]."""
+    scores = Counter()
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] += 1.0 / (k + rank + 1)
+    return scores.most_common()
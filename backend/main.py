@@ -3,58 +3,250 @@ import glob
 import logging
 import json
 import numpy as np
-import faiss
-import openai
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.requests import ClientDisconnect
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 import re
 import uuid
+import asyncio
+import contextlib
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional
-
-# Add LangChain imports
-from langchain.memory import ConversationBufferMemory, ChatMessageHistory
-from langchain.schema import messages_from_dict, messages_to_dict
-from langchain.schema import HumanMessage, AIMessage
-from langchain.chains import ConversationalRetrievalChain
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import FAISS
+import httpx
+from embedding_cache import EmbeddingCache, QueryEmbedder
+from manifest import fingerprint
+from ingest import EmbeddingPipeline, LazyOpenAI
+from chunking import chunk_text
+from docstore import DocStore
+import deadlines
+import conversations
+import answer_cache
+import lexical
+import dedup
+import metrics
+import uploads
+import jobs
+import admission
+import degree_audit
+from persistence import PersistentIndex, atomic_write
+from shards import Shard, ShardStore, user_key
+import vector_index
 
 load_dotenv()
 
 
 BASE_DIR           = os.path.dirname(__file__)
+# everything the server writes (indexes, uploaded texts, SQLite stores) goes
+# under STATE_DIR; it defaults to the source directory for existing deployments
+STATE_DIR          = os.getenv("STATE_DIR", BASE_DIR)
+os.makedirs(STATE_DIR, exist_ok=True)
 PLAN_SOURCE_DIR    = os.path.join(BASE_DIR, "plan_data")
-PLAN_INDEX_PATH    = os.path.join(BASE_DIR, "plan_faiss.index")
-PLAN_META_PATH     = os.path.join(BASE_DIR, "plan_meta.npy")
-plan_index         = None
-plan_id_to_meta    = {}
-plan_next_doc_id   = 0
+PLAN_INDEX_BASE    = os.path.join(STATE_DIR, "plan_index")
+PLAN_STUDENT_DIR   = os.path.join(STATE_DIR, "plan_students")
 
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise RuntimeError("Missing OPENAI_API_KEY environment variable")
-openai.api_key = OPENAI_API_KEY
 
-BASE_DIR    = os.path.dirname(__file__)
-SOURCE_DIR  = os.path.join(BASE_DIR, "data", "txts")  
+SOURCE_DIR  = os.path.join(STATE_DIR, "data", "txts")
 DIM         = 1536
-INDEX_PATH  = os.path.join(BASE_DIR, "canvas_faiss.index")
-META_PATH   = os.path.join(BASE_DIR, "canvas_meta.npy")
+# pre-sharding single index; no longer read
+INDEX_PATH  = os.path.join(STATE_DIR, "canvas_faiss.index")
+SHARD_DIR   = os.path.join(STATE_DIR, "shards")
+
+CHUNK_TOKENS         = int(os.getenv("CHUNK_TOKENS", "400"))
+CHUNK_OVERLAP        = int(os.getenv("CHUNK_OVERLAP", "64"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# byte-identical files are always collapsed; with a threshold (estimated
+# Jaccard, e.g. 0.9) near-identical ones are too, and near-identical
+# passages from different courses (cross-listings) are dropped from results
+NEAR_DUP_THRESHOLD   = float(os.getenv("NEAR_DUP_THRESHOLD", "0"))
+
+# "vector" (ada-002 + FAISS), "lexical" (BM25, no embedding call) or "hybrid"
+# (both, fused with reciprocal rank fusion over FUSION_DEPTH candidates each)
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+RETRIEVAL_MODE  = os.getenv("RETRIEVAL_MODE", "hybrid")
+FUSION_DEPTH    = int(os.getenv("FUSION_DEPTH", "20"))
+# most passages (or plan documents) one request may ask for
+MAX_TOP_K       = int(os.getenv("MAX_TOP_K", "50"))
+
+# upper bounds on the per-request search overrides; past these an ANN search
+# costs about as much as a full scan
+MAX_NPROBE      = int(os.getenv("MAX_NPROBE", "256"))
+MAX_EF_SEARCH   = int(os.getenv("MAX_EF_SEARCH", "1024"))
+
+# "flat", "hnsw", "ivfpq", or "auto": exact search until the index holds
+# ANN_THRESHOLD vectors, then ANN_INDEX_TYPE
+INDEX_TYPE     = os.getenv("INDEX_TYPE", "auto")
+ANN_INDEX_TYPE = os.getenv("ANN_INDEX_TYPE", "hnsw")
+ANN_THRESHOLD  = int(os.getenv("ANN_THRESHOLD", "50000"))
+# "fp32", or "fp16"/"sq8" to keep flat/HNSW vectors compressed in memory
+# (2x/4x smaller) with the float32 copies on disk for exact re-ranking
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "fp32")
+
+EMBED_MODEL      = "text-embedding-ada-002"
+EMBED_CACHE_PATH = os.path.join(STATE_DIR, "embedding_cache.sqlite")
+EMBED_CACHE_MAX_MB = int(os.getenv("EMBED_CACHE_MAX_MB", "512"))
+embedding_cache  = EmbeddingCache(
+    EMBED_CACHE_PATH,
+    max_memory_items=int(os.getenv("EMBED_CACHE_MEMORY_ITEMS", "4096")),
+    max_disk_bytes=EMBED_CACHE_MAX_MB * 1024 * 1024,
+)
+
+# one pooled HTTP connection set shared by every OpenAI call, and a bounded
+# pool for the blocking work (FAISS, disk, SQLite) so it stays off the event loop
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+BLOCKING_WORKERS       = int(os.getenv("BLOCKING_WORKERS", "8"))
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_CONNECTIONS // 2),
+    timeout=httpx.Timeout(60.0, connect=10.0),
+)
+aclient     = LazyOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+executor    = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+embedder         = EmbeddingPipeline(
+    aclient, EMBED_MODEL, DIM,
+    cache=embedding_cache,
+    concurrency=int(os.getenv("EMBED_CONCURRENCY", "4")),
+    executor=executor,
+)
+
+# MULTI_WORKER=1 for `uvicorn --workers N`: indexes are memory-mapped
+# read-only from the published snapshot generations (one copy in the page
+# cache for all workers), one worker at a time writes a given index under a
+# file lock, and readers pick up new generations within a second
+MULTI_WORKER     = os.getenv("MULTI_WORKER", "0") == "1"
+# how many such workers (uvicorn's --workers defaults to WEB_CONCURRENCY);
+# what's tracked in process memory (admission budgets, the query-embedding
+# LRU) is per worker and sized from this
+WORKERS          = int(os.getenv("WEB_CONCURRENCY", "1")) if MULTI_WORKER else 1
+WRITER_POLL_S    = 0.05
+
+def forget_sources(shard, files):
+    """Drops text another worker has since changed; it's read back from disk on demand."""
+    for fn in files:
+        docstore.remove(f"{shard.user}/{fn}")
+
+# one index per (user, course), loaded on demand and evicted LRU once the
+# resident shards exceed SHARD_CACHE_MB
+SHARD_CACHE_MB   = int(os.getenv("SHARD_CACHE_MB", "1024"))
+# indexes are persisted as a snapshot plus a write-ahead log of the changes
+# since; the log is folded into a new snapshot once it passes WAL_COMPACT_MB
+WAL_COMPACT_MB   = int(os.getenv("WAL_COMPACT_MB", "64"))
+shards           = ShardStore(SHARD_DIR, DIM, SHARD_CACHE_MB * 1024 * 1024,
+                              compact_bytes=WAL_COMPACT_MB * 1024 * 1024,
+                              shared=MULTI_WORKER, on_change=forget_sources,
+                              storage=VECTOR_STORAGE)
+plan_store       = PersistentIndex(PLAN_INDEX_BASE, DIM, WAL_COMPACT_MB * 1024 * 1024,
+                                   shared=MULTI_WORKER, storage=VECTOR_STORAGE)
+write_locks      = {}
+
+# extracted deadlines cached per course content, and the Calendar events
+# already created per user
+DEADLINE_MODEL       = "gpt-4o"
+DEADLINE_CONCURRENCY = int(os.getenv("DEADLINE_CONCURRENCY", "4"))
+deadline_store       = deadlines.DeadlineStore(os.path.join(STATE_DIR, "deadlines.sqlite"))
+
+# NDJSON uploads are indexed every STREAM_BATCH_RECORDS records (or
+# STREAM_BATCH_MB of text), so memory stays bounded whatever the dump size
+STREAM_BATCH_RECORDS = int(os.getenv("STREAM_BATCH_RECORDS", "64"))
+STREAM_BATCH_MB      = int(os.getenv("STREAM_BATCH_MB", "8"))
+upload_log           = uploads.UploadLog(os.path.join(STATE_DIR, "uploads.sqlite"))
+
+# first-turn answers replayed for near-identical questions over unchanged
+# documents; ANSWER_CACHE_THRESHOLD is the cosine similarity needed to reuse one
+answers = answer_cache.AnswerCache(
+    max_entries=int(os.getenv("ANSWER_CACHE_ENTRIES", "10000")),
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97")),
+    ttl_s=float(os.getenv("ANSWER_CACHE_TTL_H", "24")) * 3600,
+)
+
+# source texts kept in memory so retrieval never hits the filesystem; course
+# files live in SOURCE_DIR/<user>/ and are keyed "<user>/<file>"
+# (read-through: queries can be served before warm-up has loaded the texts)
+docstore         = DocStore(SOURCE_DIR, "*/*.txt", read_through=True)
+plan_docstore    = DocStore(PLAN_SOURCE_DIR, "*.*", read_through=MULTI_WORKER)
+
+# Chat history per (user, conversation): evicted after CONVERSATION_TTL_H idle
+# hours or once there are more than CONVERSATION_MAX, and windowed to
+# HISTORY_TOKEN_BUDGET tokens (older turns are folded into a summary)
+CONVERSATION_BACKEND = os.getenv("CONVERSATION_BACKEND", "sqlite")  # memory, sqlite or redis
+CONVERSATION_TTL_H   = float(os.getenv("CONVERSATION_TTL_H", "168"))
+CONVERSATION_MAX     = int(os.getenv("CONVERSATION_MAX", "10000"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+SUMMARY_MODEL        = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+
+def make_conversation_backend():
+    ttl_s = CONVERSATION_TTL_H * 3600
+    if CONVERSATION_BACKEND == "memory":
+        return conversations.MemoryBackend(CONVERSATION_MAX, ttl_s)
+    if CONVERSATION_BACKEND == "redis":
+        return conversations.RedisBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"), ttl_s)
+    return conversations.SQLiteBackend(os.path.join(STATE_DIR, "conversations.sqlite"),
+                                       CONVERSATION_MAX, ttl_s)
+
+conversation_store = conversations.ConversationStore(
+    make_conversation_backend(), embedder.tokenizer, HISTORY_TOKEN_BUDGET
+)
 
-index            = None
-id_to_meta       = {}
-next_doc_id      = 0
+# per-stage histograms on /metrics plus a Server-Timing header; with
+# METRICS_ENABLED=0 every timer is a no-op
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+registry        = metrics.Registry(METRICS_ENABLED)
+llm_tokens      = registry.counter("rag_llm_tokens_total", "Chat completion tokens (estimated)",
+                                   ("endpoint", "direction"))
+
+# every OpenAI call waits for admission: interactive ones (chat, search)
+# before bulk ones (ingest embeddings, deadline extraction, summaries), and
+# within token budgets per user and class and overall, in tokens per minute
+# (0 = unlimited). Requests that would wait past LLM_MAX_WAIT_S, or find
+# their class's queue full, get 429 with Retry-After. The buckets live in
+# each worker process, so the token budgets and LLM_MAX_ACTIVE are split
+# evenly across WORKERS; per-user concurrency and queue limits apply per worker
+LLM_GLOBAL_TPM        = int(os.getenv("LLM_GLOBAL_TPM", "1000000"))
+LLM_USER_TPM          = int(os.getenv("LLM_USER_TPM", "100000"))
+LLM_USER_BULK_TPM     = int(os.getenv("LLM_USER_BULK_TPM", "300000"))
+LLM_MAX_ACTIVE        = int(os.getenv("LLM_MAX_ACTIVE", str(OPENAI_MAX_CONNECTIONS)))
+LLM_USER_ACTIVE       = int(os.getenv("LLM_USER_ACTIVE", "8"))
+LLM_QUEUE_INTERACTIVE = int(os.getenv("LLM_QUEUE_INTERACTIVE", "256"))
+LLM_QUEUE_BULK        = int(os.getenv("LLM_QUEUE_BULK", "64"))
+LLM_USER_QUEUE        = int(os.getenv("LLM_USER_QUEUE", "16"))
+LLM_MAX_WAIT_S        = float(os.getenv("LLM_MAX_WAIT_S", "20"))
+# what a chat completion is charged for its answer, on top of the prompt
+LLM_COMPLETION_TOKENS = 500
+llm_scheduler = admission.Scheduler(
+    LLM_GLOBAL_TPM / WORKERS,
+    {admission.INTERACTIVE: LLM_USER_TPM / WORKERS, admission.BULK: LLM_USER_BULK_TPM / WORKERS},
+    max(1, LLM_MAX_ACTIVE // WORKERS), LLM_USER_ACTIVE,
+    {admission.INTERACTIVE: LLM_QUEUE_INTERACTIVE, admission.BULK: LLM_QUEUE_BULK},
+    LLM_USER_QUEUE, LLM_MAX_WAIT_S, registry,
+)
+embedder.admit = llm_scheduler.slot
+
+def admit(ukey: str, priority: str):
+    """Attributes this request's OpenAI calls to the user; 429 if they'd queue too long."""
+    admission.use(ukey, priority)
+    llm_scheduler.check(ukey, priority)
 
-# Memory storage - we'll use a dictionary to store conversation history
-# Keys will be user IDs, values will be the conversation memory
-conversation_memory: Dict[str, ChatMessageHistory] = {}
+def chat_tokens(messages: List[dict]) -> int:
+    return admission.estimate_tokens(*(m["content"] for m in messages)) + LLM_COMPLETION_TOKENS
 
 app = FastAPI()
+app.add_middleware(
+    metrics.MetricsMiddleware, registry=registry,
+    traced_paths=["/api/rag/chat", "/api/rag/query", "/api/rag/upload", "/api/rag/upload/stream",
+                  "/api/rag/build",
+                  "/api/rag/deadlines", "/api/plan/chat", "/api/plan/upload"],
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -64,6 +256,11 @@ app.add_middleware(
 )
 security = HTTPBearer()
 
+@app.exception_handler(admission.Overloaded)
+async def overloaded(request: Request, exc: admission.Overloaded):
+    return JSONResponse({"detail": str(exc)}, status_code=429,
+                        headers={"Retry-After": str(exc.retry_after)})
+
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ) -> str:
@@ -72,92 +269,418 @@ async def get_current_user(
         raise HTTPException(401, "Invalid or missing token")
     return token
 
-def build_plan_index():
-    global plan_index, plan_id_to_meta, plan_next_doc_id
+async def run_blocking(fn, *args, **kwargs):
+    """Runs disk/CPU-bound work (FAISS, file I/O, SQLite) on the bounded executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+# rebuilds, uploads and deadline scans run as background jobs: the endpoint
+# answers 202 with a job to poll (or stream) at /api/jobs/{id}, or the result
+# itself with ?wait=true. JOB_WORKERS jobs run at once, at most
+# JOB_USER_CONCURRENCY of them for any one user
+JOB_WORKERS          = int(os.getenv("JOB_WORKERS", "2"))
+JOB_USER_CONCURRENCY = int(os.getenv("JOB_USER_CONCURRENCY", "1"))
+job_store            = jobs.JobStore(os.path.join(STATE_DIR, "jobs.sqlite"))
+job_queue            = jobs.JobQueue(job_store, run_blocking, JOB_WORKERS, JOB_USER_CONCURRENCY)
+
+# newline="": passage offsets are byte offsets into the file as stored (which
+# is what DocStore and fingerprint read), so line endings must not be translated
+def read_text(path: str) -> str:
+    with open(path, encoding="utf-8", newline="") as f:
+        return f.read()
+
+def write_text(path: str, text: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+
+async def build_plan_index():
     os.makedirs(PLAN_SOURCE_DIR, exist_ok=True)
-    flat   = faiss.IndexFlatL2(DIM)
-    mapper = faiss.IndexIDMap2(flat)
-    meta   = {}
-    did    = 0
+    fresh = PersistentIndex(None, DIM, storage=VECTOR_STORAGE)
 
     # scan all .txt (or .json) in plan_data
-    for path in glob.glob(os.path.join(PLAN_SOURCE_DIR, "*.*")):
-        fn   = os.path.basename(path)
-        text = open(path, encoding="utf-8").read()
-        emb  = openai.embeddings.create(
-                  input=text,
-                  model="text-embedding-ada-002"
-              ).data[0].embedding
-        vec  = np.array(emb, dtype="float32").reshape(1, DIM)
-        mapper.add_with_ids(vec, np.array([did], dtype="int64"))
-        meta[did] = {"source_file": fn}
-        did += 1
-
-    faiss.write_index(mapper, PLAN_INDEX_PATH)
-    np.save(PLAN_META_PATH, meta)
-    plan_index       = mapper
-    plan_id_to_meta  = meta
-    plan_next_doc_id = did
-    return did
-
-def build_faiss_index():
-    global index, id_to_meta, next_doc_id
-    os.makedirs(SOURCE_DIR, exist_ok=True)
-    flat   = faiss.IndexFlatL2(DIM)
-    mapper = faiss.IndexIDMap2(flat)
-    meta   = {}
-    did    = 0
-
-    for path in glob.glob(os.path.join(SOURCE_DIR, "*.txt")):
-        fn   = os.path.basename(path)
-        text = open(path, encoding="utf-8").read()
-        emb  = openai.embeddings.create(input=text, model="text-embedding-ada-002").data[0].embedding
-        vec  = np.array(emb, dtype="float32").reshape(1, DIM)
-        mapper.add_with_ids(vec, np.array([did], dtype="int64"))
-        meta[did] = {"source_file": fn}
-        did += 1
-
-    faiss.write_index(mapper, INDEX_PATH)
-    np.save(META_PATH, meta)
-    index       = mapper
-    id_to_meta  = meta
-    next_doc_id = did
-    return did
-
-@app.on_event("startup")
-def startup():
-    global index, id_to_meta, next_doc_id
-    global plan_index, plan_id_to_meta, plan_next_doc_id
+    paths = await run_blocking(glob.glob, os.path.join(PLAN_SOURCE_DIR, "*.*"))
+    texts = await run_blocking(lambda: [read_text(path) for path in paths])
+    ids   = fresh.allocate(len(paths))
+    for did, path, text in zip(ids, paths, texts):
+        fn = os.path.basename(path)
+        plan_docstore.put(fn, text)
+        fresh.meta[did] = {"source_file": fn}
+    await embedder.add_documents(fresh, ids, texts)
+    fresh.set_files({os.path.basename(path): {"doc_ids": [did]} for did, path in zip(ids, paths)})
+
+    before = plan_store.content_hash()
+    plan_store.replace(fresh)
+    invalidate_answers(plan_store, before)
+    await run_blocking(plan_store.commit)
+    return len(ids)
+
+def chunk_file(fn: str, text: str):
+    """
+    Splits one source file into overlapping passages. Returns the passages and
+    their metadata, which records the byte range each covers in the file.
+    """
+    chunks = chunk_text(text, embedder.tokenizer, CHUNK_TOKENS, CHUNK_OVERLAP)
+    metas  = [{"source_file": fn, "start": start, "end": end} for start, end, _ in chunks]
+    return [passage for _, _, passage in chunks], metas
 
-    os.makedirs(SOURCE_DIR, exist_ok=True)
+def course_of(fn: str) -> Optional[str]:
+    m = re.match(r"(\d+)_", fn)
+    return m.group(1) if m else None
 
-    if os.path.exists(INDEX_PATH) and os.path.exists(META_PATH):
-        index       = faiss.read_index(INDEX_PATH)
-        id_to_meta  = np.load(META_PATH, allow_pickle=True).item()
-        next_doc_id = max(id_to_meta.keys(), default=-1) + 1
+def scan_sources(ukey: str, manifests: Dict[str, dict]):
+    """
+    Compares SOURCE_DIR/<ukey> with the manifest of each of the user's course
+    shards. Returns {course_id: (changed, unchanged, deleted)}: changed is
+    [(fn, fingerprint, passages, metas)] for new or modified files, unchanged
+    maps fn -> refreshed manifest entry.
+    """
+    user_dir = os.path.join(SOURCE_DIR, ukey)
+    os.makedirs(user_dir, exist_ok=True)
+    on_disk = {}
+    for path in glob.glob(os.path.join(user_dir, "*.txt")):
+        fn  = os.path.basename(path)
+        cid = course_of(fn)
+        if cid is not None:
+            on_disk.setdefault(cid, []).append((fn, path))
+
+    out = {}
+    for cid in set(on_disk) | set(manifests):
+        known = manifests.get(cid, {})
+        changed, unchanged, seen = [], {}, set()
+        for fn, path in on_disk.get(cid, []):
+            seen.add(fn)
+            prev = known.get(fn)
+            fp   = fingerprint(path, prev)
+            if prev and prev["sha256"] == fp["sha256"]:
+                unchanged[fn] = {**prev, **fp}
+                continue
+            text = read_text(path)
+            docstore.put(f"{ukey}/{fn}", text)
+            passages, metas = chunk_file(fn, text)
+            changed.append((fn, fp, passages, metas))
+        deleted = [fn for fn in known if fn not in seen]
+        for fn in deleted:
+            docstore.remove(f"{ukey}/{fn}")
+        out[cid] = (changed, unchanged, deleted)
+    return out
+
+async def apply_changes(shard, changed, unchanged=None, deleted=()):
+    """
+    Upserts `changed` files into `shard` and drops `deleted` ones. Every step
+    goes to the shard's write-ahead log; the caller commits. Returns
+    added/updated/removed counts.
+    """
+    counts  = {"added": 0, "updated": 0, "removed": len(deleted), "collapsed": 0}
+    before  = shard.content_hash()
+    entries = {fn: e for fn, e in (unchanged or {}).items() if shard.manifest.get(fn) != e}
+    stale   = []
+    ids, texts = [], []
+
+    # files collapsed into one that is now changing or going away get
+    # their own vectors (or a new original) again
+    touched = {fn for fn, *_ in changed} | set(deleted)
+    changed = list(changed)
+    for fn, e in list(shard.manifest.items()):
+        if e.get("duplicate_of") in touched and fn not in touched:
+            text = docstore.get(f"{shard.user}/{fn}")
+            if text is not None:
+                fp = {k: v for k, v in e.items() if k in ("mtime", "size", "sha256")}
+                changed.append((fn, fp, *chunk_file(fn, text)))
+                touched.add(fn)
+
+    dups = dedup.DuplicateFinder(NEAR_DUP_THRESHOLD)
+    for fn, e in shard.manifest.items():
+        if fn not in touched and not e.get("duplicate_of"):
+            dups.add(fn, e)
+
+    for fn, fp, passages, metas in changed:
+        prev = shard.manifest.get(fn)
+        if prev:
+            stale += prev["doc_ids"]
+        extra = {"minhash": dedup.minhash("\n".join(passages))} if NEAR_DUP_THRESHOLD else {}
+        orig  = dups.find(fp["sha256"], extra.get("minhash"))
+        if orig is not None:
+            # same (or nearly the same) page under another slug: keep the
+            # file, but not a second set of vectors
+            entries[fn] = {**fp, "doc_ids": [], "duplicate_of": orig, **extra}
+            counts["collapsed"] += 1
+            continue
+        chunk_ids = shard.allocate(len(passages))
+        ids   += chunk_ids
+        texts += passages
+        shard.meta.update(zip(chunk_ids, metas))
+        entries[fn] = {**fp, "doc_ids": chunk_ids, **extra}
+        dups.add(fn, entries[fn])
+        counts["updated" if prev else "added"] += 1
+    if counts["collapsed"]:
+        logging.info(f"Course {shard.course_id}: {counts['collapsed']} duplicate files collapsed")
+
+    # add the new passages before dropping the old ones so concurrent
+    # searches never see a file disappear
+    await embedder.add_documents(shard, ids, texts, lock=shard.lock)
+    for fn in deleted:
+        stale += shard.manifest[fn]["doc_ids"]
+    await run_blocking(shard.set_files, entries, deleted)
+    invalidate_answers(shard, before)
+    await run_blocking(shard.remove, stale)
+    await run_blocking(update_lexical, shard, ids, texts, stale)
+    await run_blocking(convert_shard_if_needed, shard)
+    return counts
+
+def lexical_index(shard) -> lexical.BM25Index:
+    """The shard's BM25 index, built from its passages' source text on first use."""
+    with shard.lock:
+        if shard.lexical is None:
+            bm25 = lexical.BM25Index()
+            for did, meta in shard.meta.items():
+                text = docstore.passage(f"{shard.user}/{meta['source_file']}", meta["start"], meta["end"])
+                if text is not None:
+                    bm25.add(did, text)
+            shard.lexical = bm25
+        return shard.lexical
+
+def update_lexical(shard, ids, texts, stale):
+    with shard.lock:
+        if shard.lexical is None:
+            # meta already reflects this change, so a fresh build covers it
+            lexical_index(shard)
+            return
+        shard.lexical.remove(stale)
+        for did, text in zip(ids, texts):
+            shard.lexical.add(did, text)
+
+def invalidate_answers(index, before: str):
+    """Forgets cached answers built on `index` if its documents changed since `before`."""
+    if index.content_hash() != before:
+        answers.invalidate(before)
+
+@contextlib.asynccontextmanager
+async def writing(index):
+    """
+    Exclusive write access to a shard or the plan index. With MULTI_WORKER
+    this also holds the index's lock across processes, so the caller works
+    on a private copy of the newest generation and its commits are
+    published to the other workers.
+    """
+    async with write_locks.setdefault(index.base, asyncio.Lock()):
+        if MULTI_WORKER:
+            while not await run_blocking(index.lock_writer):
+                await asyncio.sleep(WRITER_POLL_S)
+        try:
+            yield index
+        finally:
+            if MULTI_WORKER:
+                await run_blocking(index.unlock_writer)
+
+@contextlib.asynccontextmanager
+async def writable_shard(ukey: str, cid: str):
+    """Pins a course shard (creating it if needed) and takes its write lock."""
+    shard = await run_blocking(shards.pin, ukey, cid)
+    try:
+        async with writing(shard):
+            yield shard
+    finally:
+        shards.unpin(shard)
+
+async def persist_shard(shard):
+    """Commits a shard, or deletes it once its course has no files left."""
+    if shard.manifest:
+        await run_blocking(shards.save, shard)
     else:
-        index       = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
-        id_to_meta  = {}
-        next_doc_id = 0
+        await run_blocking(shards.drop, shard)
+
+async def report(progress, **fields):
+    """Passes a progress report to a job (see jobs.Job.progress), if there is one."""
+    if progress is not None:
+        await progress(**fields)
+
+async def build_faiss_index(ukey: str, progress=None):
+    """Re-embeds all of a user's files, one fresh shard per course."""
+    by_course = await run_blocking(scan_sources, ukey, {})
+    files = passages = 0
+    for cid in set(shards.courses(ukey)) - set(by_course):
+        old = await run_blocking(shards.get, ukey, cid)
+        if old is not None:
+            async with writing(old):
+                answers.invalidate(old.content_hash())
+                await run_blocking(shards.drop, old)
+
+    for n, (cid, (changed, _, _)) in enumerate(by_course.items(), 1):
+        # built off to the side so searches keep using the old vectors meanwhile
+        fresh = Shard(ukey, cid, None, DIM, storage=VECTOR_STORAGE)
+        await apply_changes(fresh, changed)
+        async with writable_shard(ukey, cid) as shard:
+            before = shard.content_hash()
+            shard.replace(fresh)
+            invalidate_answers(shard, before)
+            await persist_shard(shard)
+        files    += len(fresh.manifest)
+        passages += fresh.index.ntotal
+        await report(progress, courses_done=n, courses=len(by_course), passages=passages)
+
+    indexed = {f"{ukey}/{fn}" for changed, _, _ in by_course.values() for fn, *_ in changed}
+    for name in docstore.names():
+        if name.startswith(f"{ukey}/") and name not in indexed:
+            docstore.remove(name)
+    return files, passages
+
+async def update_faiss_index(ukey: str, progress=None):
+    """
+    Incremental rebuild: re-embeds only the user's files whose content
+    changed since the last build/upload and drops vectors for files that
+    disappeared, course shard by course shard.
+    """
+    manifests = {s.course_id: s.manifest
+                 for s in await run_blocking(shards.user_shards, ukey)}
+    by_course = await run_blocking(scan_sources, ukey, manifests)
+    totals    = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "collapsed": 0}
+
+    for n, (cid, (changed, unchanged, deleted)) in enumerate(by_course.items(), 1):
+        totals["unchanged"] += len(unchanged)
+        if changed or deleted:
+            async with writable_shard(ukey, cid) as shard:
+                counts = await apply_changes(shard, changed, unchanged, deleted)
+                await persist_shard(shard)
+            for k, v in counts.items():
+                totals[k] += v
+        await report(progress, courses_done=n, courses=len(by_course), **totals)
+    return totals
+
+def convert_shard_if_needed(shard):
+    """
+    Switches a course shard between flat and ANN as it crosses ANN_THRESHOLD,
+    and to VECTOR_STORAGE if it was written under another setting.
+    """
+    with shard.lock:
+        converted = vector_index.maybe_convert(shard.index, INDEX_TYPE, ANN_THRESHOLD, ANN_INDEX_TYPE,
+                                               VECTOR_STORAGE, shard.rows)
+        if converted is not None:
+            shard.index = converted
+            shard.needs_snapshot = True
+
+def load_indexes():
+    os.makedirs(SOURCE_DIR, exist_ok=True)
+    docstore.load()
+    if os.path.exists(INDEX_PATH) or glob.glob(os.path.join(SOURCE_DIR, "*.txt")):
+        logging.warning(f"Ignoring pre-sharding index/sources ({INDEX_PATH}, {SOURCE_DIR}/*.txt); "
+                        "users need to re-upload their courses")
 
+def load_plan_index():
     os.makedirs(PLAN_SOURCE_DIR, exist_ok=True)
-    if os.path.exists(PLAN_INDEX_PATH) and os.path.exists(PLAN_META_PATH):
-        plan_index       = faiss.read_index(PLAN_INDEX_PATH)
-        plan_id_to_meta  = np.load(PLAN_META_PATH, allow_pickle=True).item()
-        plan_next_doc_id = max(plan_id_to_meta.keys(), default=-1) + 1
-    else:
-        plan_index       = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
-        plan_id_to_meta  = {}
-        plan_next_doc_id = 0
+    plan_docstore.load()
+    if MULTI_WORKER:
+        plan_store.load_shared()
+    elif plan_store.exists():
+        plan_store.load()
 
-    if plan_next_doc_id == 0:
-        # only build if there was no saved index
-        cnt = build_plan_index()
-        logging.info(f"Plan index built with {cnt} docs from {PLAN_SOURCE_DIR}")
+async def drop_scraped_plan_docs():
+    """
+    Plan uploads used to be appended to the plan index as scraped_<n>.json,
+    one more per sync and tied to no user. Drops them from the index and the
+    disk; course lists now live in PLAN_STUDENT_DIR, one per user.
+    """
+    def stale():
+        return [fn for fn in plan_store.manifest if fn.startswith("scraped_")]
+
+    if stale():
+        async with writing(plan_store):
+            files = stale()
+            if files:
+                before = plan_store.content_hash()
+                ids    = [i for fn in files for i in plan_store.manifest[fn]["doc_ids"]]
+                await run_blocking(plan_store.remove, ids)
+                await run_blocking(plan_store.set_files, {}, files)
+                invalidate_answers(plan_store, before)
+                await run_blocking(plan_store.commit)
+                logging.info(f"Dropped {len(files)} scraped plan uploads from the plan index")
+    paths = await run_blocking(glob.glob, os.path.join(PLAN_SOURCE_DIR, "scraped_*.json"))
+    for path in paths:
+        plan_docstore.remove(os.path.basename(path))
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+async def build_missing_plan_index():
+    if plan_store.next_id == 0:
+        # only build if there was no saved index (or, with several workers,
+        # if no other worker built it while we waited for the lock)
+        async with writing(plan_store):
+            if plan_store.next_id == 0:
+                cnt = await build_plan_index()
+                logging.info(f"Plan index built with {cnt} docs from {PLAN_SOURCE_DIR}")
+
+# startup only opens the stores; the source texts and the plan index (built
+# on a fresh deploy) are loaded in the background, so a restarted pod answers
+# health checks and course queries (shards load on demand, missing texts are
+# read from disk) straight away. /readyz turns 200 once the course side is
+# warm; the plan index warms up alongside and only the plan endpoints wait
+# for it. A failing step is retried with backoff (up to WARM_UP_RETRY_MAX_S
+# apart) and its last error shows in /readyz.
+WARM_UP_RETRY_MAX_S = float(os.getenv("WARM_UP_RETRY_MAX_S", "60"))
+warm_up_state       = {"status": "warming", "plan_index": "warming", "stages": {}, "errors": {}}
+warm_up_task        = None
+
+async def warm_up_step(name: str, step):
+    delay = 1.0
+    while True:
+        t = time.perf_counter()
+        try:
+            await step()
+        except Exception as e:
+            warm_up_state["errors"][name] = str(e)
+            logging.warning(f"Warm-up step {name} failed ({e!r}); retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARM_UP_RETRY_MAX_S)
+            continue
+        warm_up_state["errors"].pop(name, None)
+        warm_up_state["stages"][name] = round(time.perf_counter() - t, 3)
+        return
+
+async def warm_up_courses():
+    await warm_up_step("load_indexes", lambda: run_blocking(load_indexes))
+    # openai is imported on first use; get that out of the way too
+    await warm_up_step("openai_client", lambda: run_blocking(aclient.get))
+    warm_up_state["status"] = "ready"
+
+async def warm_up_plan():
+    await warm_up_step("load_plan_index", lambda: run_blocking(load_plan_index))
+    await warm_up_step("drop_scraped", drop_scraped_plan_docs)
+    await warm_up_step("plan_index", build_missing_plan_index)
+    warm_up_state["plan_index"] = "ready"
+
+async def warm_up():
+    t0 = time.perf_counter()
+    await asyncio.gather(warm_up_courses(), warm_up_plan())
+    logging.info(f"Warm-up done in {time.perf_counter() - t0:.2f}s: {warm_up_state['stages']}")
+
+def require_plan_index():
+    """For the plan endpoints: 503 until warm-up has loaded (or built) the plan index."""
+    if warm_up_state["plan_index"] != "ready":
+        raise HTTPException(503, "The plan index is still loading; try again shortly.",
+                            headers={"Retry-After": "5"})
+
+@app.on_event("startup")
+async def startup():
+    global warm_up_task
+    await job_queue.start()
+    warm_up_task = asyncio.create_task(warm_up())
+
+@app.on_event("shutdown")
+async def shutdown():
+    if warm_up_task is not None and not warm_up_task.done():
+        warm_up_task.cancel()
+        with contextlib.suppress(BaseException):
+            await warm_up_task
+    await job_queue.stop()
+    await http_client.aclose()
+    executor.shutdown(wait=True)
+    plan_store.close()
+    shards.close()
 
 
 class BuildRequest(BaseModel):
     overwrite: bool = False
+    full: bool = False  # re-embed everything instead of only changed files
 
 class UploadRequest(BaseModel):
     docs: dict
@@ -168,22 +691,70 @@ class PlanUploadRequest(BaseModel):
 
 class QueryRequest(BaseModel):
     query: str
-    top_k: int = 5
+    top_k: int = Field(5, ge=1, le=MAX_TOP_K)
+    course_ids: Optional[List[str]] = None  # restrict to these courses
+    mode: Optional[str] = None       # vector, lexical or hybrid; default RETRIEVAL_MODE
+    nprobe: Optional[int] = Field(None, ge=1, le=MAX_NPROBE)        # IVF lists to visit (ivfpq indexes)
+    ef_search: Optional[int] = Field(None, ge=1, le=MAX_EF_SEARCH)  # candidate list size (hnsw indexes)
 
 class ChatRequest(BaseModel):
     query: str
-    top_k: int = 5
+    top_k: int = Field(5, ge=1, le=MAX_TOP_K)
     conversation_id: Optional[str] = None  # Add conversation ID for memory tracking
+    course_ids: Optional[List[str]] = None
+    mode: Optional[str] = None
+    nprobe: Optional[int] = Field(None, ge=1, le=MAX_NPROBE)
+    ef_search: Optional[int] = Field(None, ge=1, le=MAX_EF_SEARCH)
+
+def job_view(job: dict, coalesced: bool = False) -> dict:
+    view = {k: job[k] for k in ("id", "kind", "status", "progress", "result", "error",
+                                "created", "started", "finished")}
+    view["status_url"] = f"/api/jobs/{job['id']}"
+    if coalesced:
+        view["coalesced"] = True
+    return view
+
+async def submit_job(ukey: str, kind: str, key: str, fn, wait: bool):
+    """
+    Queues `fn(job)` (or joins the same user's identical job already queued
+    or running). Answers 202 with the job, or with wait=True its result,
+    failing the way the job did.
+    """
+    job, created = await job_queue.submit(ukey, kind, key, fn)
+    if not wait:
+        return JSONResponse(job_view(job, coalesced=not created), status_code=202)
+    job = await job_queue.wait_finished(job["id"])
+    if job is None:
+        # the row went away under us (deleted by hand, or the table was reset)
+        raise HTTPException(500, "Job record disappeared.")
+    if job["status"] == "cancelled":
+        raise HTTPException(409, "Job was cancelled.")
+    if job["status"] == "failed":
+        raise HTTPException(job["error_status"] or 500, job["error"])
+    return job["result"]
+
+def content_key(payload) -> str:
+    return dedup.text_hash(json.dumps(payload, sort_keys=True))
 
 @app.post("/api/rag/build")
-async def rebuild(req: BuildRequest, user: str = Depends(get_current_user)):
-    if req.overwrite or not os.path.exists(INDEX_PATH):
-        cnt = build_faiss_index()
-        return {"status": "rebuilt", "documents_indexed": cnt}
-    return {"status": "skipped", "reason": "index exists"}
+async def rebuild(req: BuildRequest, wait: bool = False, user: str = Depends(get_current_user)):
+    ukey = user_key(user)
+    if not (req.full or req.overwrite or not shards.courses(ukey)):
+        return {"status": "skipped", "reason": "index exists"}
+    admit(ukey, admission.BULK)
+
+    async def run(job):
+        if req.full:
+            files, passages = await build_faiss_index(ukey, job.progress)
+            return {"status": "rebuilt", "mode": "full", "documents_indexed": files,
+                    "passages_indexed": passages}
+        counts = await update_faiss_index(ukey, job.progress)
+        return {"status": "updated", "mode": "incremental", **counts}
+
+    return await submit_job(ukey, "build", "full" if req.full else "incremental", run, wait)
 
 @app.post("/api/rag/upload")
-async def upload_docs(req: UploadRequest, user: str = Depends(get_current_user)):
+async def upload_docs(req: UploadRequest, wait: bool = False, user: str = Depends(get_current_user)):
     """
     Accepts:
       {
@@ -197,11 +768,15 @@ async def upload_docs(req: UploadRequest, user: str = Depends(get_current_user))
       }
     Handles both nested ({pages, syllabus}) and flat ({slug: text, syllabus: text}) shapes.
     """
-    global index, id_to_meta, next_doc_id
-    os.makedirs(SOURCE_DIR, exist_ok=True)
-    count = 0
+    ukey  = user_key(user)
+    admit(ukey, admission.BULK)
+    files = {}
 
     for course_id, obj in req.docs.items():
+        try:
+            uploads.check_course_id(course_id)
+        except uploads.RecordError as e:
+            raise HTTPException(400, f"docs[{course_id!r}]: {e}")
         pages       = {}
         syllabus_txt = None
 
@@ -216,92 +791,499 @@ async def upload_docs(req: UploadRequest, user: str = Depends(get_current_user))
                 pages = obj["pages"]
             else:
                 pages = {k: v for k, v in obj.items() if k != "syllabus"}
+        if syllabus_txt:
+            pages = {**(pages or {}), "syllabus": syllabus_txt}
         for slug, text in (pages or {}).items():
-            fn   = f"{course_id}_{slug}.txt"
-            path = os.path.join(SOURCE_DIR, fn)
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(text)
-
-            emb  = openai.embeddings.create(input=text, model="text-embedding-ada-002").data[0].embedding
-            vec  = np.array(emb, dtype="float32").reshape(1, DIM)
-            index.add_with_ids(vec, np.array([next_doc_id], dtype="int64"))
-            id_to_meta[next_doc_id] = {"source_file": fn}
-            next_doc_id += 1
-            count += 1
+            # same rules as the NDJSON stream: the slug ends up in a file name
+            try:
+                files[f"{course_id}_{slug}.txt"] = uploads.check_page(slug, text)
+            except uploads.RecordError as e:
+                raise HTTPException(400, f"docs[{course_id!r}][{slug!r}]: {e}")
 
-        if syllabus_txt:
-            fn   = f"{course_id}_syllabus.txt"
-            path = os.path.join(SOURCE_DIR, fn)
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(syllabus_txt)
-
-            emb  = openai.embeddings.create(input=syllabus_txt, model="text-embedding-ada-002").data[0].embedding
-            vec  = np.array(emb, dtype="float32").reshape(1, DIM)
-            index.add_with_ids(vec, np.array([next_doc_id], dtype="int64"))
-            id_to_meta[next_doc_id] = {"source_file": fn}
-            next_doc_id += 1
-            count += 1
-
-    faiss.write_index(index, INDEX_PATH)
-    np.save(META_PATH, id_to_meta)
-    return {"indexed": count}
+    async def run(job):
+        counts = await ingest_files(ukey, files, job.progress)
+        # only what was actually embedded; unchanged and collapsed pages weren't
+        return {"indexed": counts["added"] + counts["updated"], "unchanged": counts["unchanged"],
+                "collapsed": counts["collapsed"]}
+
+    # re-sending the same pages while they're being indexed joins that job
+    return await submit_job(ukey, "upload", content_key(files), run, wait)
+
+async def ingest_files(ukey: str, files: dict, progress=None) -> dict:
+    """
+    Writes, chunks, embeds and persists {file name: text}, shard by shard.
+    Files whose content is already indexed under the same name are skipped
+    without touching the disk. Returns added/updated/unchanged/collapsed counts.
+    """
+    by_course = {}
+    for fn, text in files.items():
+        by_course.setdefault(course_of(fn), {})[fn] = text
+
+    totals = {"added": 0, "updated": 0, "unchanged": 0, "collapsed": 0}
+    # one embeddings request (and one add_with_ids) per batch instead of per page
+    for n, (cid, texts) in enumerate(by_course.items(), 1):
+        async with writable_shard(ukey, cid) as shard:
+            fresh = {fn: text for fn, text in texts.items()
+                     if shard.manifest.get(fn, {}).get("sha256") != dedup.text_hash(text)}
+            totals["unchanged"] += len(texts) - len(fresh)
+            counts = {}
+            if fresh:
+                with metrics.stage("write_chunk"):
+                    changed = await run_blocking(write_sources, ukey, fresh)
+                with metrics.stage("embed_index"):
+                    counts = await apply_changes(shard, changed)
+                with metrics.stage("persist"):
+                    await persist_shard(shard)
+        for k in ("added", "updated", "collapsed"):
+            totals[k] += counts.get(k, 0)
+        await report(progress, courses_done=n, courses=len(by_course), **totals)
+    return totals
+
+class DuplexStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse without Starlette's disconnect listener, which would
+    otherwise consume the request body the response generator is reading.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+def upload_event(kind: str, **fields) -> str:
+    return json.dumps({"event": kind, **fields}) + "\n"
+
+@app.post("/api/rag/upload/stream")
+async def upload_stream(request: Request, upload_id: Optional[str] = None,
+                        user: str = Depends(get_current_user)):
+    """
+    Bulk upload as NDJSON, one {"course_id", "slug", "text"} record per line.
+    Records are indexed in batches while the body is still arriving and the
+    response streams NDJSON progress events (start, progress, error, done).
+    Sending the same upload_id again skips the records already indexed.
+    """
+    ukey      = user_key(user)
+    admit(ukey, admission.BULK)
+    upload_id = upload_id or uuid.uuid4().hex
+    done      = await run_blocking(upload_log.done, ukey, upload_id)
+
+    async def events():
+        counts = {"received": 0, "indexed": 0, "skipped": 0, "unchanged": 0, "collapsed": 0, "errors": 0}
+        batch, size = {}, 0
+        yield upload_event("start", upload_id=upload_id, already_indexed=len(done))
+
+        async def flush():
+            result = await ingest_files(ukey, {f"{key}.txt": text for key, text in batch.items()})
+            await run_blocking(upload_log.mark, ukey, upload_id, list(batch))
+            counts["indexed"]   += result["added"] + result["updated"]
+            counts["unchanged"] += result["unchanged"]
+            counts["collapsed"] += result["collapsed"]
+
+        try:
+            async for line in uploads.read_lines(request.stream()):
+                counts["received"] += 1
+                try:
+                    key, _, text = uploads.parse_record(line)
+                except uploads.RecordError as e:
+                    counts["errors"] += 1
+                    yield upload_event("error", record=counts["received"], error=str(e))
+                    continue
+                if key in done:
+                    counts["skipped"] += 1
+                    continue
+                batch[key] = text
+                size      += len(text)
+                if len(batch) >= STREAM_BATCH_RECORDS or size >= STREAM_BATCH_MB * 1024 * 1024:
+                    await flush()
+                    batch, size = {}, 0
+                    yield upload_event("progress", **counts)
+            if batch:
+                await flush()
+        except ClientDisconnect:
+            logging.info(f"Upload {upload_id} interrupted after {counts['indexed']} records")
+            return
+        except uploads.RecordError as e:
+            yield upload_event("error", record=counts["received"] + 1, error=str(e), fatal=True)
+            return
+        except Exception as e:
+            logging.error(f"Upload {upload_id} failed: {e}")
+            yield upload_event("error", error=str(e), fatal=True, **counts)
+            return
+        yield upload_event("done", upload_id=upload_id, **counts)
+
+    return DuplexStreamingResponse(events(), media_type="application/x-ndjson")
+
+@app.get("/api/rag/upload/stream/{upload_id}")
+async def upload_status(upload_id: str, user: str = Depends(get_current_user)):
+    status = await run_blocking(upload_log.status, user_key(user), upload_id)
+    if status is None:
+        raise HTTPException(404, "Unknown upload.")
+    return status
+
+async def own_job(user: str, job_id: str) -> dict:
+    job = await run_blocking(job_store.get, job_id)
+    if job is None or job["user"] != user_key(user):
+        raise HTTPException(404, "Unknown job.")
+    return job
+
+@app.get("/api/jobs")
+async def list_jobs(user: str = Depends(get_current_user)):
+    return {"jobs": [job_view(job) for job in await run_blocking(job_store.list, user_key(user))]}
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str, stream: bool = False, user: str = Depends(get_current_user)):
+    """The job's state; with stream=true an NDJSON line per change until it finishes."""
+    job = await own_job(user, job_id)
+    if not stream:
+        return job_view(job)
+
+    async def events():
+        current, last = job, None
+        while True:
+            view = job_view(current)
+            if view != last:
+                yield json.dumps(view) + "\n"
+                last = view
+            if current["status"] in jobs.FINISHED:
+                return
+            await job_queue.wait(job_id)
+            current = await run_blocking(job_store.get, job_id)
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str, user: str = Depends(get_current_user)):
+    """
+    Cancels a queued job, or stops a running one at its next await; work
+    already persisted (finished courses) stays.
+    """
+    job = await own_job(user, job_id)
+    if job["status"] in jobs.FINISHED:
+        raise HTTPException(409, f"Job already {job['status']}.")
+    await job_queue.cancel(job)
+    return JSONResponse(job_view(await run_blocking(job_store.get, job_id)), status_code=202)
+
+def write_sources(ukey: str, files: dict):
+    """
+    Writes uploaded texts to SOURCE_DIR/<ukey> and chunks them; same shape as
+    the changed lists from scan_sources.
+    """
+    out = []
+    for fn, text in files.items():
+        path = os.path.join(SOURCE_DIR, ukey, fn)
+        write_text(path, text)
+        docstore.put(f"{ukey}/{fn}", text)
+        passages, metas = chunk_file(fn, text)
+        out.append((fn, fingerprint(path), passages, metas))
+    return out
+
+@app.get("/api/stats")
+async def stats(user: str = Depends(get_current_user)):
+    return {
+        "embedding_cache": embedding_cache.stats(),
+        "embedder":        embedder.stats(),
+        "query_embedder":  query_embedder.stats(),
+        "index":           {"configured": INDEX_TYPE, "ann_threshold": ANN_THRESHOLD,
+                            "storage": VECTOR_STORAGE},
+        "shards":          shards.stats(),
+        "docstore":        docstore.stats(),
+        "plan_docstore":   plan_docstore.stats(),
+        "conversations":   conversation_store.stats(),
+        "answer_cache":    answers.stats(),
+        "jobs":            job_queue.stats(),
+        "llm_admission":   llm_scheduler.stats(),
+    }
+
+registry.gauge("rag_index_vectors", "Vectors in resident course shards",
+               lambda: shards.stats()["vectors"])
+registry.gauge("rag_index_memory_bytes", "Memory held by resident course shards",
+               lambda: shards.stats()["resident_bytes"])
+registry.gauge("rag_index_resident_shards", "Course shards loaded in memory",
+               lambda: shards.stats()["resident_shards"])
+registry.gauge("rag_plan_vectors", "Vectors in the plan index", lambda: plan_store.index.ntotal)
+registry.gauge("rag_docstore_memory_bytes", "Memory held by passage text",
+               lambda: {"rag": docstore.stats()["memory_bytes"],
+                        "plan": plan_docstore.stats()["memory_bytes"]}, label="store")
+registry.gauge("rag_docstore_hits", "Passage text lookups served since start",
+               lambda: {"rag": docstore.lookups()["hits"],
+                        "plan": plan_docstore.lookups()["hits"]}, label="store")
+registry.gauge("rag_docstore_misses", "Passage text lookups that found no text since start",
+               lambda: {"rag": docstore.lookups()["misses"],
+                        "plan": plan_docstore.lookups()["misses"]}, label="store")
+# divided by hits + misses: the average lookup latency the store buys us
+registry.gauge("rag_docstore_lookup_seconds", "Time spent in passage text lookups since start",
+               lambda: {"rag": docstore.lookups()["seconds"],
+                        "plan": plan_docstore.lookups()["seconds"]}, label="store")
+registry.gauge("rag_jobs", "Background jobs in this process",
+               lambda: {k: job_queue.stats()[k] for k in ("queued", "running")}, label="state")
+registry.gauge("rag_conversations", "Stored conversations",
+               lambda: conversation_store.backend.count())
+registry.gauge("rag_cache_hits", "Cache hits since start",
+               lambda: {"embedding": embedding_cache.stats()["hits"],
+                        "query_embedding": query_embedder.stats()["hits"],
+                        "answer": answers.stats()["hits"]}, label="cache")
+registry.gauge("rag_cache_misses", "Cache misses since start",
+               lambda: {"embedding": embedding_cache.stats()["misses"],
+                        "query_embedding": query_embedder.stats()["misses"],
+                        "answer": answers.stats()["misses"]}, label="cache")
+registry.gauge("rag_cache_coalesced", "Lookups that joined an identical in-flight request since start",
+               lambda: {"query_embedding": query_embedder.stats()["coalesced"]}, label="cache")
+# hits and coalesced lookups times the average time of a miss
+registry.gauge("rag_cache_saved_seconds", "Estimated API time saved by cache hits since start",
+               lambda: {"query_embedding": query_embedder.stats()["saved_ms"] / 1000}, label="cache")
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: 200 once the course side has warmed up, 503 (with the warm-up state) until then."""
+    return JSONResponse(warm_up_state, status_code=200 if warm_up_state["status"] == "ready" else 503)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(404, "Metrics are disabled.")
+    text = await run_blocking(registry.render)
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
 
 @app.post("/api/rag/query")
 async def query_rag(req: QueryRequest, user: str = Depends(get_current_user)):
-    if index is None:
+    ukey = user_key(user)
+    if not shards.courses(ukey):
         raise HTTPException(400, "Index not built.")
-    emb = openai.embeddings.create(input=req.query, model="text-embedding-ada-002").data[0].embedding
-    qv  = np.array(emb, dtype="float32").reshape(1, DIM)
-    dists, ids = index.search(qv, req.top_k)
-    return {"results": [{"id": int(i), **id_to_meta.get(i, {})} for i in ids[0]]}
-
+    admit(ukey, admission.INTERACTIVE)
+    mode = retrieval_mode(req.mode)
+    with metrics.stage("embed"):
+        qv = await embed_query(req.query) if mode != "lexical" else None
+    with metrics.stage("search"):
+        results = await run_blocking(search_passages, ukey, req.query, qv, req.top_k, req.nprobe,
+                                     req.ef_search, req.course_ids, mode)
+    return {"results": results, "mode": mode}
+
+def retrieval_mode(requested: Optional[str]) -> str:
+    mode = requested or RETRIEVAL_MODE
+    if mode not in RETRIEVAL_MODES:
+        raise HTTPException(400, f"mode must be one of {RETRIEVAL_MODES}")
+    return mode
+
+async def embed_query(text: str) -> np.ndarray:
+    return await query_embedder.embed(text)
+
+async def request_query_embedding(text: str) -> np.ndarray:
+    # through the on-disk embedding cache too, so a restarted process answers
+    # repeat queries without the API (or importing openai)
+    [vec] = await run_blocking(embedding_cache.get_many, EMBED_MODEL, [text])
+    if vec is None:
+        async with llm_scheduler.slot(admission.estimate_tokens(text)):
+            resp = await aclient.embeddings.create(input=text, model=EMBED_MODEL)
+        vec = np.array(resp.data[0].embedding, dtype="float32")
+        await run_blocking(embedding_cache.put_many, EMBED_MODEL, [text], [vec])
+    return vec.reshape(1, DIM)
+
+# repeated and simultaneous identical queries (suggested-prompt buttons)
+# share one embedding. The LRU is per worker; its misses still find the
+# vector in the on-disk embedding cache every worker shares
+query_embedder = QueryEmbedder(request_query_embedding,
+                               max_items=int(os.getenv("QUERY_EMBED_CACHE_ITEMS", "2048")))
+
+def search_passages(ukey: str, query: str, qv: Optional[np.ndarray], top_k: int,
+                    nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                    course_ids: Optional[List[str]] = None, mode: str = "vector") -> List[dict]:
+    """
+    Searches only the caller's course shards. "vector" ranks by L2 distance,
+    "lexical" by BM25, and "hybrid" fuses the two rankings with RRF; `score`
+    is the distance, BM25 score or RRF score respectively.
+    """
+    depth = top_k if mode != "hybrid" else max(top_k, FUSION_DEPTH)
+    vec_hits, lex_hits = [], []
+    for shard in shards.user_shards(ukey, course_ids):
+        with shard.lock:
+            if not shard.index.ntotal:
+                continue
+            if mode != "lexical":
+                dists, ids = shard.search(qv, depth, nprobe, ef_search)
+                vec_hits += [(float(d), shard, int(i)) for d, i in zip(dists[0], ids[0]) if i >= 0]
+            if mode != "vector":
+                lex_hits += [(score, shard, did) for did, score in lexical_index(shard).search(query, depth)]
+
+    vec_hits.sort(key=lambda h: h[0])
+    lex_hits.sort(key=lambda h: -h[0])
+    if mode == "vector":
+        ranked = [((s.course_id, i), d) for d, s, i in vec_hits]
+    elif mode == "lexical":
+        ranked = [((s.course_id, i), score) for score, s, i in lex_hits]
+    else:
+        ranked = lexical.rrf([[(s.course_id, i) for _, s, i in vec_hits[:depth]],
+                              [(s.course_id, i) for _, s, i in lex_hits[:depth]]])
+
+    shard_of = {(s.course_id, i): s for _, s, i in vec_hits + lex_hits}
+    results  = []
+    seen, sigs = set(), []
+    for (cid, did), score in ranked:
+        shard = shard_of[(cid, did)]
+        meta  = shard.meta.get(did)
+        if not meta:
+            continue
+        text = docstore.passage(f"{ukey}/{meta['source_file']}", meta["start"], meta["end"])
+        if text is None:
+            continue
+        # the same passage from several courses (cross-listings) counts once
+        key = dedup.text_hash(" ".join(text.split()))
+        if key in seen:
+            continue
+        seen.add(key)
+        if NEAR_DUP_THRESHOLD:
+            sig = dedup.minhash(text)
+            if any(dedup.similarity(sig, other) >= NEAR_DUP_THRESHOLD for other in sigs):
+                continue
+            sigs.append(sig)
+        results.append({"id": did, "course_id": cid, "score": float(score), **meta, "text": text})
+        if len(results) >= top_k:
+            break
+    return results
+
+def build_context(passages: List[dict], budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Joins the best passages (in rank order) until the token budget is spent;
+    the top passage is always included, truncated if it alone is too long.
+    """
+    parts, used = [], 0
+    for p in passages:
+        block = f"[{p['source_file']}]\n{p['text']}"
+        n     = embedder.tokenizer.count(block)
+        if used + n > budget:
+            if not parts:
+                parts.append(embedder.tokenizer.truncate(block, budget))
+            break
+        parts.append(block)
+        used += n
+    return "\n---\n".join(parts)
+
+
+async def stream_completion(messages: List[dict], model: str = "gpt-4o"):
+    """Yields the text of a streamed chat completion, timing first token and total."""
+    t0     = time.perf_counter()
+    first  = True
+    parts  = []
+    # the slot is held until the stream ends: that's when the connection is free
+    async with llm_scheduler.slot(chat_tokens(messages)):
+        stream = await aclient.chat.completions.create(model=model, messages=messages, stream=True)
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            content = getattr(chunk.choices[0].delta, "content", None)
+            if content:
+                if first:
+                    metrics.record("llm_first_token", time.perf_counter() - t0)
+                    first = False
+                parts.append(content)
+                yield content
+    metrics.record("llm_total", time.perf_counter() - t0)
+    count_llm_tokens(messages, "".join(parts))
+
+def count_llm_tokens(messages: List[dict], completion: str):
+    if not METRICS_ENABLED:
+        return
+    endpoint = metrics.endpoint()
+    tok      = embedder.tokenizer
+    llm_tokens.inc(sum(tok.count(m["content"]) for m in messages), endpoint=endpoint, direction="in")
+    llm_tokens.inc(tok.count(completion), endpoint=endpoint, direction="out")
+
+async def summarize_history(summary: str, messages: List[dict]) -> str:
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    prompt = [
+        {"role": "system", "content": "You keep a running summary of a conversation between a student and an assistant. "
+                                      "Keep courses, dates, decisions and open questions; drop pleasantries. Be brief."},
+        {"role": "user",   "content": f"Summary so far:\n{summary or '(none)'}\n\nNew turns:\n{transcript}\n\n"
+                                      "Return the updated summary only."},
+    ]
+    # runs after the reply was sent, so it queues behind interactive calls
+    async with llm_scheduler.slot(chat_tokens(prompt), admission.BULK):
+        resp = await aclient.chat.completions.create(model=SUMMARY_MODEL, messages=prompt, temperature=0.0)
+    return resp.choices[0].message.content.strip()
+
+async def load_history(ukey: str, conversation_id: str, query: str) -> List[dict]:
+    """Prompt history for this turn (summary + recent window), recording the new query."""
+    history = await run_blocking(conversation_store.window, ukey, conversation_id)
+    await run_blocking(conversation_store.append, ukey, conversation_id, "user", query)
+    return history + [{"role": "user", "content": query}]
+
+async def finish_turn(ukey: str, conversation_id: str, answer: str):
+    await run_blocking(conversation_store.append, ukey, conversation_id, "assistant", answer)
+
+def answer_scope(indexes):
+    """Cache scope for a search over `indexes`, plus the content hashes it depends on."""
+    tags = [idx.content_hash() for idx in indexes]
+    return answer_cache.scope_key(tags), tags
+
+async def replay_answer(answer: str):
+    for i in range(0, len(answer), 64):
+        yield answer[i:i + 64]
+
+def cached_response(answer: str, conversation_id: str) -> StreamingResponse:
+    return StreamingResponse(
+        replay_answer(answer),
+        media_type="text/plain",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Conversation-ID": conversation_id,
+            "X-Answer-Cache": "hit",
+        }
+    )
 
-from fastapi.responses import StreamingResponse
-import asyncio
+def compact_history(ukey: str, conversation_id: str) -> BackgroundTask:
+    # runs after the response has been sent, so summarizing never delays a reply
+    return BackgroundTask(conversation_store.compact, ukey, conversation_id,
+                          summarize_history, run_blocking)
 
 @app.post("/api/rag/chat")
 async def chat_rag(req: ChatRequest, user: str = Depends(get_current_user)):
-    if index is None:
+    ukey = user_key(user)
+    if not shards.courses(ukey):
         raise HTTPException(400, "Index not built.")
+    mode = retrieval_mode(req.mode)
+    admit(ukey, admission.INTERACTIVE)
     
     try:
         # Create or retrieve conversation history
         conversation_id = req.conversation_id or str(uuid.uuid4())
-        if conversation_id not in conversation_memory:
-            conversation_memory[conversation_id] = ChatMessageHistory()
-        
-        message_history = conversation_memory[conversation_id]
         
-        # Get embeddings for the query
-        emb = openai.embeddings.create(input=req.query, model="text-embedding-ada-002").data[0].embedding
-        qv  = np.array(emb, dtype="float32").reshape(1, DIM)
-        _, ids = index.search(qv, req.top_k)
-
-        # Retrieve the relevant documents
-        docs = []
-        for i in ids[0]:
-            meta = id_to_meta.get(i)
-            if not meta: continue
-            fn   = meta.get("source_file")
-            path = os.path.join(SOURCE_DIR, fn)
-            if fn and os.path.isfile(path):
-                docs.append(open(path, encoding="utf-8").read())
-
-        if not docs:
+        # Get embeddings for the query (not needed for lexical-only retrieval)
+        with metrics.stage("embed"):
+            qv = await embed_query(req.query) if mode != "lexical" else None
+        # Retrieve the relevant passages
+        with metrics.stage("search"):
+            passages = await run_blocking(search_passages, ukey, req.query, qv, req.top_k, req.nprobe,
+                                          req.ef_search, req.course_ids, mode)
+
+        if not passages:
             return {"response": "No documents found for this query.", "conversation_id": conversation_id}
 
-        context = "\n---\n".join(docs)
+        with metrics.stage("context"):
+            context = await run_blocking(build_context, passages)
         
-        # Add the user's query to memory
-        message_history.add_user_message(req.query)
-        
-        # Convert memory to messages format
-        memory_messages = []
-        for msg in message_history.messages:
-            if isinstance(msg, HumanMessage):
-                memory_messages.append({"role": "user", "content": msg.content})
-            elif isinstance(msg, AIMessage):
-                memory_messages.append({"role": "assistant", "content": msg.content})
+        # Add the user's query to memory; only the summary and the newest
+        # turns that fit the token budget are sent
+        with metrics.stage("history"):
+            memory_messages = await load_history(ukey, conversation_id, req.query)
+
+        # a first turn depends only on the question and the passages, so a
+        # near-identical earlier question over the same passages can be replayed
+        cache_key = None
+        if len(memory_messages) == 1 and qv is not None:
+            searched  = await run_blocking(shards.user_shards, ukey, req.course_ids)
+            scope, tags = answer_scope(searched)
+            pkey      = answer_cache.passages_key(
+                f"{p['course_id']}/{p['source_file']}:{p['start']}:{p['text']}" for p in passages)
+            cache_key = (scope, tags, qv, pkey)
+            with metrics.stage("answer_cache"):
+                cached = answers.lookup(scope, qv, pkey)
+            if cached is not None:
+                await finish_turn(ukey, conversation_id, cached)
+                return cached_response(cached, conversation_id)
         
         # Prepare the system message with context
         system_message = {"role": "system", "content": f"You are a helpful assistant for Canvas. Use the following context to answer questions, and remember previous parts of the conversation.\n\nContext:\n{context}"}
@@ -309,33 +1291,24 @@ async def chat_rag(req: ChatRequest, user: str = Depends(get_current_user)):
         # Complete list of messages for the API call
         all_messages = [system_message] + memory_messages
         
-        collected_response = []
-        
         async def generate():
             try:
-                stream = openai.chat.completions.create(
-                    model="gpt-4o",
-                    messages=all_messages,
-                    stream=True
-                )
-                
                 full_response = ""
                 
-                for chunk in stream:
-                    if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content is not None:
-                        content = chunk.choices[0].delta.content
-                        full_response += content
-                        yield content
-                        await asyncio.sleep(0.01)
+                async for content in stream_completion(all_messages):
+                    full_response += content
+                    yield content
                         
                 # After generating the full response, add it to memory
-                message_history.add_ai_message(full_response)
+                await finish_turn(ukey, conversation_id, full_response)
+                if cache_key is not None:
+                    answers.store(*cache_key, full_response)
                 
             except Exception as e:
                 logging.error(f"Error in generate stream: {str(e)}")
                 error_msg = f"\nError generating response: {str(e)}"
                 yield error_msg
-                message_history.add_ai_message(error_msg)
+                await finish_turn(ukey, conversation_id, error_msg)
 
         return StreamingResponse(
             generate(),
@@ -345,7 +1318,8 @@ async def chat_rag(req: ChatRequest, user: str = Depends(get_current_user)):
                 "Connection": "keep-alive",
                 "X-Accel-Buffering": "no",
                 "X-Conversation-ID": conversation_id
-            }
+            },
+            background=compact_history(ukey, conversation_id)
         )
     
     except Exception as e:
@@ -355,101 +1329,164 @@ async def chat_rag(req: ChatRequest, user: str = Depends(get_current_user)):
 # New endpoint to clear conversation history
 @app.post("/api/rag/clear_memory")
 async def clear_memory(conversation_id: str, user: str = Depends(get_current_user)):
-    if conversation_id in conversation_memory:
-        del conversation_memory[conversation_id]
+    if await run_blocking(conversation_store.delete, user_key(user), conversation_id):
         return {"status": "success", "message": f"Conversation {conversation_id} memory cleared"}
     return {"status": "success", "message": f"No conversation found with ID {conversation_id}"}
 
 # New endpoint to list active conversations
 @app.get("/api/rag/conversations")
 async def list_conversations(user: str = Depends(get_current_user)):
-    return {
-        "conversations": [
-            {"id": conv_id, "message_count": len(history.messages)}
-            for conv_id, history in conversation_memory.items()
-        ]
-    }
+    return {"conversations": await run_blocking(conversation_store.list, user_key(user))}
 
 @app.post("/api/plan/upload")
-async def plan_upload(req: PlanUploadRequest, user: str = Depends(get_current_user)):
+async def plan_upload(req: PlanUploadRequest, wait: bool = False, user: str = Depends(get_current_user)):
     """
     Accepts:
       { "courses": { currentCourses: [...], pastCourses: [...] } }
-    Embeds the entire JSON blob as one document into plan_index.
+    Replaces the user's course snapshot. It's read by key for their degree
+    audit, never searched, so it isn't embedded and the plan index only
+    ever holds the catalogs.
     """
-    global plan_index, plan_id_to_meta, plan_next_doc_id
-    os.makedirs(PLAN_SOURCE_DIR, exist_ok=True)
-
-    # 1) Serialize your blob as text
+    ukey = user_key(user)
     text = json.dumps(req.courses)
 
-    # 2) Save the raw JSON (optional)
-    fn = f"scraped_{plan_next_doc_id}.json"
-    path = os.path.join(PLAN_SOURCE_DIR, fn)
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(text)
-
-    # 3) Embed + index
-    emb = openai.embeddings.create(input=text, model="text-embedding-ada-002")\
-                           .data[0].embedding
-    vec = np.array(emb, dtype="float32").reshape(1, DIM)
-    plan_index.add_with_ids(vec, np.array([plan_next_doc_id], dtype="int64"))
-    plan_id_to_meta[plan_next_doc_id] = {"source_file": fn}
-    plan_next_doc_id += 1
+    async def run(job):
+        changed = await run_blocking(save_student_courses, ukey, text)
+        return {"stored": True, "unchanged": not changed}
 
-    # 4) Persist your new index
-    faiss.write_index(plan_index, PLAN_INDEX_PATH)
-    np.save(PLAN_META_PATH, plan_id_to_meta)
+    return await submit_job(ukey, "plan_upload", dedup.text_hash(text), run, wait)
 
-    return {"indexed": 1}
+def search_plan_docs(qv: np.ndarray, top_k: int) -> List[tuple]:
+    """[(file name, text)] of the plan documents nearest the query."""
+    plan_store.refresh()
+    with plan_store.lock:
+        _, ids = plan_store.search(qv, top_k)
+    docs = []
+    for i in ids[0]:
+        meta = plan_store.meta.get(int(i))
+        if not meta: continue
+        text = plan_docstore.get(meta["source_file"])
+        if text is not None:
+            docs.append((meta["source_file"], text))
+    return docs
+
+# degree requirements parsed from the plan_data catalogs (the .txt files),
+# by file name; reparsed when the text changes
+programs = {}
+
+def degree_program(fn: str) -> Optional[degree_audit.Program]:
+    text = plan_docstore.get(fn) if fn.endswith(".txt") else None
+    if text is None:
+        return None
+    key    = dedup.text_hash(text)
+    cached = programs.get(fn)
+    if cached is None or cached[0] != key:
+        program = degree_audit.parse_catalog(text)
+        cached  = programs[fn] = (key, program if program.requirements else None)
+    return cached[1]
+
+def student_courses_path(ukey: str) -> str:
+    return os.path.join(PLAN_STUDENT_DIR, f"{ukey}.json")
+
+def save_student_courses(ukey: str, text: str) -> bool:
+    """Replaces the user's snapshot; False if it was already this one."""
+    path = student_courses_path(ukey)
+    try:
+        if read_text(path) == text:
+            return False
+    except FileNotFoundError:
+        os.makedirs(PLAN_STUDENT_DIR, exist_ok=True)
+    atomic_write(path, [text.encode("utf-8")])
+    return True
+
+def load_student_courses(ukey: str) -> Optional[dict]:
+    """The user's last plan upload ({currentCourses, pastCourses}), if any."""
+    try:
+        return json.loads(read_text(student_courses_path(ukey)))
+    except (FileNotFoundError, ValueError):
+        return None
 
+def plan_context(ukey: str, docs: List[tuple]) -> str:
+    """
+    The plan_chat context: a degree audit for each catalog among `docs`
+    instead of the catalog text, any other plan documents as they are, and
+    the user's own course list (never anyone else's).
+    """
+    student = load_student_courses(ukey)
+    parts   = []
+    for fn, text in docs:
+        program = degree_program(fn)
+        if program is not None:
+            taken = degree_audit.student_courses(student or {}, program.titles)
+            parts.append(degree_audit.format_audit(degree_audit.audit(program, taken), program.titles))
+            if student is None:
+                parts.append("(The student hasn't uploaded their courses yet, so nothing counts as taken.)")
+        else:
+            parts.append(text)
+    if student is not None:
+        parts.append(degree_audit.format_courses(student))
+    return "\n---\n".join(parts)
+
+def plan_audits(ukey: str) -> List[dict]:
+    student = load_student_courses(ukey) or {}
+    out     = []
+    for fn in sorted(plan_store.manifest):
+        program = degree_program(fn)
+        if program is not None:
+            taken = degree_audit.student_courses(student, program.titles)
+            out.append({"source_file": fn, **degree_audit.audit(program, taken)})
+    return out
+
+@app.get("/api/plan/audit")
+async def plan_audit(user: str = Depends(get_current_user)):
+    """The structured degree audit plan_chat answers from, one per catalog."""
+    require_plan_index()
+    await run_blocking(plan_store.refresh)
+    return {"audits": await run_blocking(plan_audits, user_key(user))}
 
 @app.post("/api/plan/chat")
 async def plan_chat(req: ChatRequest, user: str = Depends(get_current_user)):
-    if plan_index is None:
+    require_plan_index()
+    await run_blocking(plan_store.refresh)
+    if not plan_store.index.ntotal:
         raise HTTPException(400, "Plan index not built.")
 
     # Create or retrieve conversation history for plan chat
+    ukey = user_key(user)
+    admit(ukey, admission.INTERACTIVE)
     conversation_id = req.conversation_id or f"plan_{str(uuid.uuid4())}"
-    if conversation_id not in conversation_memory:
-        conversation_memory[conversation_id] = ChatMessageHistory()
-    
-    message_history = conversation_memory[conversation_id]
         
     # embed the query
-    emb = openai.embeddings.create(input=req.query, model="text-embedding-ada-002")\
-                           .data[0].embedding
-    qv  = np.array(emb, dtype="float32").reshape(1, DIM)
-    _, ids = plan_index.search(qv, req.top_k)
+    with metrics.stage("embed"):
+        qv = await embed_query(req.query)
 
-    # pull down that one big JSON document (or however many you've indexed)
-    docs = []
-    for i in ids[0]:
-        meta = plan_id_to_meta.get(i)
-        if not meta: continue
-        fn = meta["source_file"]
-        p  = os.path.join(PLAN_SOURCE_DIR, fn)
-        if os.path.isfile(p):
-            docs.append(open(p, encoding="utf-8").read())
+    # the catalogs nearest the query, audited against the student's courses
+    with metrics.stage("search"):
+        docs = await run_blocking(search_plan_docs, qv, req.top_k)
+    with metrics.stage("audit"):
+        context = await run_blocking(plan_context, ukey, docs)
 
-    if not docs:
+    if not context:
         return {"response": "No plan data indexed yet.", "conversation_id": conversation_id}
-
-    context = "\n---\n".join(docs)
-    
-    # Add the user's query to memory
-    message_history.add_user_message(req.query)
     
-    # Convert memory to messages format
-    memory_messages = []
-    for msg in message_history.messages:
-        if isinstance(msg, HumanMessage):
-            memory_messages.append({"role": "user", "content": msg.content})
-        elif isinstance(msg, AIMessage):
-            memory_messages.append({"role": "assistant", "content": msg.content})
+    # Add the user's query to memory; only the summary and the newest
+    # turns that fit the token budget are sent
+    with metrics.stage("history"):
+        memory_messages = await load_history(ukey, conversation_id, req.query)
+
+    cache_key = None
+    if len(memory_messages) == 1:
+        scope, tags = answer_scope([plan_store])
+        pkey      = answer_cache.passages_key([context])
+        cache_key = (scope, tags, qv, pkey)
+        with metrics.stage("answer_cache"):
+            cached = answers.lookup(scope, qv, pkey)
+        if cached is not None:
+            await finish_turn(ukey, conversation_id, cached)
+            return cached_response(cached, conversation_id)
     
     # Prepare the system message with context
-    system_message = {"role": "system", "content": f"You are an academic advisor for course planning. Use the following context to answer questions, and remember previous parts of the conversation.\n\nContext:\n{context}"}
+    system_message = {"role": "system", "content": f"You are an academic advisor for course planning. The context is a degree audit computed from the program catalog and the student's courses: trust its DONE / NEEDS status and counts rather than recomputing them. Use it to answer questions, and remember previous parts of the conversation.\n\nContext:\n{context}"}
     
     # Complete list of messages for the API call
     all_messages = [system_message] + memory_messages
@@ -457,31 +1494,22 @@ async def plan_chat(req: ChatRequest, user: str = Depends(get_current_user)):
     # stream the answer back
     async def gen():
         try:
-            stream = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=all_messages,
-                stream=True
-            )
-            
             full_response = ""
             
-            for chunk in stream:
-                delta = chunk.choices[0].delta
-                # use attribute access instead of dict.get()
-                if getattr(delta, "content", None):
-                    content = delta.content
-                    full_response += content
-                    yield content
-                    await asyncio.sleep(0.01)
+            async for content in stream_completion(all_messages):
+                full_response += content
+                yield content
                     
             # After generating the full response, add it to memory
-            message_history.add_ai_message(full_response)
+            await finish_turn(ukey, conversation_id, full_response)
+            if cache_key is not None:
+                answers.store(*cache_key, full_response)
                 
         except Exception as e:
             logging.error(f"Error in generate stream: {e}")
             error_msg = f"\nError generating response: {e}"
             yield error_msg
-            message_history.add_ai_message(error_msg)
+            await finish_turn(ukey, conversation_id, error_msg)
 
     return StreamingResponse(
         gen(), 
@@ -491,103 +1519,104 @@ async def plan_chat(req: ChatRequest, user: str = Depends(get_current_user)):
             "Connection": "keep-alive",
             "X-Accel-Buffering": "no",
             "X-Conversation-ID": conversation_id
-        }
+        },
+        background=compact_history(ukey, conversation_id)
     )
 
 
 logging.basicConfig(level=logging.INFO)
 
 @app.post("/api/rag/deadlines")
-async def extract_deadlines(user: str = Depends(get_current_user)):
-    if index is None:
+async def extract_deadlines(wait: bool = False, user: str = Depends(get_current_user)):
+    ukey = user_key(user)
+    if not shards.courses(ukey):
         raise HTTPException(400, "Index not built.")
+    # fail before spending any LLM calls if there's nowhere to put the events
+    with metrics.stage("calendar_auth"):
+        calendar = await run_blocking(get_calendar_service, user)
+    admit(ukey, admission.BULK)
 
-    courses = {}
-    for doc_id, meta in id_to_meta.items():
-        fn = meta["source_file"]
-        m = re.match(r"(\d+)_", fn)
-        if not m:
-            continue
-        cid = m.group(1)
-        courses.setdefault(cid, []).append(fn)
+    async def run(job):
+        return await scan_deadlines(ukey, calendar, job.progress)
 
-    results = {}
+    return await submit_job(ukey, "deadlines", "all", run, wait)
 
-    for cid, files in courses.items():
-        texts = []
-        for fn in files:
-            path = os.path.join(SOURCE_DIR, fn)
-            if os.path.isfile(path):
-                texts.append(open(path, encoding="utf-8").read())
-        context = "\n---\n".join(texts)
-
-        prompt = (
-            "Extract all exam or assignment deadlines from the following syllabus/pages.  "
-            "For each item, give:\n"
-            "  - title (e.g. “Midterm Exam 1”, “Problem Set 3”) \n"
-            "  - due_date (ISO format YYYY-MM-DD if possible)  \n"
-            "  - type (“exam” or “assignment”)\n"
-            "Return a JSON array only, e.g.:\n"
-            '[ { "title": "...", "due_date": "...", "type": "..." }, … ]\n\n'
-            f"CONTEXT:\n{context}"
-        )
+async def scan_deadlines(ukey: str, calendar, progress=None) -> dict:
+    """Extracts every course's deadlines (cached per course content) and adds the new ones to the calendar."""
+    courses = {}
+    for shard in await run_blocking(shards.user_shards, ukey):
+        # collapsed copies (duplicate_of) would only put the same text in the prompt twice
+        courses[shard.course_id] = [f"{ukey}/{fn}" for fn, entry in sorted(shard.manifest.items())
+                                    if not entry.get("duplicate_of")]
 
+    sem     = asyncio.Semaphore(DEADLINE_CONCURRENCY)
+    timings = {}
+    results = {}
 
-        resp = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
+    async def extract(cid, files):
+        t0    = time.perf_counter()
+        texts = [t for t in (docstore.get(fn) for fn in files) if t is not None]
+        key   = deadlines.course_hash(DEADLINE_MODEL, texts)
+        items = await run_blocking(deadline_store.get, key)
+        status = "hit"
+        if items is None:
+            status = "miss"
+            messages = [
                 {"role": "system", "content": "You are a helpful assistant for parsing deadlines."},
-                {"role": "user",   "content": prompt},
-            ],
-            temperature=0.0
-        )
-        raw = resp.choices[0].message.content.strip()
-
-        cleaned = re.sub(r"^```(?:json)?\s*", "", raw)       
-        cleaned = re.sub(r"\s*```$", "", cleaned)           
-        cleaned = cleaned.strip()
-
-        try:
-            deadlines_list = json.loads(cleaned)
-        except json.JSONDecodeError as e:
-            logging.error(f"[{cid}] JSON parse error: {e}")
-            logging.error(f"[{cid}] raw response:\n{raw}")
-            logging.error(f"[{cid}] cleaned content:\n{cleaned}")
-            deadlines_list = []
-
-        logging.info(f"Deadlines for course {cid}: {json.dumps(deadlines_list, indent=2)}")
-
-        results[cid] = deadlines_list
-        calendar = get_calendar_service(user)
-
-        for cid, deadlines in results.items():
-            for item in deadlines:
-                if not item.get("due_date"):
-                    continue
-
-                event = {
-                    "summary": f"{item['title']} ({item['type']})",
-                    "start": {"date": item["due_date"]},
-                    "end":   {"date": item["due_date"]},
-                    "description": f"Auto-added from Canvas course {cid}"
-                }
-                try:
-                    calendar.events().insert(calendarId='primary', body=event).execute()
-                except Exception as e:
-                    logging.error(f"Failed to create event for {cid} {item}: {e}")
-
-        return {"scheduled": results}
+                {"role": "user",   "content": deadlines.build_prompt("\n---\n".join(texts))},
+            ]
+            async with sem, llm_scheduler.slot(chat_tokens(messages)):
+                t_llm = time.perf_counter()
+                resp  = await aclient.chat.completions.create(
+                    model=DEADLINE_MODEL,
+                    messages=messages,
+                    temperature=0.0
+                )
+                metrics.record("llm", time.perf_counter() - t_llm)
+            items = deadlines.parse_deadlines(cid, resp.choices[0].message.content)
+            count_llm_tokens(messages, resp.choices[0].message.content)
+            await run_blocking(deadline_store.put, key, cid, items)
+        results[cid] = items
+        timings[cid] = {"cache": status, "deadlines": len(items),
+                        "ms": round((time.perf_counter() - t0) * 1000, 1)}
+        logging.info(f"Deadlines for course {cid} ({status}, {timings[cid]['ms']} ms): {len(items)} items")
+        await report(progress, courses_done=len(results), courses=len(courses))
+
+    with metrics.stage("extract"):
+        await asyncio.gather(*(extract(cid, files) for cid, files in courses.items()))
+
+    # one event per distinct deadline, minus the ones created on earlier runs
+    events = {}
+    for cid, items in results.items():
+        for item in items:
+            if item.get("due_date"):
+                event = deadlines.make_event(cid, item)
+                events[event["id"]] = event
+    done = await run_blocking(deadline_store.created_events, ukey, events)
+    todo = [e for eid, e in events.items() if eid not in done]
+
+    t0 = time.perf_counter()
+    with metrics.stage("calendar_insert"):
+        created, existing, failed = await run_blocking(deadlines.insert_events, calendar, todo) \
+            if todo else ([], [], [])
+    await run_blocking(deadline_store.mark_created, ukey, created + existing)
 
+    return {
+        "scheduled": {cid: results[cid] for cid in courses},
+        "courses":   {cid: timings[cid] for cid in courses},
+        "calendar":  {"created": len(created), "already_present": len(done) + len(existing),
+                      "failed": len(failed), "ms": round((time.perf_counter() - t0) * 1000, 1)},
+    }
 
 
-from fastapi import Request
-from google_auth_oauthlib.flow import Flow
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+# the Google client libraries are imported by the calendar endpoints that use
+# them, not at startup (they're a noticeable part of import time)
 def get_calendar_service(user: str):
-    tok = user_tokens.get(user)
+    tok = deadline_store.token(user_key(user))
     if not tok:
         raise HTTPException(401, "User not authorized with Google Calendar")
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
     creds = Credentials(
         tok["token"],
         refresh_token=tok["refresh_token"],
@@ -601,14 +1630,17 @@ def get_calendar_service(user: str):
 GOOGLE_OAUTH2_CLIENT_SECRETS = os.path.join(BASE_DIR, 'credentials.json')
 SCOPES = ['https://www.googleapis.com/auth/calendar.events']
 
-user_tokens = {}
-from fastapi.responses import JSONResponse, HTMLResponse
-from fastapi import status
-from fastapi.responses import JSONResponse
+def oauth_flow():
+    from google_auth_oauthlib.flow import Flow
+    return Flow.from_client_secrets_file(
+        GOOGLE_OAUTH2_CLIENT_SECRETS,
+        scopes=SCOPES,
+        redirect_uri="http://localhost:8000/oauth2callback"
+    )
 
 @app.get("/oauth2status")
 async def oauth2_status(user: str = Depends(get_current_user)):
-    connected = user in user_tokens
+    connected = await run_blocking(deadline_store.token, user_key(user)) is not None
     return JSONResponse(
         {"connected": connected},
         status_code=status.HTTP_200_OK
@@ -616,11 +1648,7 @@ async def oauth2_status(user: str = Depends(get_current_user)):
 
 @app.get("/oauth2init")
 async def oauth2_init(user: str = Depends(get_current_user)):
-    flow = Flow.from_client_secrets_file(
-        GOOGLE_OAUTH2_CLIENT_SECRETS,
-        scopes=SCOPES,
-        redirect_uri="http://localhost:8000/oauth2callback"
-    )
+    flow = oauth_flow()
     auth_url, _ = flow.authorization_url(
         access_type='offline',
         prompt='consent',
@@ -629,34 +1657,24 @@ async def oauth2_init(user: str = Depends(get_current_user)):
     return JSONResponse({"auth_url": auth_url})
 
 
-
-from fastapi import Query
-from fastapi import Depends
-from fastapi import Request
-from fastapi import HTTPException
-from fastapi.responses import HTMLResponse
-
 @app.get("/oauth2callback")
 async def oauth2_callback(
     request: Request,
     state: str = Query(...)    
 ):
-    flow = Flow.from_client_secrets_file(
-        GOOGLE_OAUTH2_CLIENT_SECRETS,
-        scopes=SCOPES,
-        redirect_uri="http://localhost:8000/oauth2callback"
-    )
+    flow = oauth_flow()
     flow.fetch_token(code=request.query_params.get('code'))
     creds = flow.credentials
 
-    user_tokens[state] = {
+    # stored per user key in SQLite so every worker can use it
+    await run_blocking(deadline_store.put_token, user_key(state), {
         "token": creds.token,
         "refresh_token": creds.refresh_token,
         "token_uri": creds.token_uri,
         "client_id": creds.client_id,
         "client_secret": creds.client_secret,
         "scopes": creds.scopes
-    }
+    })
 
     return HTMLResponse("""
       <p>Calendar connected! You can now return to the extension and sync.</p>
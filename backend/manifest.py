@@ -0,0 +1,21 @@
+import hashlib
+import os
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def fingerprint(path: str, known: dict = None) -> dict:
+    """
+    Stats `path` and only hashes it when mtime/size differ from `known`,
+    so an unchanged corpus costs one stat() per file.
+    """
+    st = os.stat(path)
+    if known and known.get("mtime") == st.st_mtime and known.get("size") == st.st_size:
+        return {"mtime": st.st_mtime, "size": st.st_size, "sha256": known["sha256"]}
+    return {"mtime": st.st_mtime, "size": st.st_size, "sha256": file_hash(path)}
@@ -0,0 +1,207 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# seconds; covers a sub-millisecond FAISS search up to a slow LLM completion
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_NULL  = nullcontext()
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"'.replace("\n", " ") for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock  = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, v in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.labels, key)} {v}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name    = name
+        self.help    = help
+        self.labels  = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series  = {}  # label values -> [bucket counts..., sum, count]
+        self._lock   = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        i   = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self.series.get(key)
+            if s is None:
+                s = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for key, s in sorted(self.series.items()):
+            cum = 0
+            for bound, n in zip(self.buckets, s):
+                cum += n
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), key + (bound,))} {cum}"
+            yield f"{self.name}_bucket{_labels(self.labels + ('le',), key + ('+Inf',))} {s[-1]}"
+            yield f"{self.name}_sum{_labels(self.labels, key)} {s[-2]}"
+            yield f"{self.name}_count{_labels(self.labels, key)} {s[-1]}"
+
+
+class Gauge:
+    """Read at scrape time from `fn`, which returns a number or {label value: number}."""
+
+    def __init__(self, name: str, help: str, fn, label: str = None):
+        self.name  = name
+        self.help  = help
+        self.fn    = fn
+        self.label = label
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        value = self.fn()
+        if isinstance(value, dict):
+            for k, v in sorted(value.items()):
+                yield f"{self.name}{_labels((self.label,), (k,))} {float(v)}"
+        else:
+            yield f"{self.name} {float(value)}"
+
+
+class Registry:
+    def __init__(self, enabled: bool = True):
+        self.enabled  = enabled
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, fn, label=None) -> Gauge:
+        return self._add(Gauge(name, help, fn, label))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:  # one broken gauge shouldn't break the scrape
+                lines.append(f"# {metric.name} unavailable: {e}")
+        return "\n".join(lines) + "\n"
+
+
+class Trace:
+    """Stage timings of one request, for the stage histogram and Server-Timing."""
+
+    def __init__(self, endpoint: str, histogram: Histogram):
+        self.endpoint  = endpoint
+        self.histogram = histogram
+        self.stages    = []
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def record(self, name: str, seconds: float):
+        self.stages.append((name, seconds))
+        self.histogram.observe(seconds, endpoint=self.endpoint, stage=name)
+
+    def header(self) -> str:
+        return ", ".join(f"{name};dur={s * 1000:.1f}" for name, s in self.stages)
+
+
+def stage(name: str):
+    """Times a block as a stage of the current request; a no-op outside one or when disabled."""
+    trace = _trace.get()
+    return trace.stage(name) if trace is not None else _NULL
+
+
+def record(name: str, seconds: float):
+    trace = _trace.get()
+    if trace is not None:
+        trace.record(name, seconds)
+
+
+def endpoint() -> str:
+    """Path of the traced request being served, for labelling other metrics."""
+    trace = _trace.get()
+    return trace.endpoint if trace is not None else "other"
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (no extra task per request, unlike BaseHTTPMiddleware).
+    Opens a Trace for each request to a traced path, times the request and
+    adds a Server-Timing header with the stages finished before the response
+    started; stages after that (LLM streaming) only go to the histograms.
+    """
+
+    def __init__(self, app, registry: Registry, traced_paths):
+        self.app       = app
+        self.registry  = registry
+        self.traced    = set(traced_paths)
+        self.stages    = registry.histogram("rag_stage_seconds", "Time spent per pipeline stage",
+                                            ("endpoint", "stage"))
+        self.requests  = registry.histogram("http_request_duration_seconds", "Request latency",
+                                            ("endpoint", "status"))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.registry.enabled:
+            return await self.app(scope, receive, send)
+
+        path     = scope["path"]
+        endpoint = path if path in self.traced else "other"
+        trace    = Trace(endpoint, self.stages) if path in self.traced else None
+        token    = _trace.set(trace)
+        status   = [500]
+        t0       = time.perf_counter()
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if trace is not None and trace.stages:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", trace.header().encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            _trace.reset(token)
+            self.requests.observe(time.perf_counter() - t0, endpoint=endpoint, status=status[0])
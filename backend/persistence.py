@@ -0,0 +1,557 @@
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Optional
+
+import faiss
+import numpy as np
+
+import vector_index
+from metatable import MetaTable
+
+SNAPSHOT_MAGIC = b"CCSNAP1\n"
+COMPACT_BYTES  = 64 * 1024 * 1024
+# how often a shared reader stats the snapshot for a newer generation
+REFRESH_SECONDS = 1.0
+# flat codes are mapped straight from the page cache (zero-copy, shared by
+# every worker); such an index must never be modified in place
+MMAP_FLAGS = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+
+# every log record is framed as (payload length, crc32) so a write torn by a
+# crash is detected and dropped on replay instead of corrupting the index
+_FRAME  = struct.Struct("<II")
+_HEADER = struct.Struct("<I")
+
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: str, chunks):
+    """Writes `chunks` to `path` via a temp file + rename, so readers see old or new, never half."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(path)
+
+
+def write_snapshot(path: str, index, state: dict, index_file: Optional[str] = None):
+    """
+    Snapshot file: magic, u64 JSON length, JSON state, serialized FAISS index.
+    With `index_file` the index goes to that file (next to `path`) instead,
+    in plain faiss format so readers can memory-map it.
+    """
+    if index_file is not None:
+        full = os.path.join(os.path.dirname(path), index_file)
+        faiss.write_index(index, f"{full}.tmp")
+        with open(f"{full}.tmp", "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(f"{full}.tmp", full)
+        state = {**state, "index_file": index_file}
+    head = json.dumps(state).encode("utf-8")
+    body = [] if index_file is not None else [faiss.serialize_index(index).tobytes()]
+    atomic_write(path, [SNAPSHOT_MAGIC, struct.pack("<Q", len(head)), head, *body])
+
+
+def read_snapshot(path: str, mmap: bool = False):
+    with open(path, "rb") as f:
+        raw = f.read()
+    if not raw.startswith(SNAPSHOT_MAGIC):
+        raise ValueError(f"{path} is not an index snapshot")
+    off     = len(SNAPSHOT_MAGIC)
+    (n,)    = struct.unpack_from("<Q", raw, off)
+    off    += 8
+    state   = json.loads(raw[off:off + n])
+    if "index_file" in state:
+        full  = os.path.join(os.path.dirname(path), state["index_file"])
+        index = faiss.read_index(full, MMAP_FLAGS if mmap else 0)
+    else:
+        index = faiss.deserialize_index(np.frombuffer(raw, dtype="uint8", offset=off + n))
+    return index, state
+
+
+def encode_record(header: dict, vecs: Optional[np.ndarray] = None) -> bytes:
+    h    = json.dumps(header).encode("utf-8")
+    body = _HEADER.pack(len(h)) + h
+    if vecs is not None:
+        body += np.ascontiguousarray(vecs, dtype="float32").tobytes()
+    return _FRAME.pack(len(body), zlib.crc32(body)) + body
+
+
+def read_log(path: str):
+    """
+    Returns ([(header, vecs)], valid_bytes). Reading stops at the first
+    truncated or corrupt record; everything after it is unrecoverable.
+    """
+    if not os.path.exists(path):
+        return [], 0
+    with open(path, "rb") as f:
+        raw = f.read()
+    records, off = [], 0
+    while off + _FRAME.size <= len(raw):
+        n, crc = _FRAME.unpack_from(raw, off)
+        body   = raw[off + _FRAME.size: off + _FRAME.size + n]
+        if len(body) < n or zlib.crc32(body) != crc:
+            break
+        (hn,)  = _HEADER.unpack_from(body)
+        header = json.loads(body[_HEADER.size:_HEADER.size + hn])
+        rest   = body[_HEADER.size + hn:]
+        vecs   = np.frombuffer(rest, dtype="float32") if rest else None
+        records.append((header, vecs))
+        off += _FRAME.size + n
+    return records, off
+
+
+class VectorRows:
+    """
+    Full-precision copies of an index's vectors for exact re-ranking, as a
+    flat float32 file with the vector of doc id i at row i (ids are dense and
+    never reused), read through a memory map so only the rows a search
+    touches are paged in. Removed ids leave dead rows until the next full
+    rebuild writes a new file. With `path=None` the rows are kept in memory.
+    """
+
+    def __init__(self, path: Optional[str], dim: int):
+        self.path  = path
+        self.dim   = dim
+        self._data = np.zeros((0, dim), dtype="float32")
+        self._fd   = None
+
+    def _open(self):
+        if self._fd is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        return self._fd
+
+    def write(self, ids, vecs):
+        ids  = np.asarray(ids, dtype="int64")
+        vecs = np.ascontiguousarray(vecs, dtype="float32").reshape(len(ids), self.dim)
+        if self.path is None:
+            if len(ids) and ids.max() >= len(self._data):
+                grown = np.zeros((max(int(ids.max()) + 1, 2 * len(self._data)), self.dim), dtype="float32")
+                grown[:len(self._data)] = self._data
+                self._data = grown
+            self._data[ids] = vecs
+            return
+        fd = self._open()
+        # ids come from `allocate`, so a batch is almost always one run
+        start = 0
+        for end in [*(np.flatnonzero(np.diff(ids) != 1) + 1), len(ids)]:
+            os.pwrite(fd, vecs[start:end].tobytes(), int(ids[start]) * self.dim * 4)
+            start = end
+
+    def read(self, ids) -> np.ndarray:
+        ids = np.asarray(ids, dtype="int64")
+        if self.path is None:
+            return self._data[ids]
+        if len(ids) and ids.max() >= len(self._data):
+            # rows written since the file was last mapped
+            self.map()
+            if ids.max() >= len(self._data):
+                raise KeyError(f"{self.path} has no row {int(ids.max())}")
+        return np.asarray(self._data[ids])
+
+    def map(self):
+        rows       = os.path.getsize(self.path) // (self.dim * 4)
+        self._data = (np.memmap(self.path, dtype="float32", mode="r", shape=(rows, self.dim))
+                      if rows else np.zeros((0, self.dim), dtype="float32"))
+
+    def save_as(self, path: str, ids) -> "VectorRows":
+        """Copies the rows of `ids` into a new file-backed store at `path`."""
+        rows = VectorRows(path, self.dim)
+        if os.path.exists(path):
+            os.remove(path)
+        ids = np.asarray(ids, dtype="int64")
+        if len(ids):
+            rows.write(ids, self.read(ids))
+        return rows
+
+    def sync(self):
+        if self._fd is not None:
+            os.fsync(self._fd)
+
+    def close(self):
+        self._data = np.zeros((0, self.dim), dtype="float32")
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class PersistentIndex:
+    """
+    A FAISS index with its passage metadata (doc id -> dict), manifest
+    (file -> fingerprint and doc ids) and id counter, persisted as a snapshot
+    (`<base>.snap`) plus an append-only write-ahead log (`<base>.wal`) of the
+    adds and removes made since. Mutations are logged as they're applied;
+    `commit` fsyncs the log and folds it into a new snapshot once it outgrows
+    `compact_bytes`. With `base=None` nothing is persisted.
+
+    With `shared=True` several processes use the same files: each reader
+    memory-maps the newest snapshot generation (`load_shared`) and swaps to a
+    newer one when it appears (`refresh`). One process at a time holds the
+    writer lock (`lock_writer`), works on a private copy and publishes every
+    commit as a new generation (`<base>.g<gen>.faiss` plus the snapshot).
+
+    With a compressed `storage` (see vector_index.STORAGE_TYPES) the index
+    holds fp16/SQ8 codes and the float32 vectors go to `<base>.r<gen>.f32`
+    (see VectorRows), from which `search` re-ranks a shortlist exactly.
+    """
+
+    def __init__(self, base: Optional[str], dim: int, compact_bytes: int = COMPACT_BYTES,
+                 shared: bool = False, storage: str = "fp32"):
+        self.base           = base
+        self.dim            = dim
+        self.compact_bytes  = compact_bytes
+        self.shared         = shared
+        self.storage        = storage
+        self.index          = vector_index.make_index("flat", dim, storage=storage)
+        self.rows           = None
+        if storage != "fp32":
+            self.rows = VectorRows(None if base is None else f"{base}.r0.f32", dim)
+        self.meta           = MetaTable()
+        self.manifest       = {}
+        self.next_id        = 0
+        self.gen            = 0
+        self.lock           = threading.RLock()
+        self.needs_snapshot = False
+        self.mapped         = False
+        self._wal           = None
+        self._content_hash  = None
+        self._snap_id       = None
+        self._checked       = 0.0
+        self._writer_fd     = None
+
+    @property
+    def snap_path(self):
+        return f"{self.base}.snap"
+
+    @property
+    def wal_path(self):
+        return f"{self.base}.wal"
+
+    def exists(self) -> bool:
+        return os.path.exists(self.snap_path) or os.path.exists(self.wal_path)
+
+    def _rows_path(self, name: str) -> str:
+        return os.path.join(os.path.dirname(self.base), name)
+
+    def _set_state(self, index, state: dict, mapped: bool):
+        with self.lock:
+            if self.rows is not None:
+                self.rows.close()
+            rows_file = state.get("rows_file")
+            if rows_file is None and self.storage != "fp32" and not mapped:
+                # no full-precision copies kept yet; `load` fills them in
+                rows_file = f"{os.path.basename(self.base)}.r{state['gen']}.f32"
+            rows = VectorRows(self._rows_path(rows_file), self.dim) if rows_file else None
+            if rows is not None and mapped:
+                # now, while the generation's file is sure to exist
+                rows.map()
+            self.rows     = rows
+            self.index    = index
+            self.meta     = MetaTable.from_state(state["meta"])
+            self.manifest = state["manifest"]
+            self.next_id  = state["next_id"]
+            self.gen      = state["gen"]
+            self.mapped   = mapped
+            self._content_hash = None
+
+    def _snapshot_id(self):
+        try:
+            st = os.stat(self.snap_path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def load(self):
+        """Reads the last snapshot and replays the log written after it."""
+        empty = {"meta": {}, "manifest": {}, "next_id": 0, "gen": 0}
+        self._snap_id = self._snapshot_id()
+        if self._snap_id is not None:
+            index, state = read_snapshot(self.snap_path)
+            self._set_state(index, state, mapped=False)
+            if self.rows is not None and "rows_file" not in state and index.ntotal:
+                # snapshot from before the rows were kept; its vectors are the best we have
+                self.rows.write(*vector_index.export_vectors(index))
+                self.needs_snapshot = True
+        else:
+            self._set_state(vector_index.make_index("flat", self.dim, storage=self.storage), empty, mapped=False)
+
+        records, valid = read_log(self.wal_path)
+        # a log from an older generation was already folded into the snapshot
+        # (we crashed between writing the snapshot and resetting the log)
+        current = bool(records) and records[0][0] == {"op": "begin", "gen": self.gen}
+        for header, vecs in records[1:] if current else []:
+            self._apply(header, vecs)
+        if os.path.exists(self.wal_path) and (not current or valid < os.path.getsize(self.wal_path)):
+            if current:
+                logging.warning(f"Dropping torn tail of {self.wal_path} after {len(records)} records")
+            with open(self.wal_path, "r+b") as f:
+                f.truncate(valid if current else 0)
+
+        # vectors whose file never made it into the manifest (or whose file
+        # was replaced before the stale ids were removed) are unreachable
+        live    = {i for entry in self.manifest.values() for i in entry["doc_ids"]}
+        orphans = [i for i in self.meta if i not in live]
+        if orphans:
+            logging.warning(f"Dropping {len(orphans)} vectors left by an interrupted write to {self.base}")
+            self.remove(orphans)
+        return self
+
+    def load_shared(self):
+        """Maps the newest published generation read-only; the log is the writer's business."""
+        for attempt in range(3):
+            snap_id = self._snapshot_id()
+            if snap_id is None:
+                self._set_state(vector_index.make_index("flat", self.dim, storage=self.storage),
+                                {"meta": {}, "manifest": {}, "next_id": 0, "gen": 0}, mapped=False)
+                break
+            try:
+                index, state = read_snapshot(self.snap_path, mmap=True)
+                self._set_state(index, state, mapped=True)
+            except FileNotFoundError:
+                # the writer replaced the generation between our two reads
+                continue
+            break
+        self._snap_id = snap_id
+        self._checked = time.monotonic()
+        return self
+
+    def refresh(self, force: bool = False) -> bool:
+        """Swaps to a newer published generation if there is one; True if it did."""
+        if not self.shared or self._writer_fd is not None:
+            return False
+        if not force and time.monotonic() - self._checked < REFRESH_SECONDS:
+            return False
+        self._checked = time.monotonic()
+        if self._snapshot_id() == self._snap_id:
+            return False
+        self.load_shared()
+        return True
+
+    def lock_writer(self, blocking: bool = False) -> bool:
+        """
+        Takes the cross-process writer lock and loads a private, writable copy
+        of the newest state (replaying the log of a writer that crashed).
+        """
+        os.makedirs(os.path.dirname(self.snap_path), exist_ok=True)
+        fd = os.open(f"{self.base}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._writer_fd = fd
+        try:
+            self.load()
+        except Exception:
+            self.unlock_writer()
+            raise
+        return True
+
+    def unlock_writer(self):
+        """Goes back to the mapped copy of what was published and releases the lock."""
+        if self._writer_fd is None:
+            return
+        try:
+            self.close()
+            self.load_shared()
+        finally:
+            fd, self._writer_fd = self._writer_fd, None
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _apply(self, header: dict, vecs):
+        op = header["op"]
+        if op == "add":
+            ids = np.asarray(header["ids"], dtype="int64")
+            self._add(vecs.reshape(len(ids), self.dim), ids)
+            self.meta.update({int(k): v for k, v in header["meta"].items()})
+            self.next_id = max(self.next_id, header["next_id"])
+        elif op == "remove":
+            self._remove(header["ids"])
+        elif op == "files":
+            self.manifest.update(header["set"])
+            for fn in header["drop"]:
+                self.manifest.pop(fn, None)
+            self._content_hash = None
+
+    def _append(self, header: dict, vecs=None):
+        if self.base is None:
+            return
+        if self._wal is None:
+            os.makedirs(os.path.dirname(self.wal_path), exist_ok=True)
+            self._wal = open(self.wal_path, "ab")
+            if self._wal.tell() == 0:
+                self._wal.write(encode_record({"op": "begin", "gen": self.gen}))
+        self._wal.write(encode_record(header, vecs))
+
+    def allocate(self, n: int):
+        ids = list(range(self.next_id, self.next_id + n))
+        self.next_id += n
+        return ids
+
+    def _check_writable(self):
+        # writing to a mapped index aborts the process inside faiss
+        if self.mapped:
+            raise RuntimeError(f"{self.base} is mapped read-only; take the writer lock first")
+
+    def _add(self, vecs, ids):
+        if vector_index.needs_training(self.index):
+            vector_index.train_sq8(self.index, vecs)
+        self.index.add_with_ids(vecs, ids)
+        if self.rows is not None:
+            self.rows.write(ids, vecs)
+
+    def add_with_ids(self, vecs, ids):
+        """Same signature as the FAISS call, so EmbeddingPipeline can add straight into us."""
+        with self.lock:
+            self._check_writable()
+            self._add(vecs, ids)
+            meta = {str(i): self.meta[i] for i in map(int, ids) if i in self.meta}
+            self._append({"op": "add", "ids": [int(i) for i in ids], "meta": meta,
+                          "next_id": self.next_id}, vecs)
+
+    def _remove(self, doc_ids):
+        self.index = vector_index.remove_ids(self.index, doc_ids, self.rows)
+        for did in doc_ids:
+            self.meta.pop(did, None)
+
+    def remove(self, doc_ids):
+        if not doc_ids:
+            return
+        with self.lock:
+            self._check_writable()
+            self._remove(doc_ids)
+            self._append({"op": "remove", "ids": [int(i) for i in doc_ids]})
+
+    def set_files(self, entries: dict, drop=()):
+        if not entries and not drop:
+            return
+        with self.lock:
+            self.manifest.update(entries)
+            for fn in drop:
+                self.manifest.pop(fn, None)
+            self._content_hash = None
+            self._append({"op": "files", "set": entries, "drop": list(drop)})
+
+    def replace(self, other: "PersistentIndex"):
+        """Swaps in the contents of an index built off to the side; snapshotted on commit."""
+        with self.lock:
+            rows = other.rows
+            if rows is not None and self.base is not None:
+                # new ids, so a new file: readers of the old generation keep theirs
+                name = f"{os.path.basename(self.base)}.r{self.gen + 1}.f32"
+                rows = rows.save_as(self._rows_path(name), faiss.vector_to_array(other.index.id_map))
+            if self.rows is not None:
+                self.rows.close()
+            self.rows     = rows
+            self.index    = other.index
+            self.meta     = other.meta
+            self.manifest = other.manifest
+            self.next_id  = other.next_id
+            self.mapped   = False
+            self.needs_snapshot = True
+            self._content_hash  = None
+
+    def content_hash(self) -> str:
+        """Hash of the files indexed (by content where known); changes whenever they do."""
+        with self.lock:
+            if self._content_hash is None:
+                h = hashlib.sha256()
+                for fn in sorted(self.manifest):
+                    entry = self.manifest[fn]
+                    h.update(f"{fn}\0{entry.get('sha256') or entry['doc_ids']}\0".encode("utf-8"))
+                self._content_hash = h.hexdigest()
+            return self._content_hash
+
+    def commit(self):
+        """Makes everything logged so far durable, compacting if the log has grown large."""
+        if self.base is None:
+            return
+        with self.lock:
+            # rows first: a logged add must never outlive its vector
+            if self.rows is not None:
+                self.rows.sync()
+            if self._wal is not None:
+                self._wal.flush()
+                os.fsync(self._wal.fileno())
+            # shared readers only see snapshots, so every change is published as one
+            if self.needs_snapshot or (self._wal is not None and
+                                       (self.shared or self._wal.tell() > self.compact_bytes)):
+                self.snapshot()
+
+    def snapshot(self):
+        with self.lock:
+            state = {"meta": self.meta.to_state(), "manifest": self.manifest,
+                     "next_id": self.next_id, "gen": self.gen + 1}
+            if self.rows is not None:
+                self.rows.sync()
+                state["rows_file"] = os.path.basename(self.rows.path)
+            index_file = f"{os.path.basename(self.base)}.g{self.gen + 1}.faiss" if self.shared else None
+            write_snapshot(self.snap_path, self.index, state, index_file)
+            self.gen += 1
+            # readers still mapping an older generation keep it until they swap
+            keep = {index_file, state.get("rows_file")}
+            for old in self._generation_files():
+                if os.path.basename(old) not in keep:
+                    os.remove(old)
+            self.close()
+            # the log is only reset once the snapshot that covers it is in place
+            atomic_write(self.wal_path, [encode_record({"op": "begin", "gen": self.gen})])
+            self.needs_snapshot = False
+
+    def search(self, qv, top_k: int, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """
+        Same results as vector_index.search; a compressed index is searched
+        for RERANK_FACTOR times as many candidates, re-ranked exactly.
+        """
+        with self.lock:
+            index, rows = self.index, self.rows
+        if rows is None or vector_index.index_storage(index) == "fp32":
+            return vector_index.search(index, qv, top_k, nprobe, ef_search)
+        _, ids = vector_index.search(index, qv, top_k * vector_index.RERANK_FACTOR, nprobe, ef_search)
+        return vector_index.rerank(qv, ids, rows, top_k)
+
+    def close(self):
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        if self.rows is not None and self.base is not None:
+            self.rows.close()
+
+    def _generation_files(self):
+        """Published index generations and full-precision row files."""
+        base = glob.escape(self.base)
+        return glob.glob(f"{base}.g*.faiss") + glob.glob(f"{base}.r*.f32")
+
+    def destroy(self):
+        with self.lock:
+            self.close()
+            for path in [self.snap_path, self.wal_path, *self._generation_files()]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def disk_bytes(self) -> int:
+        paths = [self.snap_path, self.wal_path, *self._generation_files()]
+        return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
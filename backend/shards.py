@@ -0,0 +1,184 @@
+import glob
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import vector_index
+from persistence import COMPACT_BYTES, PersistentIndex
+
+
+def user_key(token: str) -> str:
+    # bearer tokens never end up in paths or logs
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+
+class Shard(PersistentIndex):
+    """
+    The vectors of one user's course: its own FAISS index, passage metadata
+    (doc id -> {source_file, start, end}) and manifest (file -> fingerprint
+    and doc ids). Doc ids are local to the shard.
+    """
+
+    def __init__(self, user: str, course_id: str, base: Optional[str], dim: int,
+                 compact_bytes: int = COMPACT_BYTES, shared: bool = False, storage: str = "fp32"):
+        super().__init__(base, dim, compact_bytes, shared, storage)
+        self.user      = user
+        self.course_id = course_id
+        self.writers   = 0
+        # BM25 over the same passages; rebuilt from the source text on load
+        self.lexical   = None
+        # called with the files whose entries changed when state is (re)loaded
+        self.on_change = None
+
+    def replace(self, other: "Shard"):
+        with self.lock:
+            super().replace(other)
+            self.lexical = other.lexical
+
+    def _set_state(self, index, state: dict, mapped: bool):
+        with self.lock:
+            stale = {fn for fn, e in self.manifest.items() if state["manifest"].get(fn) != e}
+            added = set(state["manifest"]) - set(self.manifest)
+            super()._set_state(index, state, mapped)
+            if stale or added:
+                # BM25 is rebuilt from the new text on first use
+                self.lexical = None
+            if stale and self.on_change is not None:
+                # another process changed or deleted these files
+                self.on_change(self, stale)
+
+    def memory_bytes(self) -> int:
+        lexical = self.lexical.memory_bytes() if self.lexical is not None else 0
+        return vector_index.index_bytes(self.index) + self.meta.memory_bytes() + lexical
+
+
+class ShardStore:
+    """
+    Lazily loads shards from `root/<user>/<course>.{snap,wal}` and keeps the
+    most recently used ones resident, evicting the least recently used once
+    the resident indexes exceed `max_bytes`. Shards being written are pinned.
+    With `shared=True` shards are mapped read-only and kept in step with the
+    generations other processes publish (see PersistentIndex).
+    """
+
+    def __init__(self, root: str, dim: int, max_bytes: int, compact_bytes: int = COMPACT_BYTES,
+                 shared: bool = False, on_change=None, storage: str = "fp32"):
+        self.root          = root
+        self.dim           = dim
+        self.max_bytes     = max_bytes
+        self.compact_bytes = compact_bytes
+        self.shared        = shared
+        self.storage       = storage
+        self.on_change     = on_change
+        self._resident = OrderedDict()
+        self._courses  = {}
+        self._lock     = threading.RLock()
+        self.loads     = 0
+        self.evictions = 0
+
+    def _new(self, user: str, course_id: str) -> Shard:
+        shard = Shard(user, course_id, os.path.join(self.root, user, course_id),
+                      self.dim, self.compact_bytes, self.shared, self.storage)
+        shard.on_change = self.on_change
+        return shard
+
+    def courses(self, user: str):
+        """Course ids the user has shards for, resident or on disk."""
+        with self._lock:
+            known = self._courses.get(user)
+            # other processes add and drop courses, so always look at the disk
+            if known is None or self.shared:
+                known = {
+                    os.path.splitext(os.path.basename(p))[0]
+                    for p in glob.glob(os.path.join(self.root, user, "*.snap"))
+                           + glob.glob(os.path.join(self.root, user, "*.wal"))
+                }
+                self._courses[user] = known
+            return sorted(known)
+
+    def get(self, user: str, course_id: str, create: bool = False) -> Optional[Shard]:
+        key = (user, course_id)
+        with self._lock:
+            shard = self._resident.get(key)
+            if shard is not None:
+                self._resident.move_to_end(key)
+                shard.refresh()
+                return shard
+
+            shard = self._new(user, course_id)
+            if shard.exists():
+                if self.shared:
+                    shard.load_shared()
+                else:
+                    shard.load()
+                self.loads += 1
+            elif create:
+                self.courses(user)
+                self._courses[user].add(course_id)
+            else:
+                return None
+
+            self._resident[key] = shard
+            self._evict(keep=key)
+            return shard
+
+    def pin(self, user: str, course_id: str) -> Shard:
+        """Gets (or creates) a shard and keeps it resident until `unpin`."""
+        with self._lock:
+            shard = self.get(user, course_id, create=True)
+            shard.writers += 1
+            return shard
+
+    def unpin(self, shard: Shard):
+        with self._lock:
+            shard.writers -= 1
+            self._evict()
+
+    def user_shards(self, user: str, course_ids=None):
+        wanted = self.courses(user)
+        if course_ids is not None:
+            wanted = [c for c in wanted if c in set(course_ids)]
+        return [s for s in (self.get(user, c) for c in wanted) if s is not None]
+
+    def save(self, shard: Shard):
+        shard.commit()
+
+    def drop(self, shard: Shard):
+        """Deletes a shard whose course no longer has any files."""
+        with self._lock:
+            self._resident.pop((shard.user, shard.course_id), None)
+            self._courses.get(shard.user, set()).discard(shard.course_id)
+            shard.destroy()
+
+    def _evict(self, keep=None):
+        total = sum(s.memory_bytes() for s in self._resident.values())
+        for key in list(self._resident):
+            if total <= self.max_bytes:
+                break
+            shard = self._resident[key]
+            if key == keep or shard.writers:
+                continue
+            # writers commit when they finish, so the copy on disk is current
+            del self._resident[key]
+            shard.close()
+            total -= shard.memory_bytes()
+            self.evictions += 1
+
+    def close(self):
+        with self._lock:
+            for shard in self._resident.values():
+                shard.close()
+
+    def stats(self):
+        with self._lock:
+            resident = list(self._resident.values())
+            return {
+                "resident_shards": len(resident),
+                "resident_bytes":  sum(s.memory_bytes() for s in resident),
+                "max_bytes":       self.max_bytes,
+                "vectors":         sum(s.index.ntotal for s in resident),
+                "loads":           self.loads,
+                "evictions":       self.evictions,
+            }
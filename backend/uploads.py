@@ -0,0 +1,123 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# one record per line; course pages and syllabi share the shape, the
+# syllabus is just slug "syllabus"
+#   {"course_id": "12345", "slug": "week-1", "text": "…"}
+MAX_RECORD_BYTES = 16 * 1024 * 1024
+
+_COURSE_ID = re.compile(r"\d{1,20}")
+_SLUG      = re.compile(r"[^/\\\0]+")
+# "<course_id>_<slug>.txt" has to fit the usual 255-byte file name limit
+MAX_SLUG_BYTES = 200
+
+
+class RecordError(ValueError):
+    pass
+
+
+def check_course_id(cid: str) -> str:
+    """Course ids name the shard and prefix the file names, so only digits."""
+    if not _COURSE_ID.fullmatch(cid):
+        raise RecordError("course_id must be numeric, at most 20 digits")
+    return cid
+
+
+def check_page(slug: str, text) -> str:
+    """The slug becomes part of a file name, so no path separators or dot names."""
+    if not _SLUG.fullmatch(slug) or slug in (".", ".."):
+        raise RecordError("missing or invalid slug")
+    if len(slug.encode("utf-8", errors="replace")) > MAX_SLUG_BYTES:
+        raise RecordError(f"slug longer than {MAX_SLUG_BYTES} bytes")
+    if not isinstance(text, str):
+        raise RecordError("text must be a string")
+    return text
+
+
+def parse_record(line: bytes):
+    """-> (key, course_id, text) for one NDJSON line; raises RecordError."""
+    try:
+        rec = json.loads(line)
+    except ValueError as e:
+        raise RecordError(f"invalid JSON: {e}")
+    if not isinstance(rec, dict):
+        raise RecordError("record must be an object")
+    cid, slug, text = str(rec.get("course_id", "")), str(rec.get("slug", "")), rec.get("text")
+    if isinstance(text, dict):  # syllabus objects as cached by the extension
+        text = text.get("content")
+    check_course_id(cid)
+    check_page(slug, text)
+    return f"{cid}_{slug}", cid, text
+
+
+async def read_lines(chunks, max_bytes: int = MAX_RECORD_BYTES):
+    """Splits a byte stream into non-empty lines without holding more than one record."""
+    buf = bytearray()
+    async for chunk in chunks:
+        buf += chunk
+        start = 0
+        while True:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(buf[start:end]).strip()
+            if line:
+                yield line
+            start = end + 1
+        del buf[:start]
+        if len(buf) > max_bytes:
+            raise RecordError(f"record longer than {max_bytes} bytes")
+    if buf.strip():
+        yield bytes(buf).strip()
+
+
+class UploadLog:
+    """
+    Records which record keys of a streamed upload are indexed and
+    persisted, so an interrupted upload can be resumed under the same
+    upload id without re-sending or re-embedding what already made it.
+    """
+
+    def __init__(self, path: str, ttl_s: float = 7 * 86400):
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS upload_records ("
+            " user TEXT, upload_id TEXT, key TEXT, created REAL,"
+            " PRIMARY KEY (user, upload_id, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS upload_records_created ON upload_records (created)")
+        self._conn.commit()
+
+    def done(self, user: str, upload_id: str) -> set:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key FROM upload_records WHERE user = ? AND upload_id = ?", (user, upload_id)
+            ).fetchall()
+        return {r[0] for r in rows}
+
+    def mark(self, user: str, upload_id: str, keys):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO upload_records (user, upload_id, key, created) VALUES (?, ?, ?, ?)",
+                [(user, upload_id, k, now) for k in keys],
+            )
+            self._conn.execute("DELETE FROM upload_records WHERE created < ?", (now - self.ttl_s,))
+            self._conn.commit()
+
+    def status(self, user: str, upload_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*), MAX(created) FROM upload_records WHERE user = ? AND upload_id = ?",
+                (user, upload_id),
+            ).fetchone()
+        if not row[0]:
+            return None
+        return {"upload_id": upload_id, "records": row[0], "updated": row[1]}
@@ -0,0 +1,245 @@
+import logging
+import math
+from typing import Optional
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "hnsw", "ivfpq")
+# how flat and HNSW indexes hold their vectors: full float32, float16 (half
+# the memory, near-lossless) or 8-bit scalar quantized (a quarter, lossy;
+# searches re-rank a shortlist against the full vectors, see PersistentIndex)
+STORAGE_TYPES = ("fp32", "fp16", "sq8")
+
+HNSW_M          = 32
+HNSW_EF_BUILD   = 80
+HNSW_EF_SEARCH  = 64
+PQ_BITS         = 8
+IVF_NPROBE      = 16
+# compressed searches fetch this many times k candidates for exact re-ranking
+RERANK_FACTOR   = 4
+# SQ8 ranges are fixed at the first add; widened past what the sample spans
+# so later vectors aren't clipped (full rebuilds and conversions retrain)
+SQ8_MARGIN      = 1.25
+SQ8_MIN_RMS     = 4.0
+
+_QTYPES = {"fp16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}
+
+
+def pq_subquantizers(dim: int) -> int:
+    # 16-dim sub-vectors is a reasonable default; m has to divide dim
+    m = max(1, dim // 16)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def ivf_lists(n: int) -> int:
+    return max(16, min(65536, int(4 * math.sqrt(max(n, 1)))))
+
+
+def min_train_size(n: int) -> int:
+    """Vectors needed before IVF-PQ can be trained without degenerate centroids."""
+    return max(39 * ivf_lists(n), 39 * (1 << PQ_BITS))
+
+
+def make_index(kind: str, dim: int, n_hint: int = 0, storage: str = "fp32"):
+    """
+    Returns an empty IndexIDMap2 over the requested structure. IVF-PQ and
+    SQ8 come back untrained; see `train_and_fill` and `train_sq8`. IVF-PQ
+    has its own compression and ignores `storage`.
+    """
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Unknown vector storage {storage!r}; expected one of {STORAGE_TYPES}")
+    if kind == "flat" and storage == "fp32":
+        inner = faiss.IndexFlatL2(dim)
+    elif kind == "flat":
+        inner = faiss.IndexScalarQuantizer(dim, _QTYPES[storage], faiss.METRIC_L2)
+    elif kind == "hnsw":
+        if storage == "fp32":
+            inner = faiss.IndexHNSWFlat(dim, HNSW_M)
+        else:
+            inner = faiss.IndexHNSWSQ(dim, _QTYPES[storage], HNSW_M)
+        inner.hnsw.efConstruction = HNSW_EF_BUILD
+        inner.hnsw.efSearch       = HNSW_EF_SEARCH
+    elif kind == "ivfpq":
+        quantizer = faiss.IndexFlatL2(dim)
+        inner     = faiss.IndexIVFPQ(quantizer, dim, ivf_lists(n_hint), pq_subquantizers(dim), PQ_BITS)
+        inner.nprobe = IVF_NPROBE
+    else:
+        raise ValueError(f"Unknown index type {kind!r}; expected one of {INDEX_TYPES}")
+    return faiss.IndexIDMap2(inner)
+
+
+def index_kind(idx) -> str:
+    inner = faiss.downcast_index(idx.index) if isinstance(idx, faiss.IndexIDMap2) else faiss.downcast_index(idx)
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivfpq"
+    return "flat"
+
+
+def _codes(idx):
+    """The index holding an IndexIDMap2's vectors (HNSW keeps them in `storage`)."""
+    inner = faiss.downcast_index(idx.index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.downcast_index(inner.storage)
+    return inner
+
+
+def index_storage(idx) -> str:
+    """How `idx` holds its vectors: one of STORAGE_TYPES, or "pq" for IVF-PQ."""
+    codes = _codes(idx)
+    if isinstance(codes, faiss.IndexIVF):
+        return "pq"
+    if isinstance(codes, faiss.IndexScalarQuantizer):
+        return "fp16" if codes.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "fp32"
+
+
+def index_bytes(idx) -> int:
+    """Rough resident size of an IndexIDMap2, for memory-based eviction."""
+    n     = idx.ntotal
+    inner = faiss.downcast_index(idx.index)
+    ids   = 16 * n  # id_map + rev_map
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return ids + n * (inner.pq.code_size + 8) + inner.nlist * idx.d * 4
+    codes = _codes(idx)
+    size  = ids + n * (codes.code_size if isinstance(codes, faiss.IndexScalarQuantizer) else idx.d * 4)
+    if isinstance(inner, faiss.IndexHNSW):
+        size += n * HNSW_M * 2 * 4
+    return size
+
+
+def train_sq8(idx, sample):
+    """
+    Sets symmetric per-dimension SQ8 ranges from `sample` (a few vectors, or
+    a single one, are enough), instead of faiss's min/max training, which
+    leaves dimensions the sample doesn't vary in with no range at all.
+    """
+    sample = np.asarray(sample, dtype="float32").reshape(-1, idx.d)
+    rms    = float(np.sqrt(np.mean(sample ** 2))) if sample.size else 1.0
+    vmax   = np.maximum(SQ8_MARGIN * np.abs(sample).max(axis=0), SQ8_MIN_RMS * rms)
+    vmax   = np.maximum(vmax, 1e-6).astype("float32")
+    codes  = _codes(idx)
+    faiss.copy_array_to_vector(np.concatenate([-vmax, 2 * vmax]), codes.sq.trained)
+    for level in (codes, faiss.downcast_index(idx.index), idx):
+        level.is_trained = True
+
+
+def needs_training(idx) -> bool:
+    return not idx.is_trained and index_storage(idx) == "sq8"
+
+
+def export_vectors(idx):
+    """
+    Returns (ids, vectors) currently stored in an IndexIDMap2. Exact for
+    fp32 flat and HNSW; otherwise the vectors come back as their quantized
+    reconstruction.
+    """
+    ids = faiss.vector_to_array(idx.id_map).astype("int64")
+    if not len(ids):
+        return ids, np.zeros((0, idx.d), dtype="float32")
+    inner = faiss.downcast_index(idx.index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.make_direct_map()
+    return ids, inner.reconstruct_n(0, len(ids))
+
+
+def train_and_fill(kind: str, dim: int, ids, vecs, storage: str = "fp32"):
+    idx = make_index(kind, dim, len(ids), storage)
+    if kind == "ivfpq":
+        idx.train(vecs)
+    elif needs_training(idx) and len(ids):
+        train_sq8(idx, vecs)
+    if len(ids):
+        idx.add_with_ids(vecs, ids)
+    return idx
+
+
+def _vectors(idx, rows=None):
+    """Ids and vectors of `idx`, taken from the full-precision `rows` when there are any."""
+    if rows is None:
+        return export_vectors(idx)
+    ids = faiss.vector_to_array(idx.id_map).astype("int64")
+    return ids, rows.read(ids)
+
+
+def remove_ids(idx, ids, rows=None):
+    """
+    Removes `ids` from `idx` and returns the index to use afterwards. HNSW
+    can't delete in place, so it's rebuilt from its stored vectors (or from
+    `rows`, the full-precision copies, when compressed).
+    """
+    ids = np.asarray(ids, dtype="int64")
+    if index_kind(idx) != "hnsw":
+        idx.remove_ids(ids)
+        return idx
+    all_ids, vecs = _vectors(idx, rows)
+    keep = ~np.isin(all_ids, ids)
+    return train_and_fill("hnsw", idx.d, all_ids[keep], vecs[keep], index_storage(idx))
+
+
+def target_kind(configured: str, n: int, threshold: int, ann_kind: str) -> str:
+    """
+    Which structure an index of `n` vectors should use. "auto" stays exact
+    below `threshold` and switches to `ann_kind` above it; IVF-PQ also waits
+    until there are enough vectors to train on.
+    """
+    kind = configured
+    if configured == "auto":
+        kind = ann_kind if n >= threshold else "flat"
+    if kind == "ivfpq" and n < min_train_size(n):
+        return "flat"
+    return kind
+
+
+def maybe_convert(idx, configured: str, threshold: int, ann_kind: str,
+                  storage: str = "fp32", rows=None):
+    """
+    Returns a rebuilt index if `idx` should change structure or storage,
+    else None. With `rows` the new index is built from full precision.
+    """
+    want = target_kind(configured, idx.ntotal, threshold, ann_kind)
+    have = index_kind(idx)
+    if want == have and (want == "ivfpq" or index_storage(idx) == storage):
+        return None
+    ids, vecs = _vectors(idx, rows)
+    logging.info(f"Converting {len(ids)}-vector index from {have}/{index_storage(idx)} to {want}/{storage}")
+    return train_and_fill(want, idx.d, ids, vecs, storage)
+
+
+def search_params(idx, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Per-request search parameters, so concurrent queries don't share knobs."""
+    kind = index_kind(idx)
+    if kind == "hnsw" and ef_search:
+        return faiss.SearchParametersHNSW(efSearch=ef_search)
+    if kind == "ivfpq" and nprobe:
+        return faiss.SearchParametersIVF(nprobe=nprobe)
+    return None
+
+
+def search(idx, qv, top_k: int, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    params = search_params(idx, nprobe, ef_search)
+    if params is None:
+        return idx.search(qv, top_k)
+    return idx.search(qv, top_k, params=params)
+
+
+def rerank(qv, ids, rows, top_k: int):
+    """
+    Exact L2 re-ranking of a shortlist (`ids` from a compressed search, -1
+    padded) against the full-precision `rows`; same shapes as `search`.
+    """
+    dists = np.full((len(qv), top_k), np.inf, dtype="float32")
+    out   = np.full((len(qv), top_k), -1, dtype="int64")
+    for q, (query, cand) in enumerate(zip(qv, ids)):
+        cand = cand[cand >= 0]
+        if not len(cand):
+            continue
+        d     = ((rows.read(cand) - query) ** 2).sum(axis=1)
+        order = np.argsort(d, kind="stable")[:top_k]
+        dists[q, :len(order)] = d[order]
+        out[q, :len(order)]   = cand[order]
+    return dists, out
@@ -4,6 +4,35 @@ const API_BASE    = "http://localhost:8000";
 const API_TOKEN   = "dummy_user";
 const TOP_K       = 5;
 
+// uploads, rebuilds and deadline syncs run as background jobs (202 + a job
+// to poll); resolves with the job's result either way
+async function jobResult(res) {
+  let job = await res.json();
+  if (!res.ok) throw new Error(job.detail || `Request failed (${res.status})`);
+  if (res.status !== 202) return job;
+  while (!['done', 'failed', 'cancelled'].includes(job.status)) {
+    await new Promise(resolve => setTimeout(resolve, 1000));
+    const poll = await fetch(`${API_BASE}${job.status_url}`, {
+      headers: { 'Authorization': `Bearer ${API_TOKEN}` }
+    });
+    job = await poll.json();
+    if (!poll.ok) throw new Error(job.detail || 'Job lookup failed');
+  }
+  if (job.status !== 'done') throw new Error(job.error || `Job ${job.status}`);
+  return job.result;
+}
+
+// what a /api/rag/build result says: a full rebuild, an incremental update
+// (the usual case) or a skip
+function buildSummary(build) {
+  if (build.status === 'rebuilt') return `Index rebuilt: ${build.documents_indexed} docs ready.`;
+  if (build.status === 'updated') {
+    return `Index updated: ${build.added} added, ${build.updated} updated, ` +
+           `${build.removed} deleted, ${build.unchanged} unchanged.`;
+  }
+  return `Build skipped: ${build.reason}`;
+}
+
 window.addEventListener('DOMContentLoaded', () => {
   
   // —— TAB SWITCHING (unchanged) ——
@@ -179,13 +208,16 @@ window.addEventListener('DOMContentLoaded', () => {
         },
         body: JSON.stringify({ courses: blobData })
       });
-      if (!res.ok) {
-        const err = await res.text();
-        return updatePlanProgress("Upload error: " + err, true);
+      let j;
+      try {
+        j = await jobResult(res);
+      } catch (err) {
+        return updatePlanProgress("Upload error: " + err.message, true);
       }
-      const j = await res.json();
       if (planStatusInd) planStatusInd.textContent = '';
-      updatePlanProgress(`Success! Indexed ${j.indexed} document(s) for planning.`);
+      updatePlanProgress(j.unchanged
+        ? 'Your courses are already up to date for planning.'
+        : 'Success! Saved your courses for planning.');
     } catch (err) {
       updatePlanProgress("Scrape error: " + err.message, true);
     }
@@ -386,8 +418,7 @@ window.addEventListener('DOMContentLoaded', () => {
         },
         body: JSON.stringify({ docs: window.canvasCache })
       });
-      const up = await res.json();
-      if (!res.ok) throw new Error(up.detail || 'Upload failed');
+      const up = await jobResult(res);
       setChatStatus(`Indexed ${up.indexed} docs. Rebuilding index…`);
 
       const buildRes = await fetch(`${API_BASE}/api/rag/build`, {
@@ -398,12 +429,8 @@ window.addEventListener('DOMContentLoaded', () => {
         },
         body: JSON.stringify({ overwrite: true })
       });
-      const buildJson = await buildRes.json();
-      setChatStatus(
-        buildJson.status === 'rebuilt'
-          ? `Index rebuilt: ${buildJson.documents_indexed} docs ready.`
-          : `Build skipped: ${buildJson.reason}`
-      );
+      const buildJson = await jobResult(buildRes);
+      setChatStatus(buildSummary(buildJson));
     } catch (err) {
       console.error(err);
       setChatStatus('Upload error: ' + err.message);
@@ -553,8 +580,7 @@ window.addEventListener('DOMContentLoaded', () => {
             'Content-Type': 'application/json'
           }
         });
-        const json = await res.json();
-        if (!res.ok) throw new Error(json.detail || 'Sync failed');
+        const json = await jobResult(res);
         setChatStatus('Deadlines Synced');
         console.log('Deadlines:', json.deadlines);
       } catch (err) {
@@ -2,6 +2,35 @@ const API_BASE    = "http://localhost:8000";
 const API_TOKEN   = "dummy_user";           
 const TOP_K       = 5;
 
+// uploads, rebuilds and deadline syncs run as background jobs (202 + a job
+// to poll); resolves with the job's result either way
+async function jobResult(res) {
+  let job = await res.json();
+  if (!res.ok) throw new Error(job.detail || `Request failed (${res.status})`);
+  if (res.status !== 202) return job;
+  while (!['done', 'failed', 'cancelled'].includes(job.status)) {
+    await new Promise(resolve => setTimeout(resolve, 1000));
+    const poll = await fetch(`${API_BASE}${job.status_url}`, {
+      headers: { 'Authorization': `Bearer ${API_TOKEN}` }
+    });
+    job = await poll.json();
+    if (!poll.ok) throw new Error(job.detail || 'Job lookup failed');
+  }
+  if (job.status !== 'done') throw new Error(job.error || `Job ${job.status}`);
+  return job.result;
+}
+
+// what a /api/rag/build result says: a full rebuild, an incremental update
+// (the usual case) or a skip
+function buildSummary(build) {
+  if (build.status === 'rebuilt') return `Index rebuilt: ${build.documents_indexed} docs ready.`;
+  if (build.status === 'updated') {
+    return `Index updated: ${build.added} added, ${build.updated} updated, ` +
+           `${build.removed} deleted, ${build.unchanged} unchanged.`;
+  }
+  return `Build skipped: ${build.reason}`;
+}
+
 window.addEventListener('DOMContentLoaded', () => {
   const getEl = id => {
     const el = document.getElementById(id);
@@ -180,8 +209,7 @@ window.addEventListener('DOMContentLoaded', () => {
             body: JSON.stringify({ docs: window.canvasCache })
           });
           
-          const up = await res.json();
-          if (!res.ok) throw new Error(up.detail || 'Upload failed');
+          const up = await jobResult(res);
           
           setStatus(`Indexed ${up.indexed} docs. Rebuilding index…`);
           setCanvasStatus('Building index...');
@@ -195,12 +223,8 @@ window.addEventListener('DOMContentLoaded', () => {
             body: JSON.stringify({ overwrite: true })
           });
           
-          const buildJson = await buildRes.json();
-          const successMessage = buildJson.status === 'rebuilt' 
-            ? `Index rebuilt: ${buildJson.documents_indexed} docs ready.`
-            : `Build skipped: ${buildJson.reason}`;
-          
-          setStatus(successMessage);
+          const buildJson = await jobResult(buildRes);
+          setStatus(buildSummary(buildJson));
           setCanvasStatus('Canvas data imported successfully!', true);
           
           step1.classList.add('completed');